@@ -0,0 +1,670 @@
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from dataclasses import dataclass, field, replace
+from importlib import import_module
+from queue import Empty
+from threading import BrokenBarrierError
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Simulates several Neovim instances saving, toggling and deleting revisions of the same files with one shared local
+# history folder. Every worker process runs the plugin coroutines against a fake Nvim:
+#   python3 benchmarks/loadtest.py --workers 16 --duration 60 --mix save=85,toggle=10,delete=5 > result.json
+# The result is a JSON document: throughput, latency percentiles, lock wait, errors, corruption and disk growth.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rplugin', 'python3'))
+local_history = import_module('local-history.local_history')
+nvim = import_module('local-history.nvim')
+profiler = import_module('local-history.profiler')
+scrub = import_module('local-history.scrub')
+settings_module = import_module('local-history.settings')
+storage = import_module('local-history.storage')
+utils = import_module('local-history.utils')
+
+_OPERATIONS = ('save', 'toggle', 'delete')
+
+_WORDS = ('local', 'history', 'record', 'buffer', 'window', 'return', 'self', 'def', 'import', 'None')
+
+_TREE_LINE_PATTERN = re.compile(r'\[([0-9]+)\]')
+
+# Errors kept in the result for every worker, the other ones are only counted
+_MAX_ERROR_SAMPLES = 5
+
+
+@dataclass(frozen=False)
+class _FakeBuffer:
+    name: str
+    lines: list
+    options: Dict[str, Any] = field(default_factory=dict)
+    changedtick: int = 1
+
+
+def _get_line_index(index: int, line_count: int) -> int:
+    # Negative indexes count from the end, -1 is past the last line
+    return index if index >= 0 else line_count + 1 + index
+
+
+class _FakeApi:
+    # The subset of the Neovim API used by the plugin, with a single tab page
+
+    def __init__(self) -> None:
+        self._buffers: Dict[int, _FakeBuffer] = {1: _FakeBuffer('', [''])}
+        self._windows: Dict[int, int] = {1: 1}
+        self._window_options: Dict[int, Dict[str, Any]] = {1: {}}
+        self._cursors: Dict[int, Tuple[int, int]] = {}
+        self._options: Dict[str, Any] = {'splitright': False, 'splitbelow': False}
+        self._current_window = 1
+        self._next_id = 2
+
+    def edit(self, file_path: str, lines: list) -> None:
+        # Shows the file in the first window, as :edit would
+        for buffer_number, buffer in self._buffers.items():
+            if buffer.name == file_path:
+                buffer.lines = list(lines)
+                buffer.changedtick += 1
+                break
+        else:
+            buffer_number = self._new_id()
+            self._buffers[buffer_number] = _FakeBuffer(file_path, list(lines))
+        window = min(self._windows)
+        self._windows[window] = buffer_number
+        self._current_window = window
+
+    def find_buffer(self, file_type: str) -> Optional[Tuple[int, int]]:
+        for window, buffer_number in self._windows.items():
+            if self._buffers[buffer_number].options.get('filetype') == file_type:
+                return window, buffer_number
+        return None
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id - 1
+
+    def call_atomic(self, calls: Sequence[Tuple[str, Sequence[Any]]]) -> Tuple[list, None]:
+        return [getattr(self, name[len('nvim_'):])(*args) for name, args in calls], None
+
+    def command(self, command: str) -> None:
+        if command.endswith('split'):
+            window = self._new_id()
+            self._windows[window] = self._windows[self._current_window]
+            self._window_options[window] = {}
+            self._current_window = window
+
+    def get_var(self, name: str) -> Any:
+        raise KeyError(name)
+
+    def get_option(self, name: str) -> Any:
+        return self._options.get(name)
+
+    def set_option(self, name: str, value: Any) -> None:
+        self._options[name] = value
+
+    def get_current_tabpage(self) -> int:
+        return 1
+
+    def tabpage_list_wins(self, tabpage: int) -> list:
+        return list(self._windows)
+
+    def list_wins(self) -> list:
+        return list(self._windows)
+
+    def get_current_win(self) -> int:
+        return self._current_window
+
+    def set_current_win(self, window: int) -> None:
+        self._current_window = window
+
+    def win_get_position(self, window: int) -> Tuple[int, int]:
+        return 0, window
+
+    def win_get_option(self, window: int, name: str) -> Any:
+        return self._window_options[window].get(name, False)
+
+    def win_set_option(self, window: int, name: str, value: Any) -> None:
+        self._window_options[window][name] = value
+
+    def win_get_buf(self, window: int) -> int:
+        return self._windows[window]
+
+    def win_set_buf(self, window: int, buffer_number: int) -> None:
+        self._windows[window] = buffer_number
+
+    def win_get_cursor(self, window: int) -> Tuple[int, int]:
+        return self._cursors.get(window, (1, 0))
+
+    def win_set_cursor(self, window: int, cursor: Tuple[int, int]) -> None:
+        self._cursors[window] = tuple(cursor)
+
+    def win_close(self, window: int, force: bool) -> None:
+        del self._windows[window]
+        self._cursors.pop(window, None)
+        if self._current_window == window:
+            self._current_window = min(self._windows)
+
+    def get_current_buf(self) -> int:
+        return self._windows[self._current_window]
+
+    def create_buf(self, listed: bool, scratch: bool) -> int:
+        buffer_number = self._new_id()
+        self._buffers[buffer_number] = _FakeBuffer('', [''])
+        return buffer_number
+
+    def list_bufs(self) -> list:
+        return list(self._buffers)
+
+    def buf_is_valid(self, buffer_number: int) -> bool:
+        return buffer_number in self._buffers
+
+    def buf_is_loaded(self, buffer_number: int) -> bool:
+        return buffer_number in self._buffers
+
+    def buf_get_name(self, buffer_number: int) -> str:
+        return self._buffers[buffer_number].name
+
+    def buf_set_keymap(self, buffer_number: int, mode: str, lhs: str, rhs: str, options: dict) -> None:
+        pass
+
+    def buf_get_option(self, buffer_number: int, name: str) -> Any:
+        return self._buffers[buffer_number].options.get(name, True if name == 'modifiable' else '')
+
+    def buf_set_option(self, buffer_number: int, name: str, value: Any) -> None:
+        self._buffers[buffer_number].options[name] = value
+
+    def buf_get_var(self, buffer_number: int, name: str) -> Any:
+        if name != 'changedtick':
+            raise KeyError(name)
+        return self._buffers[buffer_number].changedtick
+
+    def buf_line_count(self, buffer_number: int) -> int:
+        return len(self._buffers[buffer_number].lines)
+
+    def buf_get_lines(self, buffer_number: int, start: int, end: int, strict: bool) -> list:
+        lines = self._buffers[buffer_number].lines
+        return lines[_get_line_index(start, len(lines)):_get_line_index(end, len(lines))]
+
+    def buf_set_lines(self, buffer_number: int, start: int, end: int, strict: bool, replacement: list) -> None:
+        buffer = self._buffers[buffer_number]
+        buffer.lines[_get_line_index(start, len(buffer.lines)):_get_line_index(end, len(buffer.lines))] = replacement
+        buffer.changedtick += 1
+
+
+
+class _FakeFuncs:
+
+    def confirm(self, *args: Any) -> int:
+        return 1
+
+
+class _FakeNvim:
+    # Requests of the plugin are run on the event loop, after a simulated round trip
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, rpc_latency: float) -> None:
+        self.api = _FakeApi()
+        self.funcs = _FakeFuncs()
+        self._loop = loop
+        self._rpc_latency = rpc_latency
+        self.channel_id = 1
+
+    def async_call(self, func: Callable[[], None]) -> None:
+        if self._rpc_latency:
+            self._loop.call_soon_threadsafe(self._loop.call_later, self._rpc_latency, func)
+        else:
+            self._loop.call_soon_threadsafe(func)
+
+    def command(self, command: str) -> None:
+        self.api.command(command)
+
+    def exec_lua(self, code: str, *args: Any) -> Any:
+        # Buffer attach and detach: no buffer updates are sent, the plugin reads the lines again when the changedtick
+        # changes
+        return False
+
+    def out_write(self, message: str) -> None:
+        pass
+
+    def err_write(self, message: str) -> None:
+        pass
+
+
+class _LogCounter(logging.Handler):
+
+    def __init__(self) -> None:
+        super().__init__(logging.WARNING)
+        self.counts: Dict[str, int] = {}
+        self.samples: List[str] = []
+
+    def emit(self, log_record: logging.LogRecord) -> None:
+        level = log_record.levelname.lower()
+        self.counts[level] = self.counts.get(level, 0) + 1
+        if log_record.levelno >= logging.ERROR and len(self.samples) < _MAX_ERROR_SAMPLES:
+            self.samples.append(log_record.getMessage())
+
+
+def _make_content(lines: int, rand: random.Random) -> list:
+    return [' '.join(rand.choice(_WORDS) for _ in range(8)) for _ in range(lines)]
+
+
+def _edit_content(lines: list, rand: random.Random) -> list:
+    # A few lines replaced, inserted or removed, like a save while editing
+    lines = list(lines)
+    for _ in range(rand.randint(1, 5)):
+        index = rand.randrange(len(lines) + 1)
+        action = rand.random()
+        if action < 0.6 and index < len(lines):
+            lines[index] = ' '.join(rand.choice(_WORDS) for _ in range(8))
+        elif action < 0.85 or len(lines) < 2:
+            lines.insert(index, ' '.join(rand.choice(_WORDS) for _ in range(8)))
+        elif index < len(lines):
+            del lines[index]
+    return lines
+
+
+def _write_file(file_path: str, lines: list) -> None:
+    # Written atomically so that saves of other workers never read a partial file
+    temporary_path = '%s.%d.tmp' % (file_path, os.getpid())
+    with open(temporary_path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(temporary_path, file_path)
+
+
+def _read_file(file_path: str) -> list:
+    with open(file_path, 'r') as file:
+        return file.read().splitlines()
+
+
+def _parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for item in mix.split(','):
+        operation, _, weight = item.partition('=')
+        operation = operation.strip()
+        if operation not in _OPERATIONS:
+            raise argparse.ArgumentTypeError('Unknown operation %s, expected one of %s' %
+                                             (operation, ', '.join(_OPERATIONS)))
+        try:
+            weights[operation] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError('Invalid weight of %s: %s' % (operation, weight))
+    if not any(weight > 0 for weight in weights.values()):
+        raise argparse.ArgumentTypeError('The operation mix is empty')
+
+    return weights
+
+
+class _Worker:
+    # One simulated Neovim instance, its operations run one after the other like the commands of a user
+
+    def __init__(self, args: argparse.Namespace, index: int, file_paths: Sequence[str], settings: Any,
+                 fake_nvim: _FakeNvim) -> None:
+        self._args = args
+        self._index = index
+        self._file_paths = file_paths
+        self._settings = settings
+        self._api = fake_nvim.api
+        self._random = random.Random(args.seed + index)
+        # Lower files are edited more often, all workers share the same hot files
+        self._file_weights = [1 / (rank + 1)**args.skew for rank in range(len(file_paths))]
+        self._operations = list(args.mix)
+        self._operation_weights = [args.mix[operation] for operation in self._operations]
+        self.latencies: Dict[str, List[float]] = {operation: [] for operation in _OPERATIONS}
+        self.skipped: Dict[str, int] = {operation: 0 for operation in _OPERATIONS}
+        self.errors: Dict[str, int] = {}
+        self.error_samples: List[str] = []
+
+    async def run(self, deadline: float, operations: Any) -> None:
+        done = 0
+        while time.monotonic() < deadline and (not self._args.operations or done < self._args.operations):
+            operation = self._random.choices(self._operations, self._operation_weights)[0]
+            file_path = self._random.choices(self._file_paths, self._file_weights)[0]
+            try:
+                elapsed = await getattr(self, '_' + operation)(file_path)
+            except Exception as e:
+                self._add_error(operation, e)
+                await self._close_windows()
+            else:
+                if elapsed is None:
+                    self.skipped[operation] += 1
+                else:
+                    self.latencies[operation].append(elapsed * 1000)
+            done += 1
+            with operations.get_lock():
+                operations.value += 1
+            if self._args.think_time:
+                await asyncio.sleep(self._random.expovariate(1 / self._args.think_time))
+
+        await self._close_windows()
+        for task in (local_history._load_task, local_history._backfill_task, local_history._verify_task):
+            if task is None:
+                continue
+            if not task.done():
+                await asyncio.wait([task])
+            # Retrieved here, the exception handler is not called for them
+            if not task.cancelled() and task.exception() is not None:
+                self._add_error('background', task.exception())
+
+    def handle_exception(self, loop: asyncio.AbstractEventLoop, context: Dict[str, Any]) -> None:
+        # Exceptions of the tasks of the plugin which are never awaited (loading, backfill), called when the task is
+        # garbage collected
+        exception = context.get('exception')
+        if exception is None:
+            exception = RuntimeError(context.get('message', 'unknown error'))
+        self._add_error('background', exception)
+
+    def _add_error(self, operation: str, exception: BaseException) -> None:
+        key = '%s: %s' % (operation, type(exception).__name__)
+        self.errors[key] = self.errors.get(key, 0) + 1
+        if len(self.error_samples) < _MAX_ERROR_SAMPLES:
+            self.error_samples.append('%s\n%s' % (key, ''.join(
+                traceback.format_exception(type(exception), exception, exception.__traceback__))))
+
+    async def _save(self, file_path: str) -> Optional[float]:
+        lines = _edit_content(await utils.run_in_executor(_read_file, file_path), self._random)
+        await utils.run_in_executor(_write_file, file_path, lines)
+        self._api.edit(file_path, lines)
+        start = time.perf_counter()
+        await local_history.local_history_save(self._settings, file_path)
+        return time.perf_counter() - start
+
+    async def _toggle(self, file_path: str) -> Optional[float]:
+        # From the command until the tree and the preview are rendered, closing the windows is not measured
+        start = time.perf_counter()
+        await self._open(file_path)
+        elapsed = time.perf_counter() - start
+        await self._close_windows()
+        return elapsed
+
+    async def _delete(self, file_path: str) -> Optional[float]:
+        await self._open(file_path)
+        window_and_buffer = self._api.find_buffer(local_history._LOCAL_HISTORY_FILE_TYPE)
+        if window_and_buffer is None:
+            return None
+        window, buffer_number = window_and_buffer
+        rows = [row for row, line in enumerate(self._api.buf_get_lines(buffer_number, 0, -1, False), 1)
+                if _TREE_LINE_PATTERN.search(line)]
+        if not rows:
+            await self._close_windows()
+            return None
+
+        self._api.win_set_cursor(window, (self._random.choice(rows), 0))
+        start = time.perf_counter()
+        await local_history.local_history_delete(self._settings)
+        elapsed = time.perf_counter() - start
+        await self._close_windows()
+        return elapsed
+
+    async def _open(self, file_path: str) -> None:
+        lines = await utils.run_in_executor(_read_file, file_path)
+        self._api.edit(file_path, lines)
+        await local_history.local_history_toggle(self._settings)
+        if local_history._load_task is not None:
+            await local_history._load_task
+
+    async def _close_windows(self) -> None:
+        if self._api.find_buffer(local_history._LOCAL_HISTORY_FILE_TYPE) is not None:
+            await local_history.local_history_quit(self._settings)
+
+
+def _run_worker(args: argparse.Namespace, index: int, file_paths: Sequence[str], barrier: Any, operations: Any,
+                results: Any) -> None:
+    log_counter = _LogCounter()
+    logger = logging.getLogger(local_history.log.name)
+    logger.addHandler(log_counter)
+    logger.setLevel(logging.WARNING)
+
+    async def _run() -> _Worker:
+        fake_nvim = _FakeNvim(asyncio.get_running_loop(), args.rpc_latency / 1000)
+        nvim.init_nvim(fake_nvim)
+        settings = replace(settings_module.default_settings(args.history),
+                           new_change_delay=args.new_change_delay,
+                           max_changes=args.max_changes,
+                           codec=args.codec,
+                           backend=args.backend,
+                           track_renames=not args.no_track_renames)
+        worker = _Worker(args, index, file_paths, settings, fake_nvim)
+        asyncio.get_running_loop().set_exception_handler(worker.handle_exception)
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+        await worker.run(time.monotonic() + args.duration, operations)
+        # Tasks which are not referenced any more report their exception
+        gc.collect()
+        return worker
+
+    result: Dict[str, Any] = {'worker': index}
+    try:
+        worker = asyncio.run(_run())
+        result.update(latencies=worker.latencies, skipped=worker.skipped, errors=worker.errors,
+                      error_samples=worker.error_samples)
+    except Exception:
+        barrier.abort()
+        result.update(failure=traceback.format_exc())
+    result.update(logged=log_counter.counts, logged_samples=log_counter.samples, stats=profiler.get_stats())
+    results.put(result)
+
+
+def _get_disk_usage(folder: str) -> Tuple[int, int]:
+    size = files = 0
+    for root, _, file_names in os.walk(folder):
+        for file_name in file_names:
+            try:
+                size += os.stat(os.path.join(root, file_name)).st_size
+            except OSError:
+                # Removed by a worker in the meantime
+                continue
+            files += 1
+
+    return size, files
+
+
+def _get_latency_stats(latencies: Sequence[float]) -> Dict[str, float]:
+    if not latencies:
+        return {'count': 0}
+    latencies = sorted(latencies)
+
+    def percentile(q: float) -> float:
+        return round(latencies[max(0, math.ceil(q * len(latencies)) - 1)], 3)
+
+    return {
+        'count': len(latencies),
+        'avg_ms': round(sum(latencies) / len(latencies), 3),
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'p999_ms': percentile(0.999),
+        'max_ms': round(latencies[-1], 3),
+    }
+
+
+def _merge_timers(results: Sequence[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    # Percentiles of the profiler are approximated by buckets and can't be merged, the worst worker is reported
+    merged: Dict[str, Dict[str, float]] = {}
+    for result in results:
+        for name, timer in result['stats']['timers'].items():
+            stage = merged.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'worst_worker_p99_ms': 0.0})
+            stage['count'] += timer['count']
+            stage['total_ms'] = round(stage['total_ms'] + timer['total_ms'], 3)
+            stage['max_ms'] = max(stage['max_ms'], timer['max_ms'])
+            stage['worst_worker_p99_ms'] = max(stage['worst_worker_p99_ms'], timer['p99_ms'])
+    for stage in merged.values():
+        stage['avg_ms'] = round(stage['total_ms'] / stage['count'], 3) if stage['count'] else 0
+
+    return merged
+
+
+def _sum_counts(counts: Sequence[Dict[str, int]]) -> Dict[str, int]:
+    total: Dict[str, int] = {}
+    for item in counts:
+        for key, value in item.items():
+            total[key] = total.get(key, 0) + value
+
+    return total
+
+
+def _verify(settings: Any, jobs: int) -> Dict[str, int]:
+    histories = corrupt_histories = corrupt_records = 0
+    for result in scrub.scrub_local_histories(settings, [], False, jobs, 0):
+        histories += 1
+        if result.error or result.corrupt:
+            corrupt_histories += 1
+            corrupt_records += len(result.corrupt)
+
+    return {'histories': histories, 'corrupt_histories': corrupt_histories, 'corrupt_records': corrupt_records}
+
+
+def _report(args: argparse.Namespace, results: Sequence[Dict[str, Any]], duration: float,
+            samples: Sequence[Dict[str, Any]], verification: Dict[str, int]) -> Dict[str, Any]:
+    completed = [result for result in results if 'failure' not in result]
+    operations = {}
+    total = 0
+    for operation in _OPERATIONS:
+        latencies = [latency for result in completed for latency in result['latencies'][operation]]
+        total += len(latencies)
+        operations[operation] = dict(_get_latency_stats(latencies),
+                                     skipped=sum(result['skipped'][operation] for result in completed),
+                                     throughput_ops_s=round(len(latencies) / duration, 2))
+
+    stages = _merge_timers(results)
+    lock_wait = dict(stages.get('storage.lock_wait', {'count': 0, 'total_ms': 0.0}))
+    busy_ms = sum(latency for result in completed for latencies in result['latencies'].values()
+                  for latency in latencies)
+    lock_wait['share_of_operation_time'] = round(lock_wait['total_ms'] / busy_ms, 4) if busy_ms else 0
+    counters = _sum_counts([result['stats']['counters'] for result in results])
+    errors = _sum_counts([result['errors'] for result in completed])
+    saves = operations['save']['count']
+
+    return {
+        'config': vars(args),
+        'duration_s': round(duration, 3),
+        'operations': total,
+        'throughput_ops_s': round(total / duration, 2),
+        'by_operation': operations,
+        'lock_wait': lock_wait,
+        'errors': {
+            'total': sum(errors.values()),
+            'by_operation': errors,
+            'logged': _sum_counts([result['logged'] for result in results]),
+            'failed_workers': len(results) - len(completed),
+            'samples': [sample for result in results
+                        for sample in result.get('error_samples', []) + result['logged_samples'] +
+                        ([result['failure']] if 'failure' in result else [])][:_MAX_ERROR_SAMPLES],
+        },
+        'corruption': dict(verification, corrupt_records_read=counters.get('storage.corrupt_records', 0)),
+        'disk': {
+            'initial_bytes': samples[0]['bytes'],
+            'final_bytes': samples[-1]['bytes'],
+            'files': samples[-1]['files'],
+            'growth_bytes_s': round((samples[-1]['bytes'] - samples[0]['bytes']) / duration, 1),
+            'bytes_per_save': round((samples[-1]['bytes'] - samples[0]['bytes']) / saves, 1) if saves else 0,
+            'samples': samples,
+        },
+        'stages': stages,
+        'counters': counters,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Load test of a local history folder shared by many Neovim instances')
+    parser.add_argument('--workers', type=int, default=8, help='simulated Neovim instances (processes)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--operations', type=int, default=0, help='stop every worker after this many operations')
+    parser.add_argument('--mix', type=_parse_mix, default='save=85,toggle=10,delete=5',
+                        help='weights of the operations')
+    parser.add_argument('--files', type=int, default=50, help='files of the workspace shared by the workers')
+    parser.add_argument('--lines', type=int, default=300, help='initial lines of every file')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='the n-th file is edited 1/n^skew as often as the first one (0: uniform)')
+    parser.add_argument('--think-time', type=float, default=0,
+                        help='mean seconds between two operations of a worker (exponentially distributed)')
+    parser.add_argument('--rpc-latency', type=float, default=0.1, help='milliseconds of a round trip to Neovim')
+    parser.add_argument('--sample-interval', type=float, default=1.0, help='seconds between two disk usage samples')
+    parser.add_argument('--folder', help='folder of the workspace and of the local history (default: temporary)')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary folder')
+    parser.add_argument('--new-change-delay', type=int, default=0,
+                        help='g:local_history_new_change_delay (default: every save is a new revision)')
+    parser.add_argument('--max-changes', type=int, default=settings_module._DEFAULT_LOCAL_HISTORY_MAX_CHANGES)
+    parser.add_argument('--codec', default=settings_module._DEFAULT_LOCAL_HISTORY_CODEC)
+    parser.add_argument('--backend', default=settings_module._DEFAULT_LOCAL_HISTORY_BACKEND)
+    parser.add_argument('--no-track-renames', action='store_true')
+    parser.add_argument('--no-verify', action='store_true', help='skip the integrity check of the histories')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the result to (default: standard output)')
+    args = parser.parse_args()
+
+    folder = args.folder or tempfile.mkdtemp(prefix='local-history-loadtest-')
+    workspace = os.path.join(folder, 'workspace')
+    args.history = os.path.join(folder, 'history')
+    os.makedirs(workspace, exist_ok=True)
+    os.makedirs(args.history, exist_ok=True)
+    rand = random.Random(args.seed)
+    file_paths = []
+    for index in range(args.files):
+        file_path = os.path.join(workspace, 'file_%04d.py' % index)
+        if not os.path.exists(file_path):
+            _write_file(file_path, _make_content(args.lines, rand))
+        file_paths.append(file_path)
+    # Resolved once so that the workers inherit the warning about dbm.dumb
+    storage.get_dbm_backend(args.backend)
+
+    barrier = multiprocessing.Barrier(args.workers + 1)
+    operations = multiprocessing.Value('q', 0)
+    results_queue = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_run_worker,
+                                args=(args, index, file_paths, barrier, operations, results_queue),
+                                name='loadtest-worker-%d' % index) for index in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    size, files = _get_disk_usage(args.history)
+    samples = [{'elapsed_s': 0.0, 'operations': 0, 'bytes': size, 'files': files}]
+    try:
+        barrier.wait()
+    except BrokenBarrierError:
+        # A worker failed to start, its failure is reported
+        pass
+    start = time.monotonic()
+    results: List[Dict[str, Any]] = []
+    while len(results) < len(processes):
+        deadline = time.monotonic() + args.sample_interval
+        while len(results) < len(processes) and time.monotonic() < deadline:
+            try:
+                results.append(results_queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except Empty:
+                break
+        elapsed = time.monotonic() - start
+        size, files = _get_disk_usage(args.history)
+        samples.append({'elapsed_s': round(elapsed, 3), 'operations': operations.value, 'bytes': size,
+                        'files': files})
+    duration = time.monotonic() - start
+    for process in processes:
+        process.join()
+
+    settings = replace(settings_module.default_settings(args.history), backend=args.backend)
+    verification = {} if args.no_verify else _verify(settings, os.cpu_count() or 1)
+    report = _report(args, sorted(results, key=lambda result: result['worker']), duration, samples, verification)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+    if not args.folder and not args.keep:
+        shutil.rmtree(folder, ignore_errors=True)
+    errors = report['errors']
+    if errors['total'] or errors['failed_workers'] or errors['logged'].get('error') or verification.get(
+            'corrupt_histories'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import os
+import random
+import shelve
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from importlib import import_module
+from typing import Callable, Optional
+
+# Compares the pickled records written by older versions with the binary record format:
+#   PYTHONPATH=rplugin/python3 python3 benchmarks/record_format.py --records 2000
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rplugin', 'python3'))
+storage = import_module('local-history.storage')
+utils = import_module('local-history.utils')
+similarity = import_module('local-history.similarity')
+
+
+@dataclass(frozen=False)
+class LocalHistoryRecord:
+    # Same fields as the pickled records, only the module of the class differs
+    record_id: int
+    timestamp: float
+    content: bytes
+    previous_record_id: int
+    next_record_id: int
+    unsaved: bool = False
+    codec: str = utils.DEFAULT_CODEC
+    checksum: Optional[int] = None
+    first_timestamp: Optional[float] = None
+    sketch: bytes = b''
+    sketch_rate: int = 1
+    added: Optional[int] = None
+    removed: Optional[int] = None
+    size: Optional[int] = None
+
+
+def _make_contents(records: int, lines: int) -> list:
+    random.seed(0)
+    words = ['local', 'history', 'record', 'buffer', 'window', 'return', 'self', 'def', 'import', 'None']
+    content = [' '.join(random.choice(words) for _ in range(8)) for _ in range(lines)]
+    contents = []
+    for _ in range(records):
+        content[random.randrange(lines)] = ' '.join(random.choice(words) for _ in range(8))
+        contents.append('\n'.join(content) + '\n')
+
+    return contents
+
+
+def _make_records(contents: list) -> list:
+    records = []
+    for index, content in enumerate(contents, 1):
+        next_record_id = index + 1 if index < len(contents) else 0
+        record = storage.LocalHistoryRecord(index, time.time(), b'', index - 1, next_record_id)
+        record.set_content(utils.compress(content), utils.DEFAULT_CODEC)
+        record.sketch_rate, record.sketch = similarity.get_line_sketch(similarity.get_line_hashes(content))
+        record.added, record.removed, record.size = 1, 1, len(content)
+        records.append(record)
+
+    return records
+
+
+def _to_legacy(record) -> LocalHistoryRecord:
+    return LocalHistoryRecord(record.record_id, record.timestamp, record.content, record.previous_record_id,
+                              record.next_record_id, record.unsaved, record.codec, record.checksum,
+                              record.first_timestamp, record.sketch, record.sketch_rate, record.added, record.removed,
+                              record.size)
+
+
+def _measure(name: str, walk: Callable[[], int], repeat: int) -> None:
+    walk()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        count = walk()
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    walk()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('%-34s %8.2f us/record %10d bytes peak' % (name, elapsed / count * 1e6, peak))
+
+
+def _get_disk_size(folder: str, name: str) -> int:
+    return sum(os.path.getsize(os.path.join(folder, file_name))
+               for file_name in os.listdir(folder)
+               if file_name.startswith(name))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark of the record format')
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--lines', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=5)
+    # dbm.dumb pads every value to 512 bytes, which costs the binary format (two values per record) up to one block
+    parser.add_argument('--backend', default='dbm.dumb', help='dbm implementation used to compare the file sizes')
+    args = parser.parse_args()
+
+    records = _make_records(_make_contents(args.records, args.lines))
+    keys = [str(record.record_id) for record in records]
+
+    legacy = shelve.Shelf({})
+    packed = storage.LocalHistoryFile({})
+    for key, record in zip(keys, records):
+        legacy[key] = _to_legacy(record)
+        packed[key] = record
+
+    legacy_size = sum(len(legacy.dict[key.encode()]) for key in keys)
+    packed_size = sum(len(packed.dict[key.encode()]) for key in keys)
+    content_size = sum(len(value) for key, value in packed.dict.items() if key.startswith(b'c'))
+    print('%d records of %d lines, %d bytes of compressed content per record' %
+          (args.records, args.lines, content_size // args.records))
+    print('%-34s %8.1f bytes/record' % ('pickle (record and content)', legacy_size / args.records))
+    print('%-34s %8.1f bytes/record' % ('binary (record)', packed_size / args.records))
+    print('%-34s %8.1f bytes/record' % ('binary (record and content)', (packed_size + content_size) / args.records))
+
+    def walk_legacy() -> int:
+        return sum(1 for key in keys if legacy[key].record_id)
+
+    def walk_packed_metadata() -> int:
+        return sum(1 for key in keys if packed.get_value(key, False).record_id)
+
+    def walk_packed() -> int:
+        return sum(1 for key in keys if packed.get_value(key, True).record_id)
+
+    _measure('pickle decode', walk_legacy, args.repeat)
+    _measure('binary decode (metadata)', walk_packed_metadata, args.repeat)
+    _measure('binary decode (with content)', walk_packed, args.repeat)
+
+    with tempfile.TemporaryDirectory() as folder:
+        for name, shelf_class in (('legacy', shelve.Shelf), ('packed', storage.LocalHistoryFile)):
+            shelf = shelf_class(import_module(args.backend).open(os.path.join(folder, name), 'n'))
+            for key, record in zip(keys, records):
+                shelf[key] = _to_legacy(record) if name == 'legacy' else record
+            # Links of the previous record are updated on every save
+            for key, record in zip(keys, records):
+                shelf[key] = _to_legacy(record) if name == 'legacy' else record
+            shelf.close()
+        for name, label in (('legacy', 'pickle'), ('packed', 'binary')):
+            print('%-34s %8.1f bytes/record' % ('%s file, %s' % (args.backend, label),
+                                                 _get_disk_size(folder, name) / args.records))
+
+
+if __name__ == '__main__':
+    main()
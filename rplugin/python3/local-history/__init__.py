@@ -1,14 +1,21 @@
 import os
-from pynvim import Nvim, plugin, command, autocmd, function
+from pynvim import Nvim, plugin, command, autocmd, function, rpc_export
 from asyncio import AbstractEventLoop, Lock, run_coroutine_threadsafe
 from typing import Any, Awaitable, Callable, Optional, Sequence
 
-from .nvim import init_nvim, get_global_var
+from functools import partial
+
+from .nvim import init_nvim, get_global_var, async_call, echo
 from .logging import log, init_log
 from .settings import load_settings
 from .executor_service import ExecutorService
+from .profiler import start_capture, stop_capture, write_capture
+from .snapshot import SnapshotScheduler
+from .utils import run_in_executor
 from .local_history import (
     local_history_save,
+    local_history_snapshot,
+    local_history_track_unsaved,
     local_history_toggle,
     local_history_quit,
     local_history_move,
@@ -17,6 +24,17 @@ from .local_history import (
     local_history_preview_resize,
     local_history_delete,
     local_history_diff,
+    local_history_mark,
+    local_history_buffer_lines_event,
+    local_history_buffer_changedtick_event,
+    local_history_buffer_detach_event,
+    local_history_window_closed_event,
+    local_history_wait_for_load,
+    local_history_stats,
+    local_history_profile,
+    local_history_verify,
+    local_history_restore_at,
+    local_history_watch,
     MoveDirection,
 )
 
@@ -31,6 +49,9 @@ class LocalHistoryPlugin(object):
         init_nvim(self._nvim)
         init_log(self._nvim)
         self._settings = None
+        self._snapshot_scheduler = SnapshotScheduler(
+            self._nvim.loop, lambda buffer_number: self._run(local_history_snapshot, self._snapshot_scheduler,
+                                                             buffer_number))
         local_history_workspace = get_global_var('local_history_workspace', os.getcwd())
         os.chdir(local_history_workspace)
 
@@ -53,18 +74,72 @@ class LocalHistoryPlugin(object):
             async with self._lock:
                 if self._settings is None:
                     self._settings = await load_settings()
-                await func(self._settings, *args)
+                capturing = start_capture()
+                try:
+                    await func(self._settings, *args)
+                    if capturing:
+                        # The tree is loaded in the background after the toggle returns
+                        await local_history_wait_for_load()
+                finally:
+                    if capturing:
+                        lines = await run_in_executor(partial(write_capture, stop_capture(), func.__name__))
+                        if lines is not None:
+                            await async_call(partial(echo, lines))
 
         self._submit(run())
 
+    @autocmd('VimEnter', pattern='*')
+    def on_vim_enter(self) -> None:
+        self._run(local_history_watch)
+
     @autocmd('BufWritePost', pattern='*', eval='expand(\'%:p\')')
     def on_buffer_write_post(self, file_path: str) -> None:
         self._run(local_history_save, file_path)
 
+    @autocmd('CursorHold,CursorHoldI,InsertLeave', pattern='*', eval='[bufnr(), b:changedtick, &modified]')
+    def on_buffer_idle(self, buffer_info: Sequence[Any]) -> None:
+        self._run(local_history_track_unsaved, self._snapshot_scheduler, buffer_info)
+
+    @autocmd('BufWipeout', pattern='*', eval='str2nr(expand(\'<abuf>\'))')
+    def on_buffer_wipeout(self, buffer_number: int) -> None:
+        self._snapshot_scheduler.forget(buffer_number)
+
+    @autocmd('WinClosed', pattern='*', eval='getbufvar(winbufnr(str2nr(expand(\'<amatch>\'))), \'&filetype\')')
+    def on_window_closed(self, file_type: str) -> None:
+        local_history_window_closed_event(file_type)
+
+    @rpc_export('LocalHistory_buffer_lines_event')
+    def on_buffer_lines_event(self, *args: Any) -> None:
+        local_history_buffer_lines_event(*args)
+
+    @rpc_export('LocalHistory_buffer_changedtick_event')
+    def on_buffer_changedtick_event(self, *args: Any) -> None:
+        local_history_buffer_changedtick_event(*args)
+
+    @rpc_export('LocalHistory_buffer_detach_event')
+    def on_buffer_detach_event(self, *args: Any) -> None:
+        local_history_buffer_detach_event(*args)
+
     @command('LocalHistoryToggle')
     def local_history_toggle_command(self) -> None:
         self._run(local_history_toggle)
 
+    @command('LocalHistoryStats', bang=True)
+    def local_history_stats_command(self, bang: bool) -> None:
+        self._run(local_history_stats, bang)
+
+    @command('LocalHistoryProfile', nargs='?', complete='file')
+    def local_history_profile_command(self, args: Sequence[Any]) -> None:
+        self._run(local_history_profile, args[0] if args else '')
+
+    @command('LocalHistoryVerify', bang=True)
+    def local_history_verify_command(self, bang: bool) -> None:
+        self._run(local_history_verify, bang)
+
+    @command('LocalHistoryRestoreAt', nargs='+', bang=True)
+    def local_history_restore_at_command(self, args: Sequence[Any], bang: bool) -> None:
+        self._run(local_history_restore_at, ' '.join(args), bang)
+
     @function('LocalHistory_quit')
     def quit(self, args: Sequence[Any]) -> None:
         self._run(local_history_quit)
@@ -112,3 +187,7 @@ class LocalHistoryPlugin(object):
     @function('LocalHistory_diff')
     def diff(self, args: Sequence[Any]) -> None:
         self._run(local_history_diff)
+
+    @function('LocalHistory_mark')
+    def mark(self, args: Sequence[Any]) -> None:
+        self._run(local_history_mark)
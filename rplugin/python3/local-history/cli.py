@@ -0,0 +1,407 @@
+import argparse
+import difflib
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from .settings import Settings, default_settings
+from .storage import (
+    LocalHistoryStorage,
+    LocalHistoryRecord,
+    find_local_history_names,
+    get_dbm_backend,
+    is_dbm_backend_available,
+)
+from .migration import MigrationResult, migrate_local_history
+from .scrub import scrub_local_histories
+from .git_export import export_to_git
+from .restore import restore_local_histories
+from .utils import get_file_content, parallel_map, parse_timestamp, CODECS, DEFAULT_CODEC
+
+_DEFAULT_LOCAL_HISTORY_PATH = os.environ.get('LOCAL_HISTORY_PATH', '.local-history')
+
+_TIME_FMT = '%Y-%m-%d %H:%M:%S'
+
+
+class CommandError(Exception):
+    pass
+
+
+def _format_time(timestamp: float) -> str:
+    return time.strftime(_TIME_FMT, time.localtime(timestamp))
+
+
+def _get_storage(settings: Settings, file_path: str) -> LocalHistoryStorage:
+    local_history_storage = LocalHistoryStorage(settings, os.path.abspath(file_path))
+    if not local_history_storage.exists():
+        raise CommandError('No local history for %s' % file_path)
+
+    return local_history_storage
+
+
+def _get_records(local_history_storage: LocalHistoryStorage, with_content: bool = True) -> List[LocalHistoryRecord]:
+    records = list(local_history_storage.get_records(with_content))
+    if not records:
+        raise CommandError('Local history is empty')
+
+    return records
+
+
+def _get_record(records: List[LocalHistoryRecord], revision: Optional[int]) -> LocalHistoryRecord:
+    # Revisions are numbered like in the local history tree: 1 is the oldest one
+    if revision is None:
+        return records[-1]
+    if revision < 1 or revision > len(records):
+        raise CommandError('Revision %d does not exist (1-%d)' % (revision, len(records)))
+
+    return records[revision - 1]
+
+
+def _get_storages(settings: Settings, file_paths: Sequence[str]) -> List[Tuple[Settings, str]]:
+    if file_paths:
+        return [(settings, _get_storage(settings, file_path).local_history_name) for file_path in file_paths]
+
+    return [(settings, name) for name in find_local_history_names(settings)]
+
+
+def _collect_history_info(item: Tuple[Settings, str]) -> Dict[str, Any]:
+    settings, name = item
+    local_history_storage = LocalHistoryStorage(settings, '', name)
+    header = local_history_storage.get_header()
+    records = list(local_history_storage.get_records(with_content=False))
+
+    return {
+        'name': name,
+        'file_path': header.file_path if header is not None else '',
+        'revisions': len(records),
+        'first_timestamp': records[0].timestamp if records else None,
+        'last_timestamp': records[-1].timestamp if records else None,
+    }
+
+
+def _collect_history_stats(item: Tuple[Settings, str]) -> Dict[str, Any]:
+    info = _collect_history_info(item)
+    settings, name = item
+    local_history_storage = LocalHistoryStorage(settings, '', name)
+    compressed_size = 0
+    size = 0
+    for record, content in local_history_storage.get_contents():
+        compressed_size += record.compressed_size
+        size += len(content.encode('utf-8')) if content is not None else 0
+    info['compressed_size'] = compressed_size
+    info['size'] = size
+    info['backend'] = local_history_storage.get_backend()
+
+    return info
+
+
+def _export_history(item: Tuple[Settings, str, str, Optional[float], bool]) -> Tuple[str, int]:
+    settings, name, destination, before, all_revisions = item
+    local_history_storage = LocalHistoryStorage(settings, '', name)
+    header = local_history_storage.get_header()
+    file_path = header.file_path if header is not None and header.file_path else os.path.join('_unknown', name)
+    target_path = os.path.join(destination, os.path.splitdrive(file_path)[1].lstrip(os.sep))
+
+    records = [record for record in local_history_storage.get_records() if before is None or record.timestamp <= before]
+    if not all_revisions:
+        records = records[-1:]
+    if not records:
+        return file_path, 0
+
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    for index, (record, content) in enumerate(local_history_storage.get_contents(records), 1):
+        if content is None:
+            continue
+        output_path = '%s.~%d~' % (target_path, index) if all_revisions else target_path
+        with open(output_path, 'w') as file:
+            file.write(content)
+        os.utime(output_path, (record.timestamp, record.timestamp))
+
+    return file_path, len(records)
+
+
+def _migrate_history(item: Tuple[Settings, str, str, str, bool]) -> MigrationResult:
+    return migrate_local_history(*item)
+
+
+def _list(settings: Settings, args: argparse.Namespace) -> None:
+    if args.file is not None:
+        records = _get_records(_get_storage(settings, args.file), with_content=False)
+        for index in range(len(records), 0, -1):
+            record = records[index - 1]
+            print('[%d] %s %8d%s' % (index, _format_time(record.timestamp), record.compressed_size,
+                                     ' (unsaved)' if record.unsaved else ''))
+        return
+
+    for info in parallel_map(_collect_history_info, _get_storages(settings, []), args.jobs):
+        last_timestamp = '-' if info['last_timestamp'] is None else _format_time(info['last_timestamp'])
+        print('%s %4d  %s' % (last_timestamp, info['revisions'], info['file_path'] or info['name']))
+
+
+def _show(settings: Settings, args: argparse.Namespace) -> None:
+    record = _get_record(_get_records(_get_storage(settings, args.file)), args.revision)
+    sys.stdout.write(record.get_content())
+
+
+def _diff(settings: Settings, args: argparse.Namespace) -> None:
+    records = _get_records(_get_storage(settings, args.file))
+    revisions = args.revision or [None]
+    if len(revisions) > 2:
+        raise CommandError('At most two revisions can be compared')
+
+    if len(revisions) == 1:
+        # A deleted file is compared as an empty one, like the restore does
+        from_file, from_content = 'current', ''
+        if os.path.exists(args.file):
+            try:
+                from_content = get_file_content(args.file)
+            except OSError as e:
+                raise CommandError('Cannot read %s: %s' % (args.file, e.strerror or e))
+    else:
+        from_file, from_content = ('revision %d' % revisions[0], _get_record(records, revisions[0]).get_content())
+    # From the file, or the first revision, to the last revision given
+    to_revision = revisions[-1]
+    to_file = 'revision %d' % (to_revision if to_revision is not None else len(records))
+    to_content = _get_record(records, to_revision).get_content()
+
+    sys.stdout.writelines(
+        difflib.unified_diff(from_content.splitlines(True),
+                             to_content.splitlines(True),
+                             fromfile=from_file,
+                             tofile=to_file))
+
+
+def _restore(settings: Settings, args: argparse.Namespace) -> None:
+    record = _get_record(_get_records(_get_storage(settings, args.file)), args.revision)
+    output_path = args.output or args.file
+    with open(output_path, 'w') as file:
+        file.write(record.get_content())
+    print('Restored %s from %s' % (output_path, _format_time(record.timestamp)))
+
+
+def _restore_at(settings: Settings, args: argparse.Namespace) -> None:
+    totals = {'restored': 0, 'changed': 0, 'unchanged': 0, 'missing': 0, 'failed': 0}
+    for result in restore_local_histories(settings, args.time, os.path.abspath(args.root), args.apply, [], args.jobs):
+        if result.status not in totals:
+            continue
+        totals[result.status] += 1
+        if result.status == 'failed':
+            print('failed    %s: %s' % (result.file_path, result.error), file=sys.stderr)
+        elif result.status in ('restored', 'changed'):
+            print('%-9s %s +%d -%d  %s' % (result.status, _format_time(result.timestamp), result.added, result.removed,
+                                            result.file_path),
+                  flush=True)
+
+    print('%d files %s, %d unchanged, %d without revision before %s' %
+          (totals['restored'] if args.apply else totals['changed'], 'restored' if args.apply else 'differ',
+           totals['unchanged'], totals['missing'], _format_time(args.time)))
+    if totals['failed']:
+        raise CommandError('%d files could not be restored' % totals['failed'])
+
+
+def _export(settings: Settings, args: argparse.Namespace) -> None:
+    items = [(settings, name, os.path.abspath(args.destination), args.before, args.all_revisions)
+             for _, name in _get_storages(settings, args.files)]
+    exported = 0
+    for file_path, count in parallel_map(_export_history, items, args.jobs):
+        if count > 0:
+            exported += count
+            print('%4d  %s' % (count, file_path))
+    print('Exported %d revisions to %s' % (exported, args.destination))
+
+
+def _stats(settings: Settings, args: argparse.Namespace) -> None:
+    totals = {'histories': 0, 'revisions': 0, 'compressed_size': 0, 'size': 0}
+    backends: Dict[str, int] = {}
+    for info in parallel_map(_collect_history_stats, _get_storages(settings, args.files), args.jobs):
+        totals['histories'] += 1
+        for key in ('revisions', 'compressed_size', 'size'):
+            totals[key] += info[key]
+        backends[info['backend']] = backends.get(info['backend'], 0) + 1
+        if args.json:
+            print(json.dumps(info), flush=True)
+        else:
+            print('%4d %10d %10d  %s' % (info['revisions'], info['size'], info['compressed_size'], info['file_path'] or
+                                         info['name']))
+
+    new_backend = get_dbm_backend(settings.backend)
+    if args.json:
+        print(json.dumps(dict(totals, name='total', backends=backends, new_backend=new_backend)))
+    else:
+        print('%d histories, %d revisions, %d bytes (%d bytes compressed)' %
+              (totals['histories'], totals['revisions'], totals['size'], totals['compressed_size']))
+        print('dbm backends: %s (new histories: %s)' %
+              (', '.join('%s %d' % (backend or 'unknown', histories) for backend, histories in sorted(backends.items()))
+               or '-', new_backend))
+
+
+def _migrate(settings: Settings, args: argparse.Namespace) -> None:
+    if args.backend and not is_dbm_backend_available(args.backend):
+        raise CommandError('dbm implementation %s is not available' % args.backend)
+    items = [(settings, name, args.codec, args.backend, not args.no_verify)
+             for _, name in _get_storages(settings, args.files)]
+    start = time.perf_counter()
+    totals = {'migrated': 0, 'skipped': 0, 'failed': 0}
+    records = content_size = size_before = size_after = 0
+    for result in parallel_map(_migrate_history, items, args.jobs):
+        totals[result.status] += 1
+        records += result.records
+        content_size += result.content_size
+        size_before += result.size_before
+        size_after += result.size_after
+        if result.status == 'failed':
+            print('failed    %s: %s' % (result.name, result.error), file=sys.stderr)
+        elif result.status == 'migrated' or args.verbose:
+            print('%-9s %s %d records, %d -> %d bytes, %.1f ms' %
+                  (result.status, result.name, result.records, result.size_before, result.size_after,
+                   result.duration * 1000))
+
+    duration = max(time.perf_counter() - start, 1e-6)
+    print('%d migrated, %d skipped, %d failed in %.1f s (%.1f histories/s, %.1f MB/s of content)' %
+          (totals['migrated'], totals['skipped'], totals['failed'], duration, len(items) / duration,
+           content_size / duration / 1024 / 1024))
+    print('Size on disk: %d -> %d bytes (%d bytes saved)' % (size_before, size_after, size_before - size_after))
+    if totals['failed']:
+        raise CommandError('%d histories could not be migrated' % totals['failed'])
+
+
+def _verify(settings: Settings, args: argparse.Namespace) -> None:
+    names = [name for _, name in _get_storages(settings, args.files)] if args.files else []
+    histories = corrupt_histories = corrupt_records = quarantined = 0
+    for result in scrub_local_histories(settings, names, args.quarantine, args.jobs, args.throttle):
+        histories += 1
+        if result.error:
+            corrupt_histories += 1
+            print('%s: %s' % (result.name, result.error))
+            continue
+        if result.corrupt:
+            corrupt_histories += 1
+            corrupt_records += len(result.corrupt)
+            quarantined += result.quarantined
+            for key, reason in result.corrupt:
+                print('%s %s record %s: %s' % (result.name, result.file_path, key, reason), flush=True)
+
+    print('%d histories verified, %d corrupt histories, %d problems, %d records quarantined' %
+          (histories, corrupt_histories, corrupt_records, quarantined))
+    if corrupt_histories and not args.quarantine:
+        raise CommandError('Corrupt histories found, run again with --quarantine to repair them')
+
+
+def _git_export(settings: Settings, args: argparse.Namespace) -> None:
+    names = [name for _, name in _get_storages(settings, args.files)] if args.files else []
+    start = time.perf_counter()
+    result = export_to_git(settings, names, os.path.abspath(args.repository), os.path.abspath(args.root),
+                           args.branch, args.jobs)
+    print('Exported %d revisions (%d distinct blobs, %d bytes) of %d histories to branch %s of %s in %.1f s' %
+          (result.revisions, result.blobs, result.size, result.histories, args.branch, args.repository,
+           time.perf_counter() - start))
+
+
+def _create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='local-history', description='Access local history outside of Neovim')
+    parser.add_argument('-p',
+                        '--path',
+                        default=_DEFAULT_LOCAL_HISTORY_PATH,
+                        help='local history folder (default: $LOCAL_HISTORY_PATH or .local-history)')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='number of worker processes for bulk operations')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    list_parser = commands.add_parser('list', help='list histories, or the revisions of a file')
+    list_parser.add_argument('file', nargs='?')
+    list_parser.set_defaults(func=_list)
+
+    show_parser = commands.add_parser('show', help='print a revision of a file')
+    show_parser.add_argument('file')
+    show_parser.add_argument('-r', '--revision', type=int, help='revision number (default: latest)')
+    show_parser.set_defaults(func=_show)
+
+    diff_parser = commands.add_parser('diff', help='diff a revision against the file, or two revisions')
+    diff_parser.add_argument('file')
+    diff_parser.add_argument('-r', '--revision', type=int, action='append', help='revision number, can be repeated')
+    diff_parser.set_defaults(func=_diff)
+
+    restore_parser = commands.add_parser('restore', help='restore a revision of a file')
+    restore_parser.add_argument('file')
+    restore_parser.add_argument('-r', '--revision', type=int, help='revision number (default: latest)')
+    restore_parser.add_argument('-o', '--output', help='write the revision to this path instead')
+    restore_parser.set_defaults(func=_restore)
+
+    restore_at_parser = commands.add_parser('restore-at',
+                                            help='show or restore the files of a folder as they were at a time')
+    restore_at_parser.add_argument('time', type=parse_timestamp, help='e.g. "2020-08-30 14:05", 1598796300 or 2h')
+    restore_at_parser.add_argument('--root', default=os.getcwd(), help='only files in this folder (default: .)')
+    restore_at_parser.add_argument('--apply', action='store_true', help='restore the files instead of listing them')
+    restore_at_parser.set_defaults(func=_restore_at)
+
+    export_parser = commands.add_parser('export', help='export the latest revisions into a folder')
+    export_parser.add_argument('destination')
+    export_parser.add_argument('files', nargs='*')
+    export_parser.add_argument('--before', type=parse_timestamp, help='only revisions saved before this time')
+    export_parser.add_argument('--all-revisions',
+                               action='store_true',
+                               help='export every revision as <file>.~<revision>~')
+    export_parser.set_defaults(func=_export)
+
+    stats_parser = commands.add_parser('stats', help='show size statistics of histories')
+    stats_parser.add_argument('files', nargs='*')
+    stats_parser.add_argument('--json', action='store_true', help='print JSON lines')
+    stats_parser.set_defaults(func=_stats)
+
+    migrate_parser = commands.add_parser('migrate', help='convert histories to another codec or dbm backend')
+    migrate_parser.add_argument('files', nargs='*')
+    migrate_parser.add_argument('--codec', choices=CODECS, default=DEFAULT_CODEC, help='compression of the records')
+    migrate_parser.add_argument('--backend',
+                                default='',
+                                help='dbm implementation, e.g. dbm.gnu (default: keep the current one)')
+    migrate_parser.add_argument('--no-verify',
+                                action='store_true',
+                                help='do not compare the content of converted histories')
+    migrate_parser.add_argument('-v', '--verbose', action='store_true', help='also report skipped histories')
+    migrate_parser.set_defaults(func=_migrate)
+
+    git_export_parser = commands.add_parser('git-export', help='export histories into a git repository')
+    git_export_parser.add_argument('repository', help='git repository, created if needed')
+    git_export_parser.add_argument('files', nargs='*')
+    git_export_parser.add_argument('--root',
+                                   default=os.getcwd(),
+                                   help='paths in the repository are relative to this folder (default: .)')
+    git_export_parser.add_argument('--branch',
+                                   default='local-history',
+                                   help='branch to write, replaced if it exists (default: local-history)')
+    git_export_parser.set_defaults(func=_git_export)
+
+    verify_parser = commands.add_parser('verify', help='check the integrity of histories')
+    verify_parser.add_argument('files', nargs='*')
+    verify_parser.add_argument('--quarantine',
+                               action='store_true',
+                               help='move corrupt records out of the histories and repair the links')
+    verify_parser.add_argument('--throttle',
+                               type=float,
+                               default=0,
+                               help='pause in seconds between two histories, also lowers the workers priority')
+    verify_parser.set_defaults(func=_verify)
+
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    args = _create_parser().parse_args(argv)
+    settings = default_settings(args.path)
+    # Resolved (and reported if it falls back to dbm.dumb) once, before the workers of bulk commands are started
+    get_dbm_backend(settings.backend)
+    try:
+        args.func(settings, args)
+    except CommandError as e:
+        print('local-history: %s' % str(e), file=sys.stderr)
+        return 1
+    except BrokenPipeError:
+        # Output piped into head, less, ...
+        sys.stderr.close()
+
+    return 0
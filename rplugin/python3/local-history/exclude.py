@@ -0,0 +1,276 @@
+import fnmatch
+import os
+import re
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Pattern, Sequence, Tuple
+from .settings import Settings
+
+# Read in this order in every folder of the workspace, the rules of the last file win
+_IGNORE_FILE_NAMES = ('.gitignore', '.ignore')
+
+_NEVER_MATCH = re.compile(r'(?!)')
+
+_MAGIC_CHARACTERS = re.compile(r'[*?\[]')
+
+# Decisions of the exclude patterns kept by path
+_MAX_CACHED_DECISIONS = 4096
+
+# Folders whose ignore decisions are kept
+_MAX_CACHED_FOLDERS = 1024
+
+# The ignore files of a folder and of its parents are checked for changes at most once per interval (in seconds),
+# saving an ignore file from Neovim checks them again right away
+_IGNORE_FILES_CHECK_INTERVAL = 2
+
+_matchers: Dict[Tuple[Tuple[str, ...], str, bool], 'ExcludeMatcher'] = {}
+
+_matchers_lock = Lock()
+
+
+class ExcludePatterns:
+    # Same matches as fnmatch.fnmatch over every pattern. Patterns which are a literal with leading and/or trailing
+    # stars (e.g. '*.txt', '**/node_modules/**') are string tests, the other ones are merged in a single regex.
+
+    def __init__(self, patterns: Sequence[str]) -> None:
+        self._paths = set()
+        prefixes = []
+        suffixes = []
+        self._infixes = []
+        regexes = []
+        for pattern in patterns:
+            pattern = os.path.normcase(pattern)
+            literal = pattern.strip('*')
+            if _MAGIC_CHARACTERS.search(literal):
+                regexes.append('(?:%s)' % fnmatch.translate(pattern))
+            elif pattern.startswith('*') and pattern.endswith('*') and literal:
+                self._infixes.append(literal)
+            elif pattern.startswith('*'):
+                suffixes.append(literal)
+            elif pattern.endswith('*'):
+                prefixes.append(literal)
+            else:
+                self._paths.add(literal)
+        self._prefixes = tuple(prefixes)
+        self._suffixes = tuple(suffixes)
+        self._regex = re.compile('|'.join(regexes)) if regexes else _NEVER_MATCH
+
+    def match(self, file_path: str) -> bool:
+        file_path = os.path.normcase(file_path)
+        return (file_path in self._paths or file_path.startswith(self._prefixes) or
+                file_path.endswith(self._suffixes) or any(infix in file_path for infix in self._infixes) or
+                self._regex.match(file_path) is not None)
+
+
+def _translate_glob(glob: str) -> str:
+    regex = ''
+    index = 0
+    while index < len(glob):
+        char = glob[index]
+        if glob.startswith('**/', index):
+            regex += '(?:.*/)?'
+            index += 3
+            continue
+        if glob.startswith('**', index):
+            regex += '.*'
+            index += 2
+            continue
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            end = glob.find(']', index + 1)
+            if end < 0:
+                regex += re.escape(char)
+            else:
+                content = glob[index + 1:end].replace('\\', '\\\\')
+                if content.startswith('!'):
+                    content = '^' + content[1:]
+                regex += '[%s]' % content
+                index = end
+        elif char == '\\' and index + 1 < len(glob):
+            index += 1
+            regex += re.escape(glob[index])
+        else:
+            regex += re.escape(char)
+        index += 1
+
+    return regex
+
+
+class IgnoreRules:
+    # Rules of a .gitignore file, matched against paths relative to its folder
+
+    def __init__(self, lines: Sequence[str]) -> None:
+        self._rules: List[Tuple[Pattern, bool, bool]] = []
+        regexes = []
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line.endswith('\\ '):
+                line = line.rstrip(' ')
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            elif line.startswith('\\!') or line.startswith('\\#'):
+                line = line[1:]
+            directory_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            # A slash at the beginning or in the middle anchors the pattern to the folder of the ignore file
+            anchored = '/' in line
+            regex = ('' if anchored else '(?:.*/)?') + _translate_glob(line.lstrip('/')) + r'\Z'
+            self._rules.append((re.compile(regex), negated, directory_only))
+            regexes.append('(?:%s)' % regex)
+        self._any_rule = re.compile('|'.join(regexes)) if regexes else _NEVER_MATCH
+
+    def match(self, relative_path: str, is_directory: bool) -> Optional[bool]:
+        # True if ignored, False if re-included and None if no rule matches
+        if not self._any_rule.match(relative_path):
+            return None
+        for regex, negated, directory_only in reversed(self._rules):
+            if directory_only and not is_directory:
+                continue
+            if regex.match(relative_path):
+                return not negated
+
+        return None
+
+
+class ExcludeMatcher:
+
+    def __init__(self, patterns: Sequence[str], root: str, use_ignore_files: bool) -> None:
+        self._patterns = ExcludePatterns(patterns)
+        self._decisions: Dict[str, bool] = {}
+        self._root = root.rstrip(os.sep)
+        self._use_ignore_files = use_ignore_files
+        self._lock = Lock()
+        # Ignore rules and modification time of every ignore file, keyed by path
+        self._ignore_files: Dict[str, Tuple[Optional[float], Optional[IgnoreRules]]] = {}
+        # Whether every file of a folder is ignored, cleared when an ignore file changes
+        self._folders: Dict[str, bool] = {}
+        # Whether the files of a folder are ignored by file name, cleared when an ignore file changes
+        self._files: Dict[str, Dict[str, bool]] = {}
+        # Last check of the ignore files of a folder and of its parents
+        self._checked: Dict[str, float] = {}
+
+    def is_excluded(self, file_path: str) -> bool:
+        excluded = self._decisions.get(file_path)
+        if excluded is None:
+            if len(self._decisions) >= _MAX_CACHED_DECISIONS:
+                self._decisions.clear()
+            excluded = self._decisions[file_path] = self._patterns.match(file_path)
+        if excluded:
+            return True
+        if not self._use_ignore_files or not file_path.startswith(self._root + os.sep):
+            return False
+
+        folder, file_name = os.path.split(file_path)
+        with self._lock:
+            if file_name in _IGNORE_FILE_NAMES:
+                self._checked.clear()
+            files = self._get_folder_files(folder)
+            ignored = files.get(file_name)
+            if ignored is None:
+                folders = self._get_folders(folder)
+                ignored = files[file_name] = (self._is_folder_ignored(folders, len(folders) - 1) or
+                                              bool(self._match(folders, file_path, False)))
+
+            return ignored
+
+    def is_folder_excluded(self, folder: str) -> bool:
+        # Whether the patterns or the ignore files exclude every file of the folder
+        if self._patterns.match(folder + os.sep):
+            return True
+        if not self._use_ignore_files or not folder.startswith(self._root + os.sep):
+            return False
+
+        with self._lock:
+            self._get_folder_files(folder)
+            folders = self._get_folders(folder)
+            return self._is_folder_ignored(folders, len(folders) - 1)
+
+    def _get_folder_files(self, folder: str) -> Dict[str, bool]:
+        # Decisions of the files of the folder, valid until the next check of the ignore files
+        now = time.monotonic()
+        checked = self._checked.get(folder)
+        if checked is None or now - checked >= _IGNORE_FILES_CHECK_INTERVAL:
+            if self._refresh_ignore_files(self._get_folders(folder)):
+                self._folders.clear()
+                self._files.clear()
+            if len(self._checked) >= _MAX_CACHED_FOLDERS:
+                self._checked.clear()
+                self._files.clear()
+            self._checked[folder] = now
+
+        return self._files.setdefault(folder, {})
+
+    def _get_folders(self, folder: str) -> List[str]:
+        # Folders from the root of the workspace to the folder
+        folders = [folder]
+        while folder != self._root and len(folder) > len(self._root):
+            folder = os.path.dirname(folder)
+            folders.append(folder)
+        folders.reverse()
+
+        return folders
+
+    def _refresh_ignore_files(self, folders: Sequence[str]) -> bool:
+        changed = False
+        for folder in folders:
+            for ignore_file_name in _IGNORE_FILE_NAMES:
+                ignore_file_path = os.path.join(folder, ignore_file_name)
+                try:
+                    mtime = os.stat(ignore_file_path).st_mtime
+                except OSError:
+                    mtime = None
+                cached = self._ignore_files.get(ignore_file_path)
+                if cached is not None and cached[0] == mtime:
+                    continue
+                rules = None
+                if mtime is not None:
+                    with open(ignore_file_path, 'r', encoding='utf-8', errors='replace') as file:
+                        rules = IgnoreRules(file.readlines())
+                self._ignore_files[ignore_file_path] = (mtime, rules)
+                changed = changed or cached is not None or rules is not None
+
+        return changed
+
+    def _match(self, folders: Sequence[str], path: str, is_directory: bool) -> Optional[bool]:
+        # The rules of the deepest ignore file win
+        for folder in reversed(folders):
+            for ignore_file_name in reversed(_IGNORE_FILE_NAMES):
+                rules = self._ignore_files[os.path.join(folder, ignore_file_name)][1]
+                if rules is None:
+                    continue
+                ignored = rules.match(path[len(folder) + 1:].replace(os.sep, '/'), is_directory)
+                if ignored is not None:
+                    return ignored
+
+        return None
+
+    def _is_folder_ignored(self, folders: Sequence[str], index: int) -> bool:
+        if index <= 0:
+            return False
+        folder = folders[index]
+        ignored = self._folders.get(folder)
+        if ignored is None:
+            # Files of an ignored folder can't be re-included
+            ignored = self._is_folder_ignored(folders, index - 1) or bool(self._match(folders[:index], folder, True))
+            self._folders[folder] = ignored
+
+        return ignored
+
+
+def get_exclude_matcher(settings: Settings) -> ExcludeMatcher:
+    root = os.getcwd()
+    key = (tuple(settings.exclude), root, settings.use_ignore_files)
+    with _matchers_lock:
+        matcher = _matchers.get(key)
+        if matcher is None:
+            matcher = _matchers[key] = ExcludeMatcher(settings.exclude, root, settings.use_ignore_files)
+
+        return matcher
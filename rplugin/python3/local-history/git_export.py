@@ -0,0 +1,135 @@
+import os
+import subprocess
+from dataclasses import dataclass
+from hashlib import sha1
+from typing import BinaryIO, Dict, Iterator, List, Sequence, Tuple
+from .settings import Settings
+from .storage import LocalHistoryStorage, find_local_history_names
+from .utils import parallel_map
+
+_COMMITTER = b'local-history <local-history@localhost>'
+
+_FILE_MODE = b'100644'
+
+_STREAM_BUFFER_SIZE = 1024 * 1024
+
+# Revisions read by a worker at once, a few of them are in flight per worker so that memory stays bounded
+_REVISIONS_PER_ITEM = 8
+
+
+@dataclass(frozen=True)
+class GitExportResult:
+    histories: int
+    revisions: int
+    blobs: int
+    size: int
+
+
+@dataclass(frozen=True)
+class _Revision:
+    timestamp: float
+    file_path: str
+    # Fast-import mark of the blob holding the content of the revision
+    mark: int
+
+
+def _quote_path(file_path: str) -> bytes:
+    data = file_path.encode('utf-8')
+    if not any(char in data for char in b'"\\\n') and not data.startswith(b'"'):
+        return data
+    return b'"' + data.replace(b'\\', b'\\\\').replace(b'"', b'\\"').replace(b'\n', b'\\n') + b'"'
+
+
+def _get_relative_path(file_path: str, root: str) -> str:
+    if root and file_path.startswith(root.rstrip(os.sep) + os.sep):
+        return os.path.relpath(file_path, root)
+    return os.path.splitdrive(file_path)[1].lstrip(os.sep)
+
+
+def _get_items(settings: Settings, names: Sequence[str]) -> Iterator[Tuple[Settings, str, str, List[int]]]:
+    # Histories are split into slices of a few revisions, only their metadata is read here
+    for name in names:
+        local_history_storage = LocalHistoryStorage(settings, '', name)
+        header = local_history_storage.get_header()
+        file_path = header.file_path if header is not None and header.file_path else os.path.join('_unknown', name)
+        record_ids = [record.record_id for record in local_history_storage.get_records(with_content=False)]
+        for start in range(0, len(record_ids), _REVISIONS_PER_ITEM):
+            yield settings, name, file_path, record_ids[start:start + _REVISIONS_PER_ITEM]
+
+
+def _read_revisions(item: Tuple[Settings, str, str, List[int]]) -> Tuple[str, List[Tuple[float, bytes]]]:
+    # Runs in a worker process: decompression of every history is spread over all cores
+    settings, name, file_path, record_ids = item
+    local_history_storage = LocalHistoryStorage(settings, '', name)
+    records = local_history_storage.get_records_by_id(record_ids)
+    revisions = [(record.timestamp, content.encode('utf-8'))
+                 for record, content in local_history_storage.get_contents(records)
+                 if content is not None]
+
+    return file_path, revisions
+
+
+def _write_blob(stream: BinaryIO, mark: int, content: bytes) -> None:
+    stream.write(b'blob\nmark :%d\ndata %d\n' % (mark, len(content)))
+    stream.write(content)
+    stream.write(b'\n')
+
+
+def _write_commit(stream: BinaryIO, branch: bytes, revision: _Revision, root: str) -> None:
+    timestamp = int(revision.timestamp)
+    file_path = _get_relative_path(revision.file_path, root)
+    message = ('Local history of %s' % file_path).encode('utf-8')
+    stream.write(b'commit %s\n' % branch)
+    stream.write(b'author %s %d +0000\n' % (_COMMITTER, timestamp))
+    stream.write(b'committer %s %d +0000\n' % (_COMMITTER, timestamp))
+    stream.write(b'data %d\n%s\n' % (len(message), message))
+    stream.write(b'M %s :%d %s\n\n' % (_FILE_MODE, revision.mark, _quote_path(file_path)))
+
+
+def write_fast_import_stream(stream: BinaryIO, settings: Settings, names: Sequence[str], root: str, branch: str,
+                             jobs: int) -> GitExportResult:
+    # Blobs are streamed a few revisions at a time, commits are then ordered by timestamp across all files and
+    # only reference the blobs by mark
+    marks: Dict[bytes, int] = {}
+    revisions: List[_Revision] = []
+    size = 0
+    for file_path, history_revisions in parallel_map(_read_revisions, _get_items(settings, names), jobs, chunk_size=1):
+        for timestamp, content in history_revisions:
+            digest = sha1(content).digest()
+            mark = marks.get(digest)
+            if mark is None:
+                mark = marks[digest] = len(marks) + 1
+                _write_blob(stream, mark, content)
+                size += len(content)
+            revisions.append(_Revision(timestamp, file_path, mark))
+
+    branch_ref = ('refs/heads/%s' % branch).encode('utf-8')
+    stream.write(b'reset %s\n\n' % branch_ref)
+    revisions.sort(key=lambda revision: revision.timestamp)
+    for revision in revisions:
+        _write_commit(stream, branch_ref, revision, root)
+    stream.write(b'done\n')
+
+    return GitExportResult(len(names), len(revisions), len(marks), size)
+
+
+def export_to_git(settings: Settings, names: Sequence[str], repository: str, root: str, branch: str,
+                  jobs: int) -> GitExportResult:
+    if not names:
+        names = find_local_history_names(settings)
+    if not os.path.isdir(os.path.join(repository, '.git')) and not os.path.isfile(os.path.join(repository, 'HEAD')):
+        subprocess.run(['git', 'init', '--quiet', repository], check=True)
+
+    process = subprocess.Popen(['git', 'fast-import', '--quiet', '--done', '--force'],
+                               cwd=repository,
+                               stdin=subprocess.PIPE,
+                               bufsize=_STREAM_BUFFER_SIZE)
+    try:
+        result = write_fast_import_stream(process.stdin, settings, names, root, branch, jobs)
+    finally:
+        process.stdin.close()
+        return_code = process.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, 'git fast-import')
+
+    return result
@@ -1,11 +1,23 @@
+import os
 import time
 from collections import OrderedDict
+from typing import AbstractSet, Tuple
 
 
-def build_graph_log(changes: OrderedDict) -> list:
+def build_graph_log(changes: OrderedDict, marks: AbstractSet[Tuple[str, int]] = frozenset()) -> list:
     lines = []
     for index, change in changes.items():
-        line = 'o  [%d] %-10s' % (index, _calculate_age(change.timestamp))
+        node = '*' if change.key in marks else 'o'
+        line = '%s  [%d] %-10s' % (node, index, _calculate_age(change.timestamp))
+        if change.added is not None:
+            line = line + ' +%d -%d' % (change.added, change.removed)
+        if change.size is not None:
+            line = line + ' ' + _format_size(change.size)
+        if change.unsaved:
+            line = line + ' (unsaved)'
+        if change.file_path:
+            # Saved before the file was renamed or moved
+            line = line + ' (%s)' % os.path.basename(change.file_path)
         if (len(lines) >= 1):
             lines.append('|')
         lines.append(line)
@@ -33,3 +45,12 @@ def _calculate_age(timestamp: float) -> str:
         return '%s ago' % format('minute', m)
 
     return '< 1 min ago'
+
+
+def _format_size(size: int) -> str:
+    if size < 1024:
+        return '%dB' % size
+    if size < 1024 * 1024:
+        return '%.1fK' % (size / 1024)
+
+    return '%.1fM' % (size / 1024 / 1024)
@@ -1,22 +1,37 @@
+import os
 import re
-import fnmatch
+import stat
 import tempfile
+import time
+from queue import Queue
+from threading import Event, Thread
 from pynvim.api.buffer import Buffer
 from pynvim.api.window import Window
 from collections import OrderedDict
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from enum import Enum
-from typing import Optional, Iterator, Tuple, Sequence, Any
+from asyncio import CancelledError, Task, get_running_loop, wait
+from typing import Optional, Iterator, List, Tuple, Sequence, Any
 from functools import partial
 from .graph_log import build_graph_log
-from .storage import LocalHistoryStorage, LocalHistoryChange
+from .storage import LocalHistoryStorage, LocalHistoryChange, get_dbm_backend
+from .snapshot import SnapshotScheduler
+from .scrub import scrub_local_histories
+from .restore import restore_local_histories
+from .exclude import get_exclude_matcher
+from .watcher import FileWatcher
 from .settings import Settings, LocalHistoryEnabled
 from .logging import log
+from .profiler import timed, count, get_stats, format_stats, dump_stats, reset_stats, arm_capture
 from .utils import (
     create_folder_if_not_present,
+    get_file_content,
     is_in_workspace,
     run_in_executor,
+    thread_map,
     diff,
+    get_hunks,
+    parse_timestamp,
 )
 from .nvim import (
     async_call,
@@ -25,12 +40,20 @@ from .nvim import (
     create_buffer,
     create_window,
     close_window,
+    find_window_by_buffer,
     set_buffer_in_window,
     set_current_window,
     find_windows_in_tab,
     get_buffer_in_window,
     get_buffer_option,
+    get_buffer_var,
+    buffer_attach,
+    get_buffer_number,
+    buffer_detach,
     get_window_option,
+    get_buffer,
+    get_modified_buffer_names,
+    set_quickfix_list,
     get_current_buffer,
     get_current_window,
     get_buffer_name,
@@ -39,13 +62,12 @@ from .nvim import (
     set_cursor,
     get_line_count,
     get_line,
-    get_lines,
-    get_current_line,
     get_width,
     set_width,
     get_height,
     set_height,
     confirm,
+    echo,
     WindowLayout,
 )
 
@@ -53,6 +75,49 @@ _LOCAL_HISTORY_FILE_TYPE = 'LocalHistory'
 
 _LOCAL_HISTORY_PREVIEW_FILE_TYPE = 'LocalHistoryPreview'
 
+# Seconds without any change before a modified buffer is snapshotted
+_UNSAVED_SNAPSHOT_IDLE_DELAY = 1
+
+# Pause in seconds between two histories checked by :LocalHistoryVerify
+_VERIFY_THROTTLE = 0.05
+
+# Threads of :LocalHistoryVerify and :LocalHistoryRestoreAt, the plugin host never forks worker processes
+_VERIFY_JOBS = max(1, (os.cpu_count() or 1) // 2)
+
+_RESTORE_JOBS = os.cpu_count() or 1
+
+_RESTORE_TIME_FMT = '%Y-%m-%d %H:%M:%S'
+
+# Threads saving the files changed outside of Neovim
+_WATCH_SAVE_JOBS = min(4, os.cpu_count() or 1)
+
+# Batches of changed files waiting to be saved, the watcher waits for the saving thread beyond
+_WATCH_MAX_PENDING_BATCHES = 4
+
+# Larger files changed outside of Neovim (e.g. build outputs) are not saved
+_WATCH_MAX_FILE_SIZE = 1024 * 1024
+
+# Shown in the local history tree until the changes are read
+_LOADING_MESSAGE = 'Loading local history...'
+
+# Revisions which can be marked at once for a diff
+_MAX_MARKS = 2
+
+# Temporary files written by the diff before revisions were loaded into scratch buffers: created by
+# tempfile.mkstemp() (no prefix or suffix, read and write for the user only), they hold the preview buffer, either a
+# unified diff of the current content against the revision or the message of identical contents
+_LEGACY_DIFF_FILE_NAME_PATTERN = re.compile(r'^tmp[a-z0-9_]{8}$')
+
+_LEGACY_DIFF_FILE_MODE = 0o600
+
+_LEGACY_DIFF_FILE_MAX_SIZE = 4 * 1024 * 1024
+
+_LEGACY_DIFF_FILE_IDENTICAL = b'Contents are identical\n'
+
+_LEGACY_DIFF_FILE_HEADER = b'--- current\n+++ history\n@@ '
+
+_LEGACY_DIFF_LINE_PATTERN = re.compile(rb'^(?:@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@|[ +-].*)$')
+
 
 class MoveDirection(Enum):
     OLDER = 1
@@ -61,10 +126,37 @@ class MoveDirection(Enum):
     NEWEST = 4
 
 
+@dataclass(frozen=False)
+class BufferLines:
+    changedtick: int
+    lines: list
+    attached: bool
+
+
 @dataclass(frozen=True)
 class LocalHistoryState:
     current_buffer: Buffer
     changes: OrderedDict
+    # Lines of the current buffer, kept up to date by the buffer update notifications
+    current_lines: BufferLines
+    # Keys of the revisions marked for a diff, oldest mark first
+    marks: list
+
+
+_local_history_state: Optional[LocalHistoryState] = None
+
+_verify_task: Optional[Task] = None
+
+_backfill_task: Optional[Task] = None
+
+_load_task: Optional[Task] = None
+
+# Set when the loading is cancelled, the reads running in the executor stop between two records
+_load_cancelled = Event()
+
+_watcher: Optional[FileWatcher] = None
+
+_legacy_diff_files_removed = False
 
 
 def _is_local_history_buffer(buffer: Buffer) -> bool:
@@ -80,11 +172,9 @@ def _find_local_history_windows_in_tab() -> Iterator[Window]:
             yield window
 
 
-def _is_excluded_file(file_path: str, exclude: list) -> bool:
-    for exclude_pattern in exclude:
-        if fnmatch.fnmatch(file_path, exclude_pattern):
-            return True
-    return False
+def _is_excluded_file(settings: Settings, file_path: str) -> bool:
+    with timed('exclude.match'):
+        return get_exclude_matcher(settings).is_excluded(file_path)
 
 
 def _is_buffer_valid(buffer: Buffer) -> str:
@@ -96,7 +186,70 @@ def _is_buffer_valid(buffer: Buffer) -> str:
     return get_buffer_option(buffer, 'modifiable') and not get_window_option(window, 'previewwindow')
 
 
+def _get_current_buffer_lines() -> list:
+    buffer_lines = _local_history_state.current_lines
+    buffer = _local_history_state.current_buffer
+    if not buffer_lines.attached:
+        buffer_lines.attached = buffer_attach(buffer)
+        buffer_lines.changedtick = -1
+
+    if get_buffer_var(buffer, 'changedtick') != buffer_lines.changedtick:
+        # Buffer updates which are not processed yet are ignored thanks to the changedtick
+        count('preview.buffer_cache_miss')
+        buffer_lines.changedtick, buffer_lines.lines = call_atomic(
+            ("nvim_buf_get_var", (buffer, 'changedtick')),
+            ("nvim_buf_get_lines", (buffer, 0, -1, False)),
+        )
+    else:
+        count('preview.buffer_cache_hit')
+
+    return buffer_lines.lines
+
+
+def _detach_current_buffer() -> None:
+    if _local_history_state is not None and _local_history_state.current_lines.attached:
+        _local_history_state.current_lines.attached = False
+        buffer_detach(_local_history_state.current_buffer)
+
+
+def _get_attached_buffer_lines(buffer_number: int) -> Optional[BufferLines]:
+    # Updates of buffers which are not attached (any more) by the plugin are ignored
+    if (_local_history_state is None or not _local_history_state.current_lines.attached or
+            get_buffer_number(_local_history_state.current_buffer) != buffer_number):
+        return None
+
+    return _local_history_state.current_lines
+
+
+def local_history_buffer_lines_event(buffer_number: int, changedtick: int, first_line: int, last_line: int,
+                                     line_data: list) -> None:
+    buffer_lines = _get_attached_buffer_lines(buffer_number)
+    if buffer_lines is None:
+        return
+    if changedtick <= buffer_lines.changedtick or buffer_lines.changedtick < 0:
+        return
+
+    buffer_lines.lines[first_line:last_line] = line_data
+    buffer_lines.changedtick = changedtick
+
+
+def local_history_buffer_changedtick_event(buffer_number: int, changedtick: int) -> None:
+    buffer_lines = _get_attached_buffer_lines(buffer_number)
+    if buffer_lines is None:
+        return
+    if buffer_lines.changedtick >= 0 and changedtick > buffer_lines.changedtick:
+        buffer_lines.changedtick = changedtick
+
+
+def local_history_buffer_detach_event(buffer_number: int) -> None:
+    buffer_lines = _get_attached_buffer_lines(buffer_number)
+    if buffer_lines is None:
+        return
+    buffer_lines.attached = False
+
+
 def _close_local_history_windows() -> bool:
+    _detach_current_buffer()
     windows: Iterator[Window] = _find_local_history_windows_in_tab()
     closed_local_history_windows = False
     for window in windows:
@@ -115,8 +268,21 @@ def _buf_set_lines(buffer: Buffer, lines: list, modifiable: bool) -> Iterator[Tu
         yield "nvim_buf_set_option", (buffer, "modifiable", False)
 
 
+def _buf_set_hunks(buffer: Buffer, hunks: Sequence[Tuple[int, int, list]]) -> Iterator[Tuple[str, Sequence[Any]]]:
+    # From the bottom so that the line numbers of the hunks above stay valid
+    for start, end, lines in reversed(hunks):
+        yield "nvim_buf_set_lines", (buffer, start, end, True, lines)
+
+
+def _build_graph() -> list:
+    return build_graph_log(_local_history_state.changes, set(_local_history_state.marks))
+
+
 def _render_local_history_tree(lines: list) -> None:
-    _, buffer = find_window_and_buffer_by_file_type(_LOCAL_HISTORY_FILE_TYPE)
+    window_and_buffer = find_window_and_buffer_by_file_type(_LOCAL_HISTORY_FILE_TYPE)
+    if window_and_buffer is None:
+        return
+    _, buffer = window_and_buffer
 
     if not lines:
         lines = ['History is empty']
@@ -125,85 +291,239 @@ def _render_local_history_tree(lines: list) -> None:
     call_atomic(*instruction)
 
 
-def _render_local_history_preview() -> None:
-    if _local_history_state is None:
+def _render_local_history_preview(key: Tuple[str, int], preview: list) -> None:
+    window_and_buffer = find_window_and_buffer_by_file_type(_LOCAL_HISTORY_PREVIEW_FILE_TYPE)
+    target_change = _get_local_history_target_change()
+    if window_and_buffer is None or target_change is None or target_change.key != key:
+        # Closed, or the cursor moved to another revision in the meantime
         return
-    target = _get_local_history_target()
-    if target is None:
+    _, buffer = window_and_buffer
+
+    instruction = _buf_set_lines(buffer, preview, False)
+    call_atomic(*instruction)
+
+
+async def _update_local_history_preview(settings: Settings) -> None:
+    state = _local_history_state
+    if state is None:
         return
+    with timed('preview.total'):
+        change = await async_call(_get_local_history_target_change)
+        if change is None or _local_history_state is not state:
+            return
+
+        content = await _get_change_content(settings, change)
+        if _local_history_state is not state:
+            return
+        if content is None:
+            preview = ['Revision is corrupt']
+        else:
+            with timed('preview.get_lines'):
+                # Copied as the lines are updated by buffer events while the diff is computed
+                current_lines = await async_call(lambda: list(_get_current_buffer_lines()))
+            with timed('preview.diff'):
+                preview = await run_in_executor(partial(diff, current_lines, content))
+            if not preview:
+                preview = ['Contents are identical']
 
-    change: LocalHistoryChange = _local_history_state.changes[target]
+        with timed('preview.render'):
+            await async_call(partial(_render_local_history_preview, change.key, preview))
 
-    _, buffer = find_window_and_buffer_by_file_type(_LOCAL_HISTORY_PREVIEW_FILE_TYPE)
-    preview = diff(
-        get_lines(_local_history_state.current_buffer, 0, get_line_count(_local_history_state.current_buffer)),
-        change.content)
-    if not preview:
-        preview = ['Contents are identical']
 
-    instruction = _buf_set_lines(buffer, preview, False)
-    call_atomic(*instruction)
+async def _get_change_content(settings: Settings, change: LocalHistoryChange) -> Optional[list]:
+    # Contents are only read for the revisions which are previewed, reverted or diffed
+    if change.content is not None:
+        return change.content
+
+    local_history_storage = LocalHistoryStorage(settings, '', change.local_history_name)
+    with timed('preview.get_content'):
+        content = await run_in_executor(partial(local_history_storage.get_change_content, change.change_id))
+    state = _local_history_state
+    if content is not None and state is not None:
+        for index, state_change in state.changes.items():
+            if state_change.key == change.key:
+                state.changes[index] = replace(state_change, content=content)
+                break
+
+    return content
 
 
 def _get_local_history_target() -> Optional[int]:
-    window, _ = find_window_and_buffer_by_file_type(_LOCAL_HISTORY_FILE_TYPE)
-    set_current_window(window)
-    current_line = get_current_line()
-    matches = re.match('^[^\[]* \[([0-9]+)\] .*$', current_line)
+    # Revision under the cursor of the local history tree, which isn't necessarily the current window
+    window_and_buffer = find_window_and_buffer_by_file_type(_LOCAL_HISTORY_FILE_TYPE)
+    if window_and_buffer is None:
+        return None
+    window, buffer = window_and_buffer
+    row, _ = get_current_cursor(window)
+    matches = re.match('^[^\[]* \[([0-9]+)\] .*$', get_line(buffer, row) or '')
     if matches:
         return int(matches.group(1))
 
     return None
 
 
-async def local_history_diff(settings: Settings) -> None:
-    target = await async_call(_get_local_history_target)
+def _get_local_history_target_change() -> Optional[LocalHistoryChange]:
+    # Read along with the number under the cursor: the changes are numbered again when the changes of the previous
+    # paths are loaded, the handlers keep the change (and its key) rather than its number across their awaits
+    target = _get_local_history_target()
     if target is None or _local_history_state is None:
-        return
+        return None
 
-    def _go_to_preview_window() -> None:
-        window, _ = find_window_and_buffer_by_file_type(_LOCAL_HISTORY_PREVIEW_FILE_TYPE)
+    return _local_history_state.changes.get(target)
+
+
+def _create_revision_buffer(content: list, file_type: str) -> Buffer:
+    buffer = create_buffer(
+        dict(), {
+            'buftype': 'nofile',
+            'bufhidden': 'wipe',
+            'swapfile': False,
+            'buflisted': False,
+            'modifiable': False,
+            'filetype': file_type,
+        })
+    call_atomic(*_buf_set_lines(buffer, content, False))
+
+    return buffer
+
+
+def _diff_windows(windows: Sequence[Window]) -> None:
+    for window in windows:
         set_current_window(window)
+        command('diffthis')
+
+
+def _get_diff_changes(target_change: LocalHistoryChange) -> list:
+    marked_changes = [
+        change for change in _local_history_state.changes.values() if change.key in _local_history_state.marks
+    ]
+    if len(marked_changes) >= 2:
+        return marked_changes
+    if marked_changes and marked_changes[0].key != target_change.key:
+        return sorted(marked_changes + [target_change], key=lambda change: change.timestamp)
+
+    return [target_change]
+
+
+def _remove_legacy_diff_files() -> None:
+    temp_folder = tempfile.gettempdir()
+    for file_name in os.listdir(temp_folder):
+        if not _LEGACY_DIFF_FILE_NAME_PATTERN.match(file_name):
+            continue
+        file_path = os.path.join(temp_folder, file_name)
+        try:
+            file_stat = os.lstat(file_path)
+            if (not stat.S_ISREG(file_stat.st_mode) or file_stat.st_uid != os.getuid()
+                    or stat.S_IMODE(file_stat.st_mode) != _LEGACY_DIFF_FILE_MODE
+                    or file_stat.st_size > _LEGACY_DIFF_FILE_MAX_SIZE):
+                continue
+            with open(file_path, 'rb') as file:
+                content = file.read()
+            if _is_legacy_diff(content):
+                os.remove(file_path)
+        except OSError:
+            continue
+
+
+def _is_legacy_diff(content: bytes) -> bool:
+    # The whole file must be what the preview buffer held, anything else is left alone
+    if content == _LEGACY_DIFF_FILE_IDENTICAL:
+        return True
+    if not content.startswith(_LEGACY_DIFF_FILE_HEADER) or not content.endswith(b'\n'):
+        return False
+    lines = content[:-1].split(b'\n')
+    return all(_LEGACY_DIFF_LINE_PATTERN.match(line) for line in lines[2:])
 
-    await async_call(_go_to_preview_window)
 
-    (_, filename) = tempfile.mkstemp()
-    await async_call(partial(command, 'silent! w %s' % (filename)))
+async def local_history_mark(settings: Settings) -> None:
+    change = await async_call(_get_local_history_target_change)
+    if change is None or _local_history_state is None:
+        return
 
-    await async_call(_close_local_history_windows)
+    key = change.key
+    marks = _local_history_state.marks
+    if key in marks:
+        marks.remove(key)
+    else:
+        marks.append(key)
+        del marks[:-_MAX_MARKS]
+
+    graph = await run_in_executor(_build_graph)
+    await async_call(partial(_render_local_history_tree, graph))
+
+
+async def local_history_diff(settings: Settings) -> None:
+    target_change = await async_call(_get_local_history_target_change)
+    if target_change is None or _local_history_state is None:
+        return
+
+    changes = _get_diff_changes(target_change)
+    current_buffer = _local_history_state.current_buffer
+    contents = [await _get_change_content(settings, change) for change in changes]
+    if any(content is None for content in contents):
+        log.warning('[vim-local-history] The revision is corrupt')
+        return
+
+    def _diff() -> None:
+        file_type = get_buffer_option(current_buffer, 'filetype')
+        _close_local_history_windows()
+
+        if len(changes) == 2:
+            # Two revisions side by side in a new tab, the older one on the left
+            left_buffer = _create_revision_buffer(contents[0], file_type)
+            right_buffer = _create_revision_buffer(contents[1], file_type)
+            command('tab sbuffer %d' % left_buffer.number)
+            left_window = get_current_window()
+            command('rightbelow vertical sbuffer %d' % right_buffer.number)
+            _diff_windows((left_window, get_current_window()))
+            return
+
+        window = find_window_by_buffer(current_buffer)
+        if window is None:
+            return
+        revision_buffer = _create_revision_buffer(contents[0], file_type)
+        set_current_window(window)
+        command('leftabove vertical sbuffer %d' % revision_buffer.number)
+        _diff_windows((get_current_window(), window))
 
-    await async_call(partial(command, 'silent! keepalt vert diffpatch %s' % (filename)))
-    await async_call(partial(command, 'set buftype=nofile bufhidden=delete'))
+    await async_call(_diff)
 
 
 async def local_history_delete(settings: Settings) -> None:
-    target = await async_call(_get_local_history_target)
-    if _local_history_state is None or target is None:
+    # The tree must not be numbered again while the deletion is confirmed
+    await local_history_wait_for_load()
+    state = _local_history_state
+    change = await async_call(_get_local_history_target_change)
+    if state is None or change is None:
         return
 
     ans = await async_call(partial(confirm, "Do you want to delete this change?"))
     if ans == False:
         return
+    # Toggled or closed in the meantime
+    if _local_history_state is not state or not any(
+            state_change.key == change.key for state_change in state.changes.values()):
+        return
 
-    current_file_path = await async_call(partial(get_buffer_name, _local_history_state.current_buffer))
-    local_history_storage = LocalHistoryStorage(settings, current_file_path)
-    change = _local_history_state.changes[target]
+    current_file_path = await async_call(partial(get_buffer_name, state.current_buffer))
+    # The change may belong to the history of a previous path of the file
+    local_history_storage = LocalHistoryStorage(settings, current_file_path, change.local_history_name or None)
     await run_in_executor(partial(local_history_storage.delete_record, change.change_id))
 
-    index = target
-    while _local_history_state.changes.get(index + 1) is not None:
-        _local_history_state.changes[index] = _local_history_state.changes[index + 1]
-        index = index + 1
-    _local_history_state.changes.pop(index)
+    changes = [state_change for state_change in state.changes.values() if state_change.key != change.key]
+    state.changes.clear()
+    state.changes.update(enumerate(changes, 1))
+    if change.key in state.marks:
+        state.marks.remove(change.key)
 
     window, buffer = await async_call(partial(find_window_and_buffer_by_file_type, _LOCAL_HISTORY_FILE_TYPE))
     row, _ = await async_call(partial(get_current_cursor, window))
 
-    graph = await run_in_executor(partial(build_graph_log, _local_history_state.changes))
+    graph = await run_in_executor(_build_graph)
     await async_call(partial(_render_local_history_tree, graph))
     line_count = await async_call(partial(get_line_count, buffer))
     await async_call(partial(set_cursor, window, (min(row, line_count), 0)))
-    await async_call(_render_local_history_preview)
+    await _update_local_history_preview(settings)
 
 
 async def local_history_move(settings: Settings, direction: MoveDirection) -> None:
@@ -242,7 +562,7 @@ async def local_history_move(settings: Settings, direction: MoveDirection) -> No
         set_cursor(window, (new_row, 0))
 
     await async_call(_local_history_move)
-    await async_call(_render_local_history_preview)
+    await _update_local_history_preview(settings)
 
 
 async def local_history_preview_resize(settings: Settings, direction: int) -> None:
@@ -272,55 +592,188 @@ async def local_history_resize(settings: Settings, direction: int) -> None:
 
 
 async def local_history_quit(settings: Settings) -> None:
+    _cancel_local_history_load()
     await async_call(_close_local_history_windows)
 
 
 async def local_history_revert(settings: Settings) -> None:
-    target = await async_call(_get_local_history_target)
-    if target is None or _local_history_state is None:
+    change = await async_call(_get_local_history_target_change)
+    if change is None or _local_history_state is None:
+        return
+    content = await _get_change_content(settings, change)
+    if _local_history_state is None:
+        return
+    if content is None:
+        log.warning('[vim-local-history] The revision is corrupt')
         return
-    change = _local_history_state.changes[target]
 
     def _revert() -> None:
-        instruction = _buf_set_lines(_local_history_state.current_buffer, change.content, True)
-        call_atomic(*instruction)
+        # Only the changed lines are replaced, the marks, folds and undo history of the other lines are kept
+        with timed('revert.diff'):
+            hunks = get_hunks(_get_current_buffer_lines(), content)
+        if hunks:
+            call_atomic(*_buf_set_hunks(_local_history_state.current_buffer, hunks))
 
     await async_call(_revert)
 
 
-async def local_history_save(settings: Settings, file_path: str) -> None:
+def _is_local_history_enabled(settings: Settings, file_path: str) -> bool:
     if not file_path:
         # Temp file
-        return
+        return False
     if settings.enabled == LocalHistoryEnabled.NEVER:
         if settings.show_info_messages:
             log.info('[vim-local-history] Local history disabled')
-        return
+        return False
     if settings.enabled == LocalHistoryEnabled.WORKSPACE and not is_in_workspace(file_path):
         if settings.show_info_messages:
             log.info('[vim-local-history] Local history disabled for files which not in the current workspace')
-        return
-    if _is_excluded_file(file_path, settings.exclude):
+        return False
+    if _is_excluded_file(settings, file_path):
         if settings.show_info_messages:
             log.info('[vim-local-history] The file is in exclude list')
+        return False
+
+    return True
+
+
+async def local_history_track_unsaved(settings: Settings, scheduler: SnapshotScheduler, buffer_info: list) -> None:
+    buffer_number, changedtick, modified = buffer_info
+    if not settings.unsaved_snapshots or not modified:
+        return
+
+    scheduler.notify(buffer_number, changedtick, _UNSAVED_SNAPSHOT_IDLE_DELAY, settings.unsaved_snapshot_interval)
+
+
+async def local_history_snapshot(settings: Settings, scheduler: SnapshotScheduler, buffer_number: int) -> None:
+
+    def _read_buffer() -> Optional[Tuple[str, int, str]]:
+        buffer = get_buffer(buffer_number)
+        if buffer is None:
+            return None
+        # Read everything at once so that the lines match the changedtick
+        file_path, changedtick, modified, buftype, eol, fixeol, lines = call_atomic(
+            ("nvim_buf_get_name", (buffer,)),
+            ("nvim_buf_get_var", (buffer, 'changedtick')),
+            ("nvim_buf_get_option", (buffer, 'modified')),
+            ("nvim_buf_get_option", (buffer, 'buftype')),
+            ("nvim_buf_get_option", (buffer, 'eol')),
+            ("nvim_buf_get_option", (buffer, 'fixeol')),
+            ("nvim_buf_get_lines", (buffer, 0, -1, False)),
+        )
+        if not modified or buftype:
+            return None
+
+        return file_path, changedtick, '\n'.join(lines) + ('\n' if eol or fixeol else '')
+
+    with timed('snapshot.read_buffer'):
+        snapshot = await async_call(_read_buffer)
+    if snapshot is None:
+        scheduler.forget(buffer_number)
+        return
+
+    file_path, changedtick, content = snapshot
+    if not scheduler.is_pending(buffer_number, changedtick):
+        # The buffer has been changed after the snapshot was scheduled, wait until the editor is idle again
+        scheduler.notify(buffer_number, changedtick, _UNSAVED_SNAPSHOT_IDLE_DELAY, settings.unsaved_snapshot_interval)
+        return
+    if not _is_local_history_enabled(settings, file_path):
+        scheduler.captured(buffer_number, changedtick)
         return
 
-    await run_in_executor(partial(create_folder_if_not_present, settings.path))
+    with timed('snapshot.total'):
+        await run_in_executor(partial(create_folder_if_not_present, settings.path))
 
-    local_history_storage = LocalHistoryStorage(settings, file_path)
-    await run_in_executor(partial(local_history_storage.save_record))
+        local_history_storage = LocalHistoryStorage(settings, file_path)
+        await run_in_executor(partial(local_history_storage.save_record, content, True))
+    scheduler.captured(buffer_number, changedtick)
+    if settings.show_info_messages:
+        log.info('[vim-local-history] Snapshot of unsaved buffer done')
+
+
+async def local_history_save(settings: Settings, file_path: str) -> None:
+    if not _is_local_history_enabled(settings, file_path):
+        return
+
+    with timed('save.total'):
+        await run_in_executor(partial(create_folder_if_not_present, settings.path))
+
+        local_history_storage = LocalHistoryStorage(settings, file_path)
+        await run_in_executor(partial(local_history_storage.save_record))
     if settings.show_info_messages:
         log.info('[vim-local-history] Save done')
 
 
+async def local_history_watch(settings: Settings) -> None:
+    global _watcher
+
+    if not settings.watch or settings.enabled == LocalHistoryEnabled.NEVER or _watcher is not None:
+        return
+
+    root = os.getcwd()
+    history_folder = os.path.abspath(settings.path)
+    exclude_matcher = get_exclude_matcher(settings)
+
+    def _is_skipped_folder(folder: str) -> bool:
+        # Saving a history must not be reported as a change
+        return folder == history_folder or exclude_matcher.is_folder_excluded(folder)
+
+    # Saved by a thread of their own, outside of the plugin lock: a checkout of thousands of files never delays a
+    # save, a toggle or a mapping. Histories are locked one by one by the storage.
+    batches: Queue = Queue(_WATCH_MAX_PENDING_BATCHES)
+    Thread(target=_save_changed_files_loop, args=(settings, batches), name='local-history-watch-save',
+           daemon=True).start()
+    _watcher = FileWatcher(root, _is_skipped_folder, batches.put)
+    _watcher.start()
+
+
+def _save_changed_files_loop(settings: Settings, batches: Queue) -> None:
+    while True:
+        file_paths = batches.get()
+        try:
+            _save_changed_files(settings, file_paths)
+        except Exception as e:
+            log.exception('[vim-local-history] Saving files changed outside of Neovim failed: %s', str(e))
+
+
+def _save_changed_files(settings: Settings, file_paths: Sequence[str]) -> None:
+
+    def _save(file_path: str) -> bool:
+        try:
+            if os.path.getsize(file_path) > _WATCH_MAX_FILE_SIZE or _is_excluded_file(settings, file_path):
+                return False
+            content = get_file_content(file_path)
+            if '\0' in content:
+                return False
+            # Files written by Neovim are saved again, which is skipped as their content didn't change. New files (e.g.
+            # created by a checkout) are not looked up as renamed files.
+            LocalHistoryStorage(settings, file_path).save_record(content, detect_rename=False)
+        except (OSError, UnicodeDecodeError):
+            # Removed in the meantime, unreadable or binary
+            return False
+
+        return True
+
+    with timed('watch.save'):
+        create_folder_if_not_present(settings.path)
+        # The files are saved in parallel
+        saved = sum(thread_map(_save, file_paths, _WATCH_SAVE_JOBS, _WATCH_SAVE_JOBS, lambda file_path: 1))
+    count('watch.saved_files', saved)
+    if settings.show_info_messages and saved:
+        log.info('[vim-local-history] Snapshot of %d files changed outside of Neovim done', saved)
+
+
 async def local_history_toggle(settings: Settings) -> None:
     if settings.enabled == LocalHistoryEnabled.NEVER:
         if settings.show_info_messages:
             log.info('[vim-local-history] Local history disabled')
         return
 
-    global _local_history_state
+    global _local_history_state, _legacy_diff_files_removed, _load_task, _load_cancelled
 
+    # Toggling again aborts the loading of the local history
+    _cancel_local_history_load()
+    await async_call(_detach_current_buffer)
     _local_history_state = None
 
     def _toggle() -> Optional[Buffer]:
@@ -340,7 +793,7 @@ async def local_history_toggle(settings: Settings) -> None:
                 if settings.show_info_messages:
                     log.info('[vim-local-history] Local history disabled for files which not in the current workspace')
                 return None
-            if _is_excluded_file(current_file_path, settings.exclude):
+            if _is_excluded_file(settings, current_file_path):
                 if settings.show_info_messages:
                     log.info('[vim-local-history] The file is in exclude list')
                 return None
@@ -361,6 +814,7 @@ async def local_history_toggle(settings: Settings) -> None:
                 'wrap': False,
             })
             set_buffer_in_window(window, buffer)
+            call_atomic(*_buf_set_lines(buffer, [_LOADING_MESSAGE], False))
 
             preview_buffer = create_buffer(
                 dict(), {
@@ -385,25 +839,261 @@ async def local_history_toggle(settings: Settings) -> None:
 
             return current_buffer
 
-    current_buffer = await async_call(_toggle)
+    with timed('toggle.open_windows'):
+        current_buffer = await async_call(_toggle)
     if current_buffer is None:
         return
 
+    if not _legacy_diff_files_removed:
+        _legacy_diff_files_removed = True
+        await run_in_executor(_remove_legacy_diff_files)
+
     current_file_path = await async_call(partial(get_buffer_name, current_buffer))
+    _load_cancelled = Event()
+    _load_task = get_running_loop().create_task(_load_local_history(settings, current_buffer, current_file_path,
+                                                                    _load_cancelled))
 
-    await run_in_executor(partial(create_folder_if_not_present, settings.path))
-    local_history_storage = LocalHistoryStorage(settings, current_file_path)
-    changes = await run_in_executor(partial(local_history_storage.get_changes))
-    local_history_changes = OrderedDict()
-    index = 1
-    for change in changes:
-        local_history_changes[index] = change
-        index = index + 1
 
-    graph = await run_in_executor(partial(build_graph_log, local_history_changes))
+async def _load_local_history(settings: Settings, current_buffer: Buffer, current_file_path: str,
+                              cancelled: Event) -> None:
+    # Runs outside of the plugin lock so that Neovim and the mappings stay responsive. The tree is rendered as soon as
+    # the metadata of the current history is read, then the preview, then the changes of the previous paths.
+    global _local_history_state
 
-    # Save the local history state
-    _local_history_state = LocalHistoryState(current_buffer, local_history_changes)
+    try:
+        with timed('toggle.total'):
+            await run_in_executor(partial(create_folder_if_not_present, settings.path))
+            local_history_storage = LocalHistoryStorage(settings, current_file_path)
+            with timed('toggle.get_changes'):
+                changes = await run_in_executor(partial(_read_changes, local_history_storage.get_changes(False),
+                                                        cancelled))
+            state = LocalHistoryState(current_buffer, OrderedDict(), BufferLines(-1, [], False), [])
+            _local_history_state = state
+            if not await _render_loaded_tree(state, changes):
+                return
+            await _update_local_history_preview(settings)
+
+            with timed('toggle.get_linked_changes'):
+                linked_changes = await run_in_executor(partial(_read_changes,
+                                                               local_history_storage.get_linked_changes(False),
+                                                               cancelled))
+            if linked_changes and _local_history_state is state:
+                # Older than the current ones, the revision under the cursor stays on the same line
+                if not await _render_loaded_tree(state, linked_changes + list(state.changes.values())):
+                    return
+    except CancelledError:
+        count('toggle.cancelled')
+        raise
+    except Exception as e:
+        log.exception('[vim-local-history] Loading the local history failed: %s', str(e))
+        return
 
-    await async_call(partial(_render_local_history_tree, graph))
-    await async_call(_render_local_history_preview)
+    _start_change_stats_backfill(settings, list(state.changes.values()))
+
+
+async def _render_loaded_tree(state: LocalHistoryState, changes: List[LocalHistoryChange]) -> bool:
+    # False once the local history windows are closed or toggled again
+    numbered_changes = OrderedDict(enumerate(changes, 1))
+    with timed('toggle.build_graph'):
+        graph = await run_in_executor(partial(build_graph_log, numbered_changes, set(state.marks)))
+
+    def _render() -> bool:
+        if _local_history_state is not state or find_window_and_buffer_by_file_type(_LOCAL_HISTORY_FILE_TYPE) is None:
+            return False
+        # The changes are numbered again along with the tree, the number under the cursor always matches them
+        state.changes.clear()
+        state.changes.update(numbered_changes)
+        _render_local_history_tree(graph)
+        return True
+
+    with timed('toggle.render'):
+        return await async_call(_render)
+
+
+def _read_changes(changes: Iterator[LocalHistoryChange], cancelled: Event) -> List[LocalHistoryChange]:
+    # Cancelling the task only cancels the await, the read stops by itself and closing the generator releases the
+    # lock of the history
+    result = []
+    try:
+        for change in changes:
+            if cancelled.is_set():
+                count('toggle.read_cancelled')
+                break
+            result.append(change)
+    finally:
+        changes.close()
+
+    return result
+
+
+def _cancel_local_history_load() -> None:
+    _load_cancelled.set()
+    if _load_task is not None and not _load_task.done():
+        _load_task.cancel()
+
+
+async def local_history_wait_for_load() -> None:
+    if _load_task is not None and not _load_task.done():
+        await wait([_load_task])
+
+
+def local_history_window_closed_event(file_type: str) -> None:
+    # Closing the tree window by hand stops the loading as a toggle or a quit does
+    if file_type == _LOCAL_HISTORY_FILE_TYPE:
+        _cancel_local_history_load()
+
+
+def _start_change_stats_backfill(settings: Settings, changes: Sequence[LocalHistoryChange]) -> None:
+    # Statistics of the changes saved before they were stored are computed once, after the tree is shown
+    global _backfill_task
+
+    names = sorted({change.local_history_name for change in changes if change.added is None or change.size is None})
+    if not names or (_backfill_task is not None and not _backfill_task.done()):
+        return
+    state = _local_history_state
+
+    def _backfill() -> dict:
+        stats = {}
+        for name in names:
+            for record_id, record_stats in LocalHistoryStorage(settings, '', name).backfill_change_stats().items():
+                stats[(name, record_id)] = record_stats
+        return stats
+
+    async def _run_backfill() -> None:
+        # Runs outside of the plugin lock so that saves are not delayed
+        try:
+            with timed('backfill.total'):
+                stats = await run_in_executor(_backfill)
+        except Exception as e:
+            log.exception('[vim-local-history] Computing change statistics failed: %s', str(e))
+            return
+        if not stats or _local_history_state is not state:
+            return
+
+        for index, change in state.changes.items():
+            record_stats = stats.get(change.key)
+            if record_stats is not None:
+                added, removed, size = record_stats
+                state.changes[index] = replace(change, added=added, removed=removed, size=size)
+        # The global state may be reset by a toggle or a quit in the meantime
+        graph = await run_in_executor(partial(build_graph_log, state.changes, set(state.marks)))
+
+        def _render() -> None:
+            if _local_history_state is not state:
+                return
+            if find_window_and_buffer_by_file_type(_LOCAL_HISTORY_FILE_TYPE) is not None:
+                _render_local_history_tree(graph)
+
+        await async_call(_render)
+
+    _backfill_task = get_running_loop().create_task(_run_backfill())
+
+
+async def local_history_stats(settings: Settings, reset: bool) -> None:
+    stats = get_stats()
+    if reset:
+        reset_stats()
+
+    if settings.stats_file:
+        await run_in_executor(partial(dump_stats, stats, settings.stats_file))
+
+    lines = format_stats(stats)
+    if not stats['timers'] and not stats['counters']:
+        lines = ['[vim-local-history] No statistics recorded yet']
+    backend = await run_in_executor(partial(get_dbm_backend, settings.backend))
+    lines.extend(['', '%-32s %s' % ('dbm backend', backend)])
+    await async_call(partial(echo, lines))
+
+
+async def local_history_profile(settings: Settings, output_path: str) -> None:
+    arm_capture(output_path)
+    log.info('[vim-local-history] The next local history operation will be profiled')
+
+
+async def local_history_verify(settings: Settings, quarantine: bool) -> None:
+    global _verify_task
+
+    if _verify_task is not None and not _verify_task.done():
+        log.info('[vim-local-history] Verification is already running')
+        return
+
+    def _scrub() -> list:
+        return list(scrub_local_histories(settings, [], quarantine, _VERIFY_JOBS, _VERIFY_THROTTLE, False))
+
+    async def _verify() -> None:
+        # Runs outside of the plugin lock so that saves are not delayed by the verification
+        try:
+            with timed('verify.total'):
+                results = await run_in_executor(_scrub)
+        except Exception as e:
+            log.exception('[vim-local-history] Verification failed: %s', str(e))
+            return
+
+        lines = []
+        for result in results:
+            if result.error:
+                lines.append('%s: %s' % (result.file_path or result.name, result.error))
+            for key, reason in result.corrupt:
+                lines.append('%s record %s: %s' % (result.file_path or result.name, key, reason))
+        corrupt_histories = sum(1 for result in results if result.corrupt or result.error)
+        lines.append('[vim-local-history] %d histories verified, %d corrupt, %d records quarantined' %
+                     (len(results), corrupt_histories, sum(result.quarantined for result in results)))
+        if corrupt_histories and not quarantine:
+            lines.append('[vim-local-history] Run :LocalHistoryVerify! to quarantine corrupt records')
+        await async_call(partial(echo, lines))
+
+    if settings.show_info_messages:
+        log.info('[vim-local-history] Verifying local history in the background')
+    _verify_task = get_running_loop().create_task(_verify())
+
+
+async def local_history_restore_at(settings: Settings, time_value: str, apply: bool) -> None:
+    try:
+        timestamp = parse_timestamp(time_value)
+    except ValueError:
+        log.error('[vim-local-history] Invalid time: %s', time_value)
+        return
+
+    modified_file_paths = await async_call(get_modified_buffer_names)
+
+    def _restore() -> list:
+        return list(
+            restore_local_histories(settings, timestamp, os.getcwd(), apply, modified_file_paths, _RESTORE_JOBS,
+                                    False))
+
+    with timed('restore_at.total'):
+        results = await run_in_executor(_restore)
+
+    restore_time = time.strftime(_RESTORE_TIME_FMT, time.localtime(timestamp))
+    items = []
+    for result in results:
+        if result.status == 'failed':
+            text = 'Restore failed: %s' % result.error
+        elif result.status == 'modified':
+            text = 'Skipped, the buffer has unsaved changes'
+        elif result.status in ('changed', 'restored'):
+            text = '%s revision of %s: +%d -%d' % ('Restored' if apply else 'Differs from the', time.strftime(
+                _RESTORE_TIME_FMT, time.localtime(result.timestamp)), result.added, result.removed)
+        else:
+            continue
+        items.append({'filename': result.file_path, 'lnum': 1, 'text': text})
+    items.sort(key=lambda item: item['filename'])
+
+    def _show_results() -> None:
+        set_quickfix_list('Local history at %s' % restore_time, items)
+        if apply:
+            # Reload the restored files which are open
+            command('checktime')
+        if items:
+            command('copen')
+
+    await async_call(_show_results)
+    restored = sum(1 for result in results if result.status == 'restored')
+    changed = sum(1 for result in results if result.status in ('changed', 'restored'))
+    if apply:
+        log.info('[vim-local-history] %d files restored to %s', restored, restore_time)
+    elif changed:
+        log.info('[vim-local-history] %d files differ from %s, run :LocalHistoryRestoreAt! to restore them', changed,
+                 restore_time)
+    else:
+        log.info('[vim-local-history] No file differs from %s', restore_time)
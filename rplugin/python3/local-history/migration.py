@@ -0,0 +1,164 @@
+import dbm
+import hashlib
+import os
+import time
+from dataclasses import dataclass
+from typing import Tuple
+from .settings import Settings
+from .storage import (
+    LocalHistoryFile,
+    get_local_history_file_path,
+    get_local_history_files,
+    lock_local_history_file,
+    open_local_history_file,
+)
+from .utils import compress
+
+_MIGRATING_SUFFIX = '.migrating'
+
+_OLD_SUFFIX = '.old'
+
+# Records which files are being swapped so that an interrupted migration can be finished or rolled back
+_JOURNAL_SUFFIX = '.journal'
+
+_JOURNAL_MOVING_OLD = 'old'
+
+_JOURNAL_MOVING_NEW = 'new'
+
+
+@dataclass(frozen=True)
+class MigrationResult:
+    name: str
+    status: str
+    records: int
+    content_size: int
+    size_before: int
+    size_after: int
+    duration: float
+    error: str = ''
+
+
+def _get_size(local_history_file_path: str) -> int:
+    return sum(os.path.getsize(file_path) for file_path in get_local_history_files(local_history_file_path))
+
+
+def _rename(source_path: str, target_path: str) -> None:
+    for file_path in get_local_history_files(source_path):
+        os.replace(file_path, target_path + file_path[len(source_path):])
+
+
+def _remove(local_history_file_path: str) -> None:
+    for file_path in get_local_history_files(local_history_file_path):
+        os.remove(file_path)
+
+
+def _write_journal(local_history_file_path: str, state: str) -> None:
+    journal_file_path = local_history_file_path + _JOURNAL_SUFFIX
+    with open(journal_file_path + '.tmp', 'w') as file:
+        file.write(state)
+    os.replace(journal_file_path + '.tmp', journal_file_path)
+
+
+def _read_journal(local_history_file_path: str) -> str:
+    try:
+        with open(local_history_file_path + _JOURNAL_SUFFIX, 'r') as file:
+            return file.read()
+    except FileNotFoundError:
+        return ''
+
+
+def _swap(local_history_file_path: str) -> None:
+    old_file_path = local_history_file_path + _OLD_SUFFIX
+    _write_journal(local_history_file_path, _JOURNAL_MOVING_OLD)
+    _rename(local_history_file_path, old_file_path)
+    _write_journal(local_history_file_path, _JOURNAL_MOVING_NEW)
+    _rename(local_history_file_path + _MIGRATING_SUFFIX, local_history_file_path)
+    _remove(old_file_path)
+    os.remove(local_history_file_path + _JOURNAL_SUFFIX)
+
+
+def _recover(local_history_file_path: str) -> None:
+    old_file_path = local_history_file_path + _OLD_SUFFIX
+    migrating_file_path = local_history_file_path + _MIGRATING_SUFFIX
+    state = _read_journal(local_history_file_path)
+    if state == _JOURNAL_MOVING_NEW:
+        # The converted history was verified before the swap started, finish it
+        _rename(migrating_file_path, local_history_file_path)
+        _remove(old_file_path)
+    elif state == _JOURNAL_MOVING_OLD:
+        _rename(old_file_path, local_history_file_path)
+    _remove(migrating_file_path)
+    if state:
+        os.remove(local_history_file_path + _JOURNAL_SUFFIX)
+
+
+def _is_migrated(local_history_file: LocalHistoryFile, local_history_file_path: str, codec: str, backend: str) -> bool:
+    if backend and dbm.whichdb(local_history_file_path) != backend:
+        return False
+
+    # Converted records also get a checksum and are no longer pickled
+    for key in local_history_file:
+        if local_history_file.is_legacy(key):
+            return False
+        value = local_history_file.get_value(key, False)
+        if getattr(value, 'codec', codec) != codec or getattr(value, 'checksum', 0) is None:
+            return False
+
+    return True
+
+
+def _convert(local_history_file_path: str, codec: str, backend: str, verify: bool) -> Tuple[str, int, int]:
+    migrating_file_path = local_history_file_path + _MIGRATING_SUFFIX
+    # Digests of the decompressed content of every record, used to verify the converted history
+    digests = {}
+    content_size = 0
+    source = open_local_history_file(local_history_file_path, '', 'r')
+    try:
+        if _is_migrated(source, local_history_file_path, codec, backend):
+            return 'skipped', sum(1 for value in source.values() if hasattr(value, 'codec')), 0
+
+        target = open_local_history_file(migrating_file_path, backend or dbm.whichdb(local_history_file_path), 'n')
+        try:
+            for key in source.keys():
+                value = source[key]
+                if hasattr(value, 'codec'):
+                    content = value.get_content()
+                    content_size += len(content)
+                    digests[key] = hashlib.sha1(content.encode('utf-8')).digest()
+                    value.set_content(compress(content, codec) if value.codec != codec else value.content, codec)
+                target[key] = value
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+    if verify:
+        target = open_local_history_file(migrating_file_path, '', 'r')
+        try:
+            for key, digest in digests.items():
+                if hashlib.sha1(target[key].get_content().encode('utf-8')).digest() != digest:
+                    raise ValueError('Content of record %s differs after conversion' % key)
+        finally:
+            target.close()
+
+    _swap(local_history_file_path)
+
+    return 'migrated', len(digests), content_size
+
+
+def migrate_local_history(settings: Settings, name: str, codec: str, backend: str, verify: bool) -> MigrationResult:
+    local_history_file_path = get_local_history_file_path(settings.path, name)
+    start = time.perf_counter()
+    with lock_local_history_file(local_history_file_path):
+        size_before = 0
+        try:
+            _recover(local_history_file_path)
+            size_before = _get_size(local_history_file_path)
+            status, records, content_size = _convert(local_history_file_path, codec, backend, verify)
+        except Exception as e:
+            _recover(local_history_file_path)
+            return MigrationResult(name, 'failed', 0, 0, size_before, size_before, time.perf_counter() - start,
+                                   str(e))
+        size_after = _get_size(local_history_file_path)
+
+    return MigrationResult(name, status, records, content_size, size_before, size_after, time.perf_counter() - start)
@@ -3,6 +3,7 @@ from pynvim.api.common import NvimError
 from pynvim.api.window import Window
 from pynvim.api.buffer import Buffer
 from pynvim.api.tabpage import Tabpage
+import time
 from enum import Enum
 from asyncio import Future
 from os import linesep
@@ -17,9 +18,49 @@ from typing import (
     Optional,
     Dict,
 )
+from .profiler import profile_call, record
 
 T = TypeVar("T")
 
+# Buffer updates are sent under names of the plugin: the nvim_buf_*_event notifications of nvim_buf_attach() are shared
+# by every plugin of the python3 host. Each attach replaces the previous one of the buffer, the callbacks of a replaced
+# or detached attach detach themselves on the next update.
+_BUFFER_ATTACH_LUA = """
+local buffer, channel = ...
+local attaches = _G.local_history_buffer_attaches or {}
+_G.local_history_buffer_attaches = attaches
+local attach = {}
+attaches[buffer] = attach
+local function detached() return attaches[buffer] ~= attach end
+return vim.api.nvim_buf_attach(buffer, false, {
+    on_lines = function(_, _, changedtick, first_line, last_line, last_updated_line)
+        if detached() then return true end
+        vim.rpcnotify(channel, 'LocalHistory_buffer_lines_event', buffer, changedtick, first_line, last_line,
+                      vim.api.nvim_buf_get_lines(buffer, first_line, last_updated_line, true))
+    end,
+    on_changedtick = function(_, _, changedtick)
+        if detached() then return true end
+        vim.rpcnotify(channel, 'LocalHistory_buffer_changedtick_event', buffer, changedtick)
+    end,
+    on_reload = function()
+        -- The lines are not sent, they are read again after the next attach
+        if detached() then return end
+        attaches[buffer] = nil
+        vim.rpcnotify(channel, 'LocalHistory_buffer_detach_event', buffer)
+    end,
+    on_detach = function()
+        if detached() then return end
+        attaches[buffer] = nil
+        vim.rpcnotify(channel, 'LocalHistory_buffer_detach_event', buffer)
+    end,
+})
+"""
+
+_BUFFER_DETACH_LUA = """
+local buffer = ...
+if _G.local_history_buffer_attaches then _G.local_history_buffer_attaches[buffer] = nil end
+"""
+
 
 class WindowLayout(Enum):
     LEFT = 1
@@ -31,28 +72,36 @@ def init_nvim(nvim: Nvim) -> None:
     _nvim = nvim
 
 
-def call_atomic(*instructions: Tuple[str, Sequence[Any]]) -> None:
+def call_atomic(*instructions: Tuple[str, Sequence[Any]]) -> Sequence[Any]:
     inst = tuple((f"{instruction}", args) for instruction, args in instructions)
     out, error = _nvim.api.call_atomic(inst)
     if error:
         raise NvimError(error)
 
+    return out
+
 
 def async_call(func: Callable[[], T]) -> Awaitable[T]:
     future: Future = Future()
+    start = time.perf_counter()
 
     def run() -> None:
         try:
-            ret = func()
+            ret = profile_call(func)
         except Exception as e:
             future.set_exception(e)
         else:
             future.set_result(ret)
+        record('rpc.async_call', (time.perf_counter() - start) * 1000)
 
     _nvim.async_call(run)
     return future
 
 
+def echo(lines: Sequence[str]) -> None:
+    _nvim.out_write('\n'.join(lines) + '\n')
+
+
 def confirm(question: str) -> bool:
     return _nvim.funcs.confirm(question, "&Yes\n&No", 2) == 1
 
@@ -165,6 +214,22 @@ def get_line(buffer: Buffer, row: int) -> Optional[str]:
     return None if not lines else lines[0]
 
 
+def get_buffer_var(buffer: Buffer, name: str) -> Any:
+    return _nvim.api.buf_get_var(buffer, name)
+
+
+def buffer_attach(buffer: Buffer) -> bool:
+    return _nvim.exec_lua(_BUFFER_ATTACH_LUA, buffer, _nvim.channel_id)
+
+
+def buffer_detach(buffer: Buffer) -> None:
+    _nvim.exec_lua(_BUFFER_DETACH_LUA, buffer)
+
+
+def get_buffer_number(buffer: Buffer) -> int:
+    return buffer.number
+
+
 def get_buffer_option(buffer: Buffer, option: str) -> str:
     return _nvim.api.buf_get_option(buffer, option)
 
@@ -186,6 +251,35 @@ def find_window_and_buffer_by_file_type(file_type: str) -> Optional[Tuple[Window
     return None
 
 
+def find_window_by_buffer(buffer: Buffer) -> Optional[Window]:
+    for window in find_windows_in_tab():
+        if _nvim.api.win_get_buf(window) == buffer:
+            return window
+
+    return None
+
+
+def get_buffer(buffer_number: int) -> Optional[Buffer]:
+    try:
+        buffer: Buffer = _nvim.buffers[buffer_number]
+    except KeyError:
+        return None
+
+    return buffer if _nvim.api.buf_is_valid(buffer) else None
+
+
+def get_modified_buffer_names() -> Sequence[str]:
+    return [
+        _nvim.api.buf_get_name(buffer)
+        for buffer in _nvim.api.list_bufs()
+        if _nvim.api.buf_is_loaded(buffer) and _nvim.api.buf_get_option(buffer, "modified")
+    ]
+
+
+def set_quickfix_list(title: str, items: Sequence[Dict[str, Any]]) -> None:
+    _nvim.funcs.setqflist([], " ", {"title": title, "items": items})
+
+
 def get_current_buffer() -> Buffer:
     return _nvim.api.get_current_buf()
 
@@ -0,0 +1,213 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from bisect import bisect_left
+from threading import Lock, get_ident
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Upper bounds (in milliseconds) of the latency histogram buckets, the last bucket is unbounded
+_BUCKET_BOUNDS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_PROFILE_TOP_FUNCTIONS = 15
+
+
+class _Histogram:
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * (len(_BUCKET_BOUNDS) + 1)
+
+    def add(self, elapsed: float) -> None:
+        self.count += 1
+        self.total += elapsed
+        if elapsed < self.min:
+            self.min = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.buckets[bisect_left(_BUCKET_BOUNDS, elapsed)] += 1
+
+    def percentile(self, q: float) -> float:
+        # Approximated by the upper bound of the bucket which contains the q-th sample
+        rank = q * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank and bucket > 0:
+                return min(_BUCKET_BOUNDS[index], self.max) if index < len(_BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'total_ms': round(self.total, 3),
+            'avg_ms': round(self.total / self.count, 3) if self.count else 0,
+            'min_ms': round(self.min, 3) if self.count else 0,
+            'max_ms': round(self.max, 3),
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+        }
+
+
+class _Timer:
+    __slots__ = ('_name', '_start')
+
+    def __init__(self, name: str) -> None:
+        self._name = name
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(self, *args: Any) -> None:
+        record(self._name, (time.perf_counter() - self._start) * 1000)
+
+
+class _Capture:
+
+    def __init__(self, output_path: Optional[str]) -> None:
+        self.output_path = output_path
+        self.profiles: List[cProfile.Profile] = []
+        self.lock = Lock()
+        # Profile of the thread running the operation (the event loop), the other threads have one per call
+        self.thread_profile: Optional[cProfile.Profile] = None
+        self.thread_id: Optional[int] = None
+
+
+_lock = Lock()
+
+_histograms: Dict[str, _Histogram] = {}
+
+_counters: Dict[str, int] = {}
+
+_armed_capture: Optional[_Capture] = None
+
+_active_capture: Optional[_Capture] = None
+
+
+def timed(name: str) -> _Timer:
+    return _Timer(name)
+
+
+def record(name: str, elapsed: float) -> None:
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = _Histogram()
+        histogram.add(elapsed)
+
+
+def count(name: str, value: int = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def reset_stats() -> None:
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def get_stats() -> Dict[str, Any]:
+    with _lock:
+        return {
+            'timers': {name: histogram.to_dict() for name, histogram in _histograms.items()},
+            'counters': dict(_counters),
+        }
+
+
+def format_stats(stats: Dict[str, Any]) -> List[str]:
+    lines = ['%-32s %7s %10s %9s %9s %9s %9s' % ('stage', 'count', 'total ms', 'avg ms', 'p50 ms', 'p95 ms', 'max ms')]
+    for name, timer in sorted(stats['timers'].items()):
+        lines.append('%-32s %7d %10.1f %9.2f %9.2f %9.2f %9.2f' %
+                     (name, timer['count'], timer['total_ms'], timer['avg_ms'], timer['p50_ms'], timer['p95_ms'],
+                      timer['max_ms']))
+    if stats['counters']:
+        lines.append('')
+        for name, value in sorted(stats['counters'].items()):
+            lines.append('%-32s %7d' % (name, value))
+
+    return lines
+
+
+def dump_stats(stats: Dict[str, Any], file_path: str) -> None:
+    # Append one JSON object per metric so that consecutive dumps can be compared with line based tools
+    timestamp = time.time()
+    with open(file_path, 'a') as file:
+        for name, timer in sorted(stats['timers'].items()):
+            file.write(json.dumps(dict(timestamp=timestamp, type='timer', name=name, **timer)) + '\n')
+        for name, value in sorted(stats['counters'].items()):
+            file.write(json.dumps(dict(timestamp=timestamp, type='counter', name=name, value=value)) + '\n')
+
+
+def arm_capture(output_path: Optional[str]) -> None:
+    global _armed_capture
+    _armed_capture = _Capture(output_path)
+
+
+def start_capture() -> bool:
+    # Called by the thread running the operation, which is profiled until stop_capture(): on the event loop, the
+    # coroutines of the operation and everything else the loop runs in the meantime
+    global _armed_capture, _active_capture
+    if _armed_capture is None or _active_capture is not None:
+        return False
+    capture, _armed_capture = _armed_capture, None
+    capture.thread_profile = cProfile.Profile()
+    capture.thread_id = get_ident()
+    capture.profiles.append(capture.thread_profile)
+    _active_capture = capture
+    capture.thread_profile.enable()
+    return True
+
+
+def stop_capture() -> Optional[_Capture]:
+    # Called by the thread which started the capture
+    global _active_capture
+    capture, _active_capture = _active_capture, None
+    if capture is not None:
+        capture.thread_profile.disable()
+
+    return capture
+
+
+def write_capture(capture: Optional[_Capture], operation: str) -> Optional[List[str]]:
+    if capture is None or not capture.profiles:
+        return None
+
+    stream = io.StringIO()
+    stats = pstats.Stats(capture.profiles[0], stream=stream)
+    for profile in capture.profiles[1:]:
+        stats.add(profile)
+
+    output_path = capture.output_path
+    if not output_path:
+        output_path = os.path.join(os.getcwd(), 'local-history-%s-%d.prof' % (operation, int(time.time())))
+    stats.dump_stats(output_path)
+    stats.sort_stats('cumulative').print_stats(_PROFILE_TOP_FUNCTIONS)
+
+    return ['[vim-local-history] Profile of %s saved to %s' % (operation, output_path)] + stream.getvalue().splitlines()
+
+
+def profile_call(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    # Profiles are collected per thread because cProfile only traces the thread which enabled it, the thread running
+    # the operation is already traced
+    capture = _active_capture
+    if capture is None or capture.thread_id == get_ident():
+        return func(*args, **kwargs)
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.disable()
+        with capture.lock:
+            capture.profiles.append(profile)
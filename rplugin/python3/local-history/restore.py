@@ -0,0 +1,109 @@
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Sequence, Tuple
+from .settings import Settings
+from .storage import LocalHistoryStorage, find_local_history_names, flush_similarity_indexes
+from .timeline import get_timeline, needs_rebuild, write_timeline
+from .utils import diff, get_file_content, parallel_map
+
+
+@dataclass(frozen=True)
+class RestoreResult:
+    name: str
+    file_path: str
+    # 'restored' (or 'changed' when only previewed), 'unchanged', 'modified' (skipped because the file is being
+    # edited), 'outside' (not in the restored folder), 'missing' (no revision before the timestamp) or 'failed'
+    status: str
+    timestamp: float = 0
+    added: int = 0
+    removed: int = 0
+    error: str = ''
+
+
+def _read_timeline_entries(item: Tuple[Settings, str]) -> List[Tuple[float, str, int]]:
+    settings, name = item
+    return [(record.timestamp, name, record.record_id)
+            for record in LocalHistoryStorage(settings, '', name).get_records(with_content=False)
+            if not record.unsaved]
+
+
+def rebuild_timeline(settings: Settings, jobs: int, processes: bool = True) -> None:
+    since = time.time()
+    items = [(settings, name) for name in find_local_history_names(settings)]
+    entries = []
+    for history_entries in parallel_map(_read_timeline_entries, items, jobs, processes=processes):
+        entries.extend(history_entries)
+    write_timeline(settings.path, entries, since)
+
+
+def _count_changes(current_content: str, content: str) -> Tuple[int, int]:
+    added = removed = 0
+    for line in diff(current_content.splitlines(), content.splitlines())[2:]:
+        if line.startswith('+'):
+            added += 1
+        elif line.startswith('-'):
+            removed += 1
+
+    return added, removed
+
+
+def _write_file(file_path: str, content: str) -> None:
+    # Replace the file at once so that a failed restore never leaves a truncated file behind
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_file_path = '%s.local-history-%d' % (file_path, os.getpid())
+    with open(temp_file_path, 'w') as file:
+        file.write(content)
+    if os.path.exists(file_path):
+        shutil.copymode(file_path, temp_file_path)
+    os.replace(temp_file_path, file_path)
+
+
+def _restore_local_history(item: Tuple[Settings, str, Optional[int], float, str, bool, frozenset]) -> RestoreResult:
+    settings, name, record_id, timestamp, root, apply, skipped_paths = item
+    local_history_storage = LocalHistoryStorage(settings, '', name)
+    header = local_history_storage.get_header()
+    file_path = header.file_path if header is not None else ''
+    if not file_path or not file_path.startswith(root.rstrip(os.sep) + os.sep):
+        return RestoreResult(name, file_path, 'outside')
+
+    if record_id is None:
+        # Created after the timestamp, the timeline has no revision of it before
+        return RestoreResult(name, file_path, 'missing')
+
+    try:
+        record = local_history_storage.find_record(timestamp, record_id)
+        if record is None:
+            return RestoreResult(name, file_path, 'missing')
+        content = record.get_content()
+        current_content = get_file_content(file_path) if os.path.isfile(file_path) else ''
+        if content == current_content:
+            return RestoreResult(name, file_path, 'unchanged', record.timestamp)
+        added, removed = _count_changes(current_content, content)
+        if file_path in skipped_paths:
+            return RestoreResult(name, file_path, 'modified', record.timestamp, added, removed)
+        if not apply:
+            return RestoreResult(name, file_path, 'changed', record.timestamp, added, removed)
+
+        # Keep the content which is overwritten so that the restore can be undone, in a change of its own so that the
+        # revisions saved within g:local_history_new_change_delay (maybe the restored one) are not overwritten
+        LocalHistoryStorage(settings, file_path, name).save_record(current_content, new_change=True)
+        _write_file(file_path, content)
+        flush_similarity_indexes()
+    except Exception as e:
+        return RestoreResult(name, file_path, 'failed', error=str(e))
+
+    return RestoreResult(name, file_path, 'restored', record.timestamp, added, removed)
+
+
+def restore_local_histories(settings: Settings, timestamp: float, root: str, apply: bool, skipped_paths: Sequence[str],
+                            jobs: int, processes: bool = True) -> Iterator[RestoreResult]:
+    if needs_rebuild(settings.path):
+        rebuild_timeline(settings, jobs, processes)
+    timeline = get_timeline(settings.path)
+
+    # Files created after the timestamp are reported as missing and left untouched
+    items = [(settings, name, timeline.find(name, timestamp), timestamp, root, apply, frozenset(skipped_paths))
+             for name in timeline.get_names()]
+    return parallel_map(_restore_local_history, items, jobs, processes=processes)
@@ -0,0 +1,187 @@
+import dbm
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Sequence, Set, Tuple
+from .settings import Settings
+from .storage import (
+    LocalHistoryFile,
+    LocalHistoryRecord,
+    LocalHistoryRecordHeader,
+    find_local_history_names,
+    get_local_history_file_path,
+    lock_local_history_file,
+    open_local_history_file,
+)
+from .utils import parallel_map
+
+_QUARANTINE_FOLDER = 'quarantine'
+
+_HEADER_KEY = 'header'
+
+_NO_RECORD = 0
+
+# Niceness of the scrub worker processes when throttled
+_THROTTLED_NICENESS = 10
+
+
+@dataclass(frozen=True)
+class ScrubResult:
+    name: str
+    file_path: str
+    records: int
+    # (key, reason) of every corrupt record
+    corrupt: List[Tuple[str, str]]
+    quarantined: int
+    error: str = ''
+
+
+def _check_record(value: object) -> str:
+    if not isinstance(value, LocalHistoryRecord):
+        return 'unexpected value %s' % type(value).__name__
+    if not value.is_intact():
+        return 'checksum mismatch'
+    try:
+        value.get_content()
+    except Exception as e:
+        return 'cannot decompress: %s' % str(e)
+
+    return ''
+
+
+def _check_links(header: LocalHistoryRecordHeader, records: Dict[int, LocalHistoryRecord]) -> List[str]:
+    record_ids = sorted(records.keys())
+    expected_previous = dict(zip(record_ids, [_NO_RECORD] + record_ids[:-1]))
+    expected_next = dict(zip(record_ids, record_ids[1:] + [_NO_RECORD]))
+    problems = []
+    if header.num_records != len(record_ids):
+        problems.append('header counts %d records instead of %d' % (header.num_records, len(record_ids)))
+    if record_ids and (header.first_record_id != record_ids[0] or header.last_record_id != record_ids[-1]):
+        problems.append('header points to missing records')
+    for record_id, record in records.items():
+        if record.previous_record_id != expected_previous[record_id] or record.next_record_id != expected_next[
+                record_id]:
+            problems.append('record %d is not linked to its neighbours' % record_id)
+
+    return problems
+
+
+def _relink(local_history_file: Dict, header: LocalHistoryRecordHeader, records: Dict[int,
+                                                                                      LocalHistoryRecord]) -> None:
+    record_ids = sorted(records.keys())
+    for index, record_id in enumerate(record_ids):
+        record = records[record_id]
+        previous_record_id = record_ids[index - 1] if index > 0 else _NO_RECORD
+        next_record_id = record_ids[index + 1] if index + 1 < len(record_ids) else _NO_RECORD
+        if record.previous_record_id != previous_record_id or record.next_record_id != next_record_id:
+            record.previous_record_id = previous_record_id
+            record.next_record_id = next_record_id
+            local_history_file[str(record_id)] = record
+
+    header.num_records = len(record_ids)
+    header.first_record_id = record_ids[0] if record_ids else _NO_RECORD
+    header.last_record_id = record_ids[-1] if record_ids else _NO_RECORD
+    local_history_file[_HEADER_KEY] = header
+
+
+def _get_referenced_content_keys(local_history_file: LocalHistoryFile) -> Set[str]:
+    # Also the contents of the corrupt records, which are quarantined with them
+    content_keys = set()
+    for key in local_history_file:
+        if key == _HEADER_KEY:
+            continue
+        try:
+            content_keys.add(local_history_file.get_value(key, False).content_key)
+        except Exception:
+            continue
+
+    return content_keys
+
+
+def scrub_local_history(settings: Settings, name: str, quarantine: bool) -> ScrubResult:
+    local_history_file_path = get_local_history_file_path(settings.path, name)
+    with lock_local_history_file(local_history_file_path):
+        try:
+            local_history_file = open_local_history_file(local_history_file_path, '', 'w' if quarantine else 'r')
+        except dbm.error as e:
+            return ScrubResult(name, '', 0, [], 0, str(e))
+
+        try:
+            corrupt = []
+            records = {}
+            header = None
+            for key in local_history_file.keys():
+                try:
+                    value = local_history_file[key]
+                except Exception as e:
+                    corrupt.append((key, 'cannot load: %s' % str(e)))
+                    continue
+                if key == _HEADER_KEY:
+                    if isinstance(value, LocalHistoryRecordHeader):
+                        header = value
+                    else:
+                        corrupt.append((key, 'unexpected value %s' % type(value).__name__))
+                    continue
+                reason = _check_record(value)
+                if reason:
+                    corrupt.append((key, reason))
+                else:
+                    records[value.record_id] = value
+
+            # Left behind by an interrupted write
+            referenced_content_keys = _get_referenced_content_keys(local_history_file)
+            corrupt.extend((key, 'content of no record')
+                           for key in local_history_file.get_content_keys()
+                           if key not in referenced_content_keys)
+
+            if header is None:
+                header = LocalHistoryRecordHeader(_NO_RECORD, _NO_RECORD, _NO_RECORD)
+                if records and not any(key == _HEADER_KEY for key, _ in corrupt):
+                    corrupt.append((_HEADER_KEY, 'missing'))
+            corrupt.extend((_HEADER_KEY, problem) for problem in _check_links(header, records))
+
+            quarantined = 0
+            if quarantine and corrupt:
+                quarantine_folder = os.path.join(settings.path, _QUARANTINE_FOLDER)
+                os.makedirs(quarantine_folder, exist_ok=True)
+                # Keep the raw bytes of corrupt records so that they can still be inspected or repaired by hand
+                with dbm.open(os.path.join(quarantine_folder, name), 'c') as quarantine_file:
+                    for key, _ in corrupt:
+                        raw_items = local_history_file.get_raw_items(key) if key != _HEADER_KEY else []
+                        if not raw_items:
+                            continue
+                        for raw_key, raw_value in raw_items:
+                            quarantine_file[raw_key] = raw_value
+                        del local_history_file[key]
+                        quarantined += 1
+                _relink(local_history_file, header, records)
+
+            return ScrubResult(name, header.file_path, len(records), corrupt, quarantined)
+        finally:
+            local_history_file.close()
+
+
+def _scrub_local_history(item: Tuple[Settings, str, bool, float]) -> ScrubResult:
+    settings, name, quarantine, throttle = item
+    result = scrub_local_history(settings, name, quarantine)
+    if throttle > 0:
+        # Pause outside of the history lock so that saves are never blocked by the scrub
+        time.sleep(throttle)
+
+    return result
+
+
+def _init_throttled_worker(throttle: float) -> None:
+    # Never lower the priority of the calling process (Neovim plugin host, command line tool)
+    if throttle > 0 and hasattr(os, 'nice') and multiprocessing.current_process().name != 'MainProcess':
+        os.nice(_THROTTLED_NICENESS)
+
+
+def scrub_local_histories(settings: Settings, names: Sequence[str], quarantine: bool, jobs: int, throttle: float,
+                          processes: bool = True) -> Iterator[ScrubResult]:
+    if not names:
+        names = find_local_history_names(settings)
+
+    items = [(settings, name, quarantine, throttle) for name in names]
+    return parallel_map(_scrub_local_history, items, jobs, _init_throttled_worker, (throttle,), processes)
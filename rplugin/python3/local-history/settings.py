@@ -5,6 +5,7 @@ from dataclasses import dataclass
 from functools import partial
 from typing import Dict
 from .nvim import get_global_var, async_call
+from .utils import CODECS, DEFAULT_CODEC
 
 
 class LocalHistoryEnabled(Enum):
@@ -23,12 +24,32 @@ _DEFAULT_LOCAL_HISTORY_MAX_CHANGES = 100
 
 _DEFAULT_LOCAL_HISTORY_NEW_CHANGE_DELAY = 300
 
+# Estimated number of changed lines above which a save always starts a new change (0: merge by time only)
+_DEFAULT_LOCAL_HISTORY_COALESCE_MAX_LINES = 20
+
 _DEFAULT_LOCAL_HISTORY_WIDTH = 45
 
 _DEFAULT_LOCAL_HISTORY_PREVIEW_HEIGHT = 15
 
 _DEFAULT_LOCAL_HISTORY_EXCLUDE = []
 
+_DEFAULT_LOCAL_HISTORY_USE_IGNORE_FILES = False
+
+_DEFAULT_LOCAL_HISTORY_STATS_FILE = ''
+
+_DEFAULT_LOCAL_HISTORY_UNSAVED_SNAPSHOTS = False
+
+_DEFAULT_LOCAL_HISTORY_UNSAVED_SNAPSHOT_INTERVAL = 60
+
+_DEFAULT_LOCAL_HISTORY_CODEC = DEFAULT_CODEC
+
+_DEFAULT_LOCAL_HISTORY_TRACK_RENAMES = True
+
+# Empty to let dbm pick the implementation
+_DEFAULT_LOCAL_HISTORY_BACKEND = ''
+
+_DEFAULT_LOCAL_HISTORY_WATCH = False
+
 _DEFAULT_LOCAL_HISTORY_MAPPINGS = {
     'quit': ['q'],
     'move_older': ['j', '<down>'],
@@ -37,6 +58,7 @@ _DEFAULT_LOCAL_HISTORY_MAPPINGS = {
     'move_newest': ['gg'],
     'revert': ['<CR>'],
     'diff': ['r'],
+    'mark': ['m'],
     'delete': ['d'],
     'bigger': ['L'],
     'smaller': ['H'],
@@ -52,10 +74,19 @@ class Settings:
     show_info_messages: bool
     max_changes: int
     new_change_delay: int
+    coalesce_max_lines: int
     width: int
     preview_height: int
     exclude: list
+    use_ignore_files: bool
     mappings: Dict
+    stats_file: str
+    unsaved_snapshots: bool
+    unsaved_snapshot_interval: int
+    codec: str
+    backend: str
+    track_renames: bool
+    watch: bool
 
 
 async def load_settings() -> Settings:
@@ -76,19 +107,66 @@ async def load_settings() -> Settings:
         partial(get_global_var, 'local_history_max_changes', _DEFAULT_LOCAL_HISTORY_MAX_CHANGES))
     new_change_delay = await async_call(
         partial(get_global_var, 'local_history_new_change_delay', _DEFAULT_LOCAL_HISTORY_NEW_CHANGE_DELAY))
+    coalesce_max_lines = await async_call(
+        partial(get_global_var, 'local_history_coalesce_max_lines', _DEFAULT_LOCAL_HISTORY_COALESCE_MAX_LINES))
     width = await async_call(partial(get_global_var, 'local_history_width', _DEFAULT_LOCAL_HISTORY_WIDTH))
     preview_height = await async_call(
         partial(get_global_var, 'local_history_preview_height', _DEFAULT_LOCAL_HISTORY_PREVIEW_HEIGHT))
     exclude = await async_call(partial(get_global_var, 'local_history_exclude', _DEFAULT_LOCAL_HISTORY_EXCLUDE))
+    use_ignore_files = await async_call(
+        partial(get_global_var, 'local_history_use_ignore_files', _DEFAULT_LOCAL_HISTORY_USE_IGNORE_FILES))
     mappings = await async_call(partial(get_global_var, 'local_history_mappings', _DEFAULT_LOCAL_HISTORY_MAPPINGS))
     mappings = {f"LocalHistory_{function}": mappings for function, mappings in mappings.items()}
+    stats_file = await async_call(
+        partial(get_global_var, 'local_history_stats_file', _DEFAULT_LOCAL_HISTORY_STATS_FILE))
+    unsaved_snapshots = await async_call(
+        partial(get_global_var, 'local_history_unsaved_snapshots', _DEFAULT_LOCAL_HISTORY_UNSAVED_SNAPSHOTS))
+    unsaved_snapshot_interval = await async_call(
+        partial(get_global_var, 'local_history_unsaved_snapshot_interval',
+                _DEFAULT_LOCAL_HISTORY_UNSAVED_SNAPSHOT_INTERVAL))
+    codec = await async_call(partial(get_global_var, 'local_history_codec', _DEFAULT_LOCAL_HISTORY_CODEC))
+    backend = await async_call(partial(get_global_var, 'local_history_backend', _DEFAULT_LOCAL_HISTORY_BACKEND))
+    track_renames = await async_call(
+        partial(get_global_var, 'local_history_track_renames', _DEFAULT_LOCAL_HISTORY_TRACK_RENAMES))
+    watch = await async_call(partial(get_global_var, 'local_history_watch', _DEFAULT_LOCAL_HISTORY_WATCH))
 
     return Settings(enabled=enabled,
                     path=path,
                     show_info_messages=show_info_messages,
                     max_changes=max(1, max_changes),
                     new_change_delay=max(0, new_change_delay),
+                    coalesce_max_lines=max(0, coalesce_max_lines),
                     width=max(1, width),
                     preview_height=max(1, preview_height),
                     exclude=exclude,
-                    mappings=mappings)
+                    use_ignore_files=bool(use_ignore_files),
+                    mappings=mappings,
+                    stats_file=os.path.expanduser(stats_file) if stats_file else stats_file,
+                    unsaved_snapshots=bool(unsaved_snapshots),
+                    unsaved_snapshot_interval=max(0, unsaved_snapshot_interval),
+                    codec=codec if codec in CODECS else _DEFAULT_LOCAL_HISTORY_CODEC,
+                    backend=backend,
+                    track_renames=bool(track_renames),
+                    watch=bool(watch))
+
+
+def default_settings(path: str) -> Settings:
+    # Settings used outside of Neovim (e.g. by the command line tool)
+    return Settings(enabled=LocalHistoryEnabled(_DEFAULT_LOCAL_HISTORY_ENABLED),
+                    path=os.path.abspath(os.path.expanduser(path)),
+                    show_info_messages=_DEFAULT_LOCAL_HISTORY_SHOW_INFO_MESSAGES,
+                    max_changes=_DEFAULT_LOCAL_HISTORY_MAX_CHANGES,
+                    new_change_delay=_DEFAULT_LOCAL_HISTORY_NEW_CHANGE_DELAY,
+                    coalesce_max_lines=_DEFAULT_LOCAL_HISTORY_COALESCE_MAX_LINES,
+                    width=_DEFAULT_LOCAL_HISTORY_WIDTH,
+                    preview_height=_DEFAULT_LOCAL_HISTORY_PREVIEW_HEIGHT,
+                    exclude=_DEFAULT_LOCAL_HISTORY_EXCLUDE,
+                    use_ignore_files=_DEFAULT_LOCAL_HISTORY_USE_IGNORE_FILES,
+                    mappings=_DEFAULT_LOCAL_HISTORY_MAPPINGS,
+                    stats_file=_DEFAULT_LOCAL_HISTORY_STATS_FILE,
+                    unsaved_snapshots=_DEFAULT_LOCAL_HISTORY_UNSAVED_SNAPSHOTS,
+                    unsaved_snapshot_interval=_DEFAULT_LOCAL_HISTORY_UNSAVED_SNAPSHOT_INTERVAL,
+                    codec=_DEFAULT_LOCAL_HISTORY_CODEC,
+                    backend=_DEFAULT_LOCAL_HISTORY_BACKEND,
+                    track_renames=_DEFAULT_LOCAL_HISTORY_TRACK_RENAMES,
+                    watch=_DEFAULT_LOCAL_HISTORY_WATCH)
@@ -0,0 +1,251 @@
+import os
+import zlib
+from array import array
+from hashlib import sha1
+from threading import Lock
+from typing import AbstractSet, Dict, List, Optional, Sequence, Set, Tuple
+from .utils import lock_file
+
+# Latest revision of every history, indexed by content hash and by MinHash signature (banded for LSH). Saves append
+# one "<history name>\t<content hash>\t<signature>" line, the last line of a history wins and an empty hash removes it
+_SIMILARITY_INDEX_FILE_NAME = 'similarity'
+
+# First line of an index which covers every history, indexes without it are rebuilt from the histories
+_SIMILARITY_INDEX_HEADER = 'local-history-similarity\t1\n'
+
+# Indexes are compacted (only the last line of every history is kept) when they grow over this size
+_MAX_SIMILARITY_INDEX_SIZE = 8 * 1024 * 1024
+
+# One permutation MinHash: the hash of every line falls in one of the bins, the minimum of each bin is kept
+_SIGNATURE_BINS = 64
+
+_BANDS = 16
+
+_ROWS_PER_BAND = _SIGNATURE_BINS // _BANDS
+
+_EMPTY_BIN = 0xffffffff
+
+# Line hashes kept in the sketch of a revision, lines are sampled by hash beyond it
+_MAX_SKETCH_LINES = 2048
+
+_similarity_indexes: Dict[str, 'SimilarityIndex'] = {}
+
+_similarity_indexes_lock = Lock()
+
+
+class SimilarityIndex:
+
+    def __init__(self, similarity_index_file_path: str) -> None:
+        self._similarity_index_file_path = similarity_index_file_path
+        self._reset(None)
+
+    @property
+    def complete(self) -> bool:
+        return self._complete
+
+    @property
+    def offset(self) -> int:
+        return self._offset
+
+    def refresh(self) -> None:
+        try:
+            file = open(self._similarity_index_file_path, 'rb')
+        except FileNotFoundError:
+            self._reset(None)
+            return
+
+        with file:
+            file_stat = os.fstat(file.fileno())
+            if file_stat.st_ino != self._inode or file_stat.st_size < self._offset:
+                # Compacted in the meantime
+                self._reset(file_stat.st_ino)
+            file.seek(self._offset)
+            data = file.read()
+
+        # A line which is being appended is read on the next refresh
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        for line in data[:end].decode('utf-8', 'replace').splitlines(True):
+            if line == _SIMILARITY_INDEX_HEADER:
+                self._complete = True
+                continue
+            entry = _parse_entry(line)
+            if entry is not None:
+                self._set(*entry)
+
+    def find(self, content: str, threshold: float) -> List[Tuple[str, float]]:
+        # Histories whose latest revision is identical (similarity 1) or similar to the content, most similar first
+        signature = get_signature(content)
+        candidates = {name: 1.0 for name in self._contents.get(get_content_hash(content), ())}
+        for band_key in _get_band_keys(signature):
+            for name in self._bands.get(band_key, ()):
+                if name not in candidates:
+                    candidates[name] = estimate_similarity(signature, self._signatures[name][1])
+
+        return sorted(((name, similarity) for name, similarity in candidates.items() if similarity >= threshold),
+                      key=lambda candidate: -candidate[1])
+
+    def _reset(self, inode: Optional[int]) -> None:
+        self._complete = False
+        self._offset = 0
+        self._inode = inode
+        self._signatures: Dict[str, Tuple[str, Tuple[int, ...]]] = {}
+        self._contents: Dict[str, Set[str]] = {}
+        self._bands: Dict[Tuple[int, Tuple[int, ...]], Set[str]] = {}
+
+    def _set(self, name: str, content_hash: str, signature: Tuple[int, ...]) -> None:
+        previous = self._signatures.pop(name, None)
+        if previous is not None:
+            self._contents[previous[0]].discard(name)
+            for band_key in _get_band_keys(previous[1]):
+                self._bands[band_key].discard(name)
+        if not content_hash:
+            return
+
+        self._signatures[name] = (content_hash, signature)
+        self._contents.setdefault(content_hash, set()).add(name)
+        for band_key in _get_band_keys(signature):
+            self._bands.setdefault(band_key, set()).add(name)
+
+
+def get_content_hash(content: str) -> str:
+    return sha1(content.encode('utf-8')).hexdigest()
+
+
+def get_signature(content: str) -> Tuple[int, ...]:
+    signature = [_EMPTY_BIN] * _SIGNATURE_BINS
+    for line in set(content.splitlines()):
+        line = line.strip()
+        if not line:
+            continue
+        line_hash = zlib.crc32(line.encode('utf-8'))
+        index = line_hash % _SIGNATURE_BINS
+        value = line_hash // _SIGNATURE_BINS
+        if value < signature[index]:
+            signature[index] = value
+
+    # Empty bins borrow the value of the next filled bin so that signatures stay comparable
+    filled = [index for index, value in enumerate(signature) if value != _EMPTY_BIN]
+    if not filled:
+        return tuple(signature)
+    for index in range(_SIGNATURE_BINS):
+        if signature[index] == _EMPTY_BIN:
+            next_index = next((filled_index for filled_index in filled if filled_index > index), filled[0])
+            signature[index] = signature[next_index] + (next_index - index) % _SIGNATURE_BINS * _EMPTY_BIN
+
+    return tuple(signature)
+
+
+def get_line_hashes(content: str) -> Set[int]:
+    return {zlib.crc32(line.encode('utf-8')) for line in content.splitlines()}
+
+
+def get_line_sketch(line_hashes: AbstractSet[int]) -> Tuple[int, bytes]:
+    # Sampling rate and hashes of the sampled lines (every line when the rate is 1)
+    rate = 1
+    while len(line_hashes) // rate > _MAX_SKETCH_LINES:
+        rate *= 2
+    sampled = sorted(line_hash for line_hash in line_hashes if line_hash % rate == 0)
+
+    return rate, array('I', sampled).tobytes()
+
+
+def estimate_changed_lines(rate: int, sketch: bytes, line_hashes: AbstractSet[int]) -> int:
+    # Lines which are only in the content or only in the sketched content, duplicates and moves are not counted
+    sketched = array('I')
+    sketched.frombytes(sketch)
+    sampled = {line_hash for line_hash in line_hashes if line_hash % rate == 0}
+
+    return len(sampled.symmetric_difference(sketched)) * rate
+
+
+def estimate_similarity(signature: Sequence[int], other_signature: Sequence[int]) -> float:
+    return sum(1 for value, other_value in zip(signature, other_signature) if value == other_value) / _SIGNATURE_BINS
+
+
+def _get_band_keys(signature: Sequence[int]) -> List[Tuple[int, Tuple[int, ...]]]:
+    if all(value == _EMPTY_BIN for value in signature):
+        # Blank content, only matched by its hash
+        return []
+    return [(band, tuple(signature[band * _ROWS_PER_BAND:(band + 1) * _ROWS_PER_BAND])) for band in range(_BANDS)]
+
+
+def _parse_entry(line: str) -> Optional[Tuple[str, str, Tuple[int, ...]]]:
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) != 3:
+        return None
+    name, content_hash, signature = fields
+    if not content_hash:
+        return name, '', ()
+    try:
+        return name, content_hash, tuple(int(value, 16) for value in signature.split(','))
+    except ValueError:
+        return None
+
+
+def _format_entry(name: str, content_hash: str, signature: Sequence[int]) -> str:
+    return '%s\t%s\t%s\n' % (name, content_hash, ','.join('%x' % value for value in signature))
+
+
+def _get_similarity_index_file_path(path: str) -> str:
+    return os.path.join(path, _SIMILARITY_INDEX_FILE_NAME)
+
+
+def get_similarity_index(path: str) -> SimilarityIndex:
+    with _similarity_indexes_lock:
+        similarity_index = _similarity_indexes.get(path)
+        if similarity_index is None:
+            similarity_index = _similarity_indexes[path] = SimilarityIndex(_get_similarity_index_file_path(path))
+        similarity_index.refresh()
+
+        return similarity_index
+
+
+def _write_index(similarity_index_file_path: str, lines: Sequence[str], since_offset: int, complete: bool) -> None:
+    # The lines of the current index after the offset are more recent than the given lines, only the last line of
+    # every history is kept. Must be called with the index locked.
+    entries = {}
+    for line in lines:
+        entries[_parse_entry(line)[0]] = line
+    try:
+        with open(similarity_index_file_path, 'r', encoding='utf-8', errors='replace') as file:
+            file.seek(since_offset)
+            for line in file:
+                entry = _parse_entry(line)
+                if entry is not None:
+                    entries[entry[0]] = line
+    except FileNotFoundError:
+        pass
+
+    with open(similarity_index_file_path + '.tmp', 'w') as file:
+        if complete:
+            file.write(_SIMILARITY_INDEX_HEADER)
+        file.writelines(line for line in entries.values() if _parse_entry(line)[1])
+    os.replace(similarity_index_file_path + '.tmp', similarity_index_file_path)
+
+
+def _append_entry(path: str, line: str) -> None:
+    similarity_index_file_path = _get_similarity_index_file_path(path)
+    with lock_file(similarity_index_file_path), open(similarity_index_file_path, 'a+') as file:
+        file.write(line)
+        if file.tell() > _MAX_SIMILARITY_INDEX_SIZE:
+            file.seek(0)
+            complete = file.readline() == _SIMILARITY_INDEX_HEADER
+            file.close()
+            _write_index(similarity_index_file_path, [], 0, complete)
+
+
+def add_to_similarity_index(path: str, name: str, content: str) -> None:
+    _append_entry(path, _format_entry(name, get_content_hash(content), get_signature(content)))
+
+
+def remove_from_similarity_index(path: str, name: str) -> None:
+    _append_entry(path, _format_entry(name, '', ()))
+
+
+def write_similarity_index(path: str, entries: Sequence[Tuple[str, str]], since_offset: int) -> None:
+    # Entries are (history name, content of its latest revision) of every history, read without holding the lock
+    similarity_index_file_path = _get_similarity_index_file_path(path)
+    lines = [_format_entry(name, get_content_hash(content), get_signature(content)) for name, content in entries]
+    with lock_file(similarity_index_file_path):
+        _write_index(similarity_index_file_path, lines, since_offset, True)
@@ -0,0 +1,61 @@
+import time
+from asyncio import AbstractEventLoop, TimerHandle
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+
+@dataclass(frozen=False)
+class _BufferSnapshotState:
+    pending_changedtick: int
+    captured_changedtick: int
+    captured_timestamp: float
+    handle: Optional[TimerHandle]
+
+
+class SnapshotScheduler:
+    # Must only be used from the event loop thread
+
+    def __init__(self, loop: AbstractEventLoop, capture: Callable[[int], None]) -> None:
+        self._loop = loop
+        self._capture = capture
+        self._buffers: Dict[int, _BufferSnapshotState] = {}
+
+    def notify(self, buffer_number: int, changedtick: int, idle_delay: float, min_interval: float) -> None:
+        state = self._buffers.get(buffer_number)
+        if state is None:
+            state = self._buffers[buffer_number] = _BufferSnapshotState(0, 0, 0.0, None)
+        if changedtick == state.captured_changedtick:
+            # Nothing changed since the last snapshot
+            return
+
+        state.pending_changedtick = changedtick
+        if state.handle is not None:
+            # The buffer is still being edited, postpone the snapshot until the editor is idle again
+            state.handle.cancel()
+
+        # Rate limit: wait for the idle delay and never snapshot the same buffer more often than min_interval
+        delay = max(idle_delay, state.captured_timestamp + min_interval - time.time())
+        state.handle = self._loop.call_later(delay, self._fire, buffer_number)
+
+    def is_pending(self, buffer_number: int, changedtick: int) -> bool:
+        state = self._buffers.get(buffer_number)
+        return state is not None and state.handle is None and state.pending_changedtick == changedtick
+
+    def captured(self, buffer_number: int, changedtick: int) -> None:
+        state = self._buffers.get(buffer_number)
+        if state is None:
+            return
+        state.captured_changedtick = changedtick
+        state.captured_timestamp = time.time()
+
+    def forget(self, buffer_number: int) -> None:
+        state = self._buffers.pop(buffer_number, None)
+        if state is not None and state.handle is not None:
+            state.handle.cancel()
+
+    def _fire(self, buffer_number: int) -> None:
+        state = self._buffers.get(buffer_number)
+        if state is None:
+            return
+        state.handle = None
+        self._capture(buffer_number)
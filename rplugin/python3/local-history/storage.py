@@ -1,11 +1,38 @@
+import dbm
+import importlib
+import os
+import pickle
+import re
 import shelve
+import struct
 import time
+import zlib
 from os import path
-from dataclasses import dataclass
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
 from hashlib import md5
-from typing import Iterator
+from threading import Lock, Thread
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 from .settings import Settings
-from .utils import get_file_content, compress, decompress
+from .utils import get_file_content, compress, count_changed_lines, decompress, thread_map, CODECS, DEFAULT_CODEC
+from .profiler import timed, count
+from .timeline import append_timeline_entry
+from .similarity import (
+    add_to_similarity_index,
+    estimate_changed_lines,
+    get_line_hashes,
+    get_line_sketch,
+    get_similarity_index,
+    remove_from_similarity_index,
+    write_similarity_index,
+)
+from .logging import log
 
 _LOCAL_HISTORY_HEADER = 'header'
 
@@ -13,57 +40,558 @@ _LOCAL_HISTORY_FIRST_RECORD_ID = 1
 
 _LOCAL_HISTORY_NO_RECORD = 0
 
+# dbm implementations store a database in one or more files named after the database
+_DBM_FILE_SUFFIXES = ('', '.db', '.dat', '.dir', '.bak', '.pag')
+
+_LOCAL_HISTORY_FILE_NAME_PATTERN = re.compile(r'^([0-9a-f]{32})(\.db|\.dat|\.dir|\.bak|\.pag)?$')
+
+_LOCAL_HISTORY_LOCK_SUFFIX = '.lock'
+
+# Histories are stored in <path>/<first hex digit>/<next two hex digits>/<name>: 4096 folders keep a few dozen
+# histories each up to ~100k tracked files. Histories of the flat layout of older versions are moved on first use.
+_SHARD_FOLDER_PATTERNS = (re.compile(r'^[0-9a-f]$'), re.compile(r'^[0-9a-f]{2}$'))
+
+# Files of a history in the flat layout: dbm files, lock, and files of an interrupted migration
+_FLAT_LOCAL_HISTORY_FILE_PATTERN = re.compile(r'^([0-9a-f]{32})(\..*)?$')
+
+# dbm implementations in the order in which dbm picks one to create a database
+_DBM_BACKENDS = ('dbm.gnu', 'dbm.ndbm', 'dbm.dumb')
+
+# dbm.dumb keeps its index in memory and rewrites it on close, histories using it are much slower
+_SLOW_DBM_BACKEND = 'dbm.dumb'
+
+# Records and headers are stored in a versioned binary layout. The compressed content of a record (preceded by its
+# sketch) is stored under its own key, named after the record id and the checksum of the content, so that the
+# records can be walked without reading it. Values pickled by older versions are still read.
+_RECORD_MAGIC = b'LHR'
+
+_HEADER_MAGIC = b'LHH'
+
+_FORMAT_VERSION = 1
+
+_CONTENT_KEY_PREFIX = 'c'
+
+# Magic, version, record id, timestamp, previous and next record ids, flags, codec, checksum, first timestamp,
+# added and removed lines, size, sketch rate, sizes of the compressed content and of the sketch
+_RECORD_STRUCT = struct.Struct('<3sBQdQQBBIdqqqIII')
+
+# Magic, version, number of records, first and last record ids, sizes of the file path and of the name of the
+# linked history (both follow UTF-8 encoded)
+_HEADER_STRUCT = struct.Struct('<3sBqQQHH')
+
+_RECORD_UNSAVED = 1
+
+_RECORD_HAS_CHECKSUM = 2
+
+_RECORD_HAS_FIRST_TIMESTAMP = 4
+
+_RECORD_HAS_CHANGES = 8
+
+_RECORD_HAS_SIZE = 16
+
+# Estimated share of lines in common for a new file to continue the history of a file which disappeared
+_RENAME_SIMILARITY_THRESHOLD = 0.5
+
+# Characters of decompressed content kept in memory, shared by every history read by the process
+_CONTENT_CACHE_SIZE = 32 * 1024 * 1024
+
+_content_cache: 'OrderedDict[Tuple[str, int, int], Tuple[list, int]]' = OrderedDict()
+
+_content_cache_size = 0
+
+_content_cache_lock = Lock()
+
+# Folders of histories which don't hold histories of the flat layout any more
+_sharded_paths: Set[str] = set()
+
+_sharded_paths_lock = Lock()
+
+# dbm implementation used to create new histories, by configured backend
+_dbm_backends: Dict[str, str] = {}
+
+# Updates of the similarity index waiting for the background thread, by folder: latest content of every history
+# (empty when removed), and settings of the folders whose index must be built first. The index only helps to find
+# renamed files, updates lost when the process exits make it miss a rename at worst.
+_similarity_updates: Dict[str, Dict[str, str]] = {}
+
+_similarity_builds: Dict[str, Settings] = {}
+
+_similarity_thread: Optional[Thread] = None
+
+_similarity_lock = Lock()
+
+# Threads decompressing the revisions of a history while the next ones are read, the codecs release the GIL
+_DECOMPRESS_JOBS = min(4, os.cpu_count() or 1)
+
+# Decompressed size of the revisions being decompressed or waiting to be consumed
+_MAX_PENDING_CONTENT_SIZE = 16 * 1024 * 1024
+
+# Compression ratio assumed for the revisions saved before their size was stored, text compresses a lot better
+_ESTIMATED_COMPRESSION_RATIO = 8
+
 
 @dataclass(frozen=True)
 class LocalHistoryChange:
     change_id: int
     timestamp: float
-    content: list
+    # None when only the metadata of the change has been read
+    content: Optional[list]
+    unsaved: bool = False
+    local_history_name: str = ''
+    # Path of the file when the change was saved, empty unless the file was renamed or moved since
+    file_path: str = ''
+    # Lines added and removed since the previous change and size in bytes, None until computed for old records
+    added: Optional[int] = None
+    removed: Optional[int] = None
+    size: Optional[int] = None
+
+    @property
+    def key(self) -> Tuple[str, int]:
+        return self.local_history_name, self.change_id
 
 
-@dataclass(frozen=False)
 class LocalHistoryRecord:
-    record_id: int
-    timestamp: float
-    content: bytes
-    previous_record_id: int
-    next_record_id: int
+    __slots__ = ('record_id', 'timestamp', 'previous_record_id', 'next_record_id', 'unsaved', 'codec', 'checksum',
+                 'first_timestamp', 'sketch_rate', 'added', 'removed', 'size', '_sketch', '_sketch_size', '_content',
+                 '_content_size', '_content_key')
+
+    def __init__(self,
+                 record_id: int,
+                 timestamp: float,
+                 content: Optional[bytes],
+                 previous_record_id: int,
+                 next_record_id: int,
+                 unsaved: bool = False,
+                 codec: str = DEFAULT_CODEC,
+                 checksum: Optional[int] = None,
+                 first_timestamp: Optional[float] = None,
+                 sketch: bytes = b'',
+                 sketch_rate: int = 1,
+                 added: Optional[int] = None,
+                 removed: Optional[int] = None,
+                 size: Optional[int] = None) -> None:
+        self.record_id = record_id
+        self.timestamp = timestamp
+        self.previous_record_id = previous_record_id
+        self.next_record_id = next_record_id
+        # Snapshot of a modified buffer which was not written to disk
+        self.unsaved = unsaved
+        # Records written before codecs were configurable are bz2 compressed
+        self.codec = codec
+        # CRC32 of the compressed content, None for records written before checksums were stored
+        self.checksum = checksum
+        # Time of the first save merged into the record, None if the record was never updated
+        self.first_timestamp = first_timestamp
+        # Sampled line hashes of the content the record was created with, to estimate the size of the merged edits
+        self.sketch = sketch
+        self.sketch_rate = sketch_rate
+        # Lines added and removed since the previous record and size of the content in bytes, None for records
+        # written before they were stored (computed in the background when the history is shown)
+        self.added = added
+        self.removed = removed
+        self.size = size
+        # None when only the metadata of the record was loaded
+        self._content = content
+        self._content_size = len(content) if content is not None else 0
+        # Key under which the content was read or written, None until then
+        self._content_key: Optional[str] = None
+
+    @property
+    def sketch(self) -> bytes:
+        return self._sketch
+
+    @sketch.setter
+    def sketch(self, sketch: bytes) -> None:
+        # Stored with the content
+        self._sketch = sketch
+        self._sketch_size = len(sketch)
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None:
+            raise ValueError('Content of record %d is not loaded' % self.record_id)
+        return self._content
+
+    @property
+    def compressed_size(self) -> int:
+        return self._content_size
+
+    @property
+    def content_key(self) -> Optional[str]:
+        return self._content_key
+
+    def get_content(self) -> str:
+        return decompress(self.content, self.codec)
+
+    def set_content(self, content: bytes, codec: str) -> None:
+        self._content = content
+        self._content_size = len(content)
+        self.codec = codec
+        self.checksum = zlib.crc32(content)
+
+    def is_intact(self) -> bool:
+        return self.checksum is None or self._content is None or self.checksum == zlib.crc32(self._content)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = {name: getattr(self, name) for name in _RECORD_FIELDS if name != 'content'}
+        state['content'] = self._content
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # Also called for the records pickled by older versions, fields added since then get their default value
+        self.__init__(**{name: value for name, value in state.items() if name in _RECORD_FIELDS})
+
+
+_RECORD_FIELDS = ('record_id', 'timestamp', 'content', 'previous_record_id', 'next_record_id', 'unsaved', 'codec',
+                  'checksum', 'first_timestamp', 'sketch', 'sketch_rate', 'added', 'removed', 'size')
 
 
-@dataclass(frozen=False)
 class LocalHistoryRecordHeader:
-    num_records: int
-    first_record_id: int
-    last_record_id: int
+    __slots__ = ('num_records', 'first_record_id', 'last_record_id', 'file_path', 'linked_from')
+
+    def __init__(self,
+                 num_records: int,
+                 first_record_id: int,
+                 last_record_id: int,
+                 file_path: str = '',
+                 linked_from: str = '') -> None:
+        self.num_records = num_records
+        self.first_record_id = first_record_id
+        self.last_record_id = last_record_id
+        # Path of the tracked file, empty for histories created before it was recorded
+        self.file_path = file_path
+        # History of the previous path of a renamed or moved file
+        self.linked_from = linked_from
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(**{name: value for name, value in state.items() if name in self.__slots__})
+
+
+def _get_content_key(record_id: int, checksum: int) -> str:
+    return '%s%d.%08x' % (_CONTENT_KEY_PREFIX, record_id, checksum)
+
+
+def _pack_record(record: LocalHistoryRecord) -> bytes:
+    flags = ((_RECORD_UNSAVED if record.unsaved else 0) | (_RECORD_HAS_CHECKSUM if record.checksum is not None else 0)
+             | (_RECORD_HAS_FIRST_TIMESTAMP if record.first_timestamp is not None else 0)
+             | (_RECORD_HAS_CHANGES if record.added is not None else 0)
+             | (_RECORD_HAS_SIZE if record.size is not None else 0))
+
+    return _RECORD_STRUCT.pack(_RECORD_MAGIC, _FORMAT_VERSION, record.record_id, record.timestamp,
+                               record.previous_record_id, record.next_record_id, flags, CODECS.index(record.codec),
+                               record.checksum or 0, record.first_timestamp or 0, record.added or 0, record.removed or 0,
+                               record.size or 0, record.sketch_rate, record.compressed_size, record._sketch_size)
+
+
+def _unpack_record(data: bytes) -> Tuple[LocalHistoryRecord, int]:
+    # The record without its content and sketch, and the size of the sketch
+    (_, version, record_id, timestamp, previous_record_id, next_record_id, flags, codec, checksum, first_timestamp,
+     added, removed, size, sketch_rate, content_size, sketch_size) = _RECORD_STRUCT.unpack_from(data)
+    if version != _FORMAT_VERSION:
+        raise ValueError('Unsupported record format version %d' % version)
+
+    record = LocalHistoryRecord(record_id, timestamp, None, previous_record_id, next_record_id,
+                                bool(flags & _RECORD_UNSAVED), CODECS[codec],
+                                checksum if flags & _RECORD_HAS_CHECKSUM else None,
+                                first_timestamp if flags & _RECORD_HAS_FIRST_TIMESTAMP else None, b'', sketch_rate,
+                                added if flags & _RECORD_HAS_CHANGES else None,
+                                removed if flags & _RECORD_HAS_CHANGES else None,
+                                size if flags & _RECORD_HAS_SIZE else None)
+    record._content_size = content_size
+    record._sketch_size = sketch_size
+    if record.checksum is not None:
+        record._content_key = _get_content_key(record_id, record.checksum)
+
+    return record, sketch_size
+
+
+def _pack_header(header: LocalHistoryRecordHeader) -> bytes:
+    file_path = header.file_path.encode('utf-8')
+    linked_from = header.linked_from.encode('utf-8')
+
+    return _HEADER_STRUCT.pack(_HEADER_MAGIC, _FORMAT_VERSION, header.num_records, header.first_record_id,
+                               header.last_record_id, len(file_path), len(linked_from)) + file_path + linked_from
+
+
+def _unpack_header(data: bytes) -> LocalHistoryRecordHeader:
+    (_, version, num_records, first_record_id, last_record_id, file_path_size,
+     linked_from_size) = _HEADER_STRUCT.unpack_from(data)
+    if version != _FORMAT_VERSION:
+        raise ValueError('Unsupported header format version %d' % version)
+    offset = _HEADER_STRUCT.size
+    file_path = data[offset:offset + file_path_size].decode('utf-8')
+    offset += file_path_size
+    linked_from = data[offset:offset + linked_from_size].decode('utf-8')
+
+    return LocalHistoryRecordHeader(num_records, first_record_id, last_record_id, file_path, linked_from)
+
+
+class LocalHistoryFile(shelve.Shelf):
+    # Keys of the contents are hidden, they are written and removed with their record
+
+    def __iter__(self) -> Iterator[str]:
+        for key in self.dict.keys():
+            key = key.decode(self.keyencoding)
+            if not key.startswith(_CONTENT_KEY_PREFIX):
+                yield key
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.get_value(key, True)
+
+    def get_value(self, key: str, with_content: bool) -> Any:
+        data = self.dict[key.encode(self.keyencoding)]
+        if data.startswith(_RECORD_MAGIC):
+            record, sketch_size = _unpack_record(data)
+            if with_content and record.content_key is not None:
+                content = self.dict[record.content_key.encode(self.keyencoding)]
+                if len(content) != sketch_size + record.compressed_size:
+                    raise ValueError('Content of record %d is truncated' % record.record_id)
+                record._sketch = content[:sketch_size]
+                record._content = content[sketch_size:]
+            return record
+        if data.startswith(_HEADER_MAGIC):
+            return _unpack_header(data)
+
+        return pickle.loads(data)
+
+    def is_legacy(self, key: str) -> bool:
+        # Pickled by an older version
+        return not self.dict[key.encode(self.keyencoding)].startswith((_RECORD_MAGIC, _HEADER_MAGIC))
+
+    def get_content_keys(self) -> List[str]:
+        return [
+            key for key in (raw_key.decode(self.keyencoding) for raw_key in self.dict.keys())
+            if key.startswith(_CONTENT_KEY_PREFIX)
+        ]
+
+    def get_raw_items(self, key: str) -> List[Tuple[bytes, bytes]]:
+        # Stored bytes of the key and of the content of the record it holds
+        raw_key = key.encode(self.keyencoding)
+        if raw_key not in self.dict:
+            return []
+        items = [(raw_key, self.dict[raw_key])]
+        content_key = self._get_content_key(items[0][1])
+        if content_key is not None and content_key in self.dict:
+            items.append((content_key, self.dict[content_key]))
+
+        return items
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if isinstance(value, LocalHistoryRecord):
+            self._store_record(key, value)
+        elif isinstance(value, LocalHistoryRecordHeader):
+            self.dict[key.encode(self.keyencoding)] = _pack_header(value)
+        else:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        raw_key = key.encode(self.keyencoding)
+        content_key = self._get_content_key(self.dict[raw_key])
+        del self.dict[raw_key]
+        if content_key is not None and content_key in self.dict:
+            del self.dict[content_key]
+
+    def _store_record(self, key: str, record: LocalHistoryRecord) -> None:
+        if record.checksum is None:
+            # Pickled before checksums were stored
+            record.checksum = zlib.crc32(record.content)
+        previous_content_key = record.content_key
+        content_key = _get_content_key(record.record_id, record.checksum)
+        raw_content_key = content_key.encode(self.keyencoding)
+        # The content is written before the record which references it, an interrupted write leaves an unreferenced
+        # content behind instead of a record without content
+        if content_key != previous_content_key or raw_content_key not in self.dict:
+            self.dict[raw_content_key] = record.sketch + record.content
+        self.dict[key.encode(self.keyencoding)] = _pack_record(record)
+        record._content_key = content_key
+        if previous_content_key is not None and previous_content_key != content_key:
+            raw_previous_content_key = previous_content_key.encode(self.keyencoding)
+            if raw_previous_content_key in self.dict:
+                del self.dict[raw_previous_content_key]
+
+    def _get_content_key(self, data: bytes) -> Optional[bytes]:
+        if not data.startswith(_RECORD_MAGIC):
+            return None
+        try:
+            record, _ = _unpack_record(data)
+        except (struct.error, ValueError, IndexError):
+            return None
+
+        return record.content_key.encode(self.keyencoding) if record.content_key is not None else None
 
 
 class LocalHistoryStorage:
 
-    def __init__(self, settings: Settings, file_path: str) -> None:
+    def __init__(self, settings: Settings, file_path: str, local_history_name: Optional[str] = None) -> None:
         self._settings = settings
         self._file_path = file_path
-        self._local_history_file_path = path.join(settings.path, self._get_local_history_file_name(file_path))
+        if local_history_name is None:
+            local_history_name = self._get_local_history_file_name(file_path)
+        self._local_history_name = local_history_name
+        self._local_history_file_path = get_local_history_file_path(settings.path, local_history_name)
+
+    @property
+    def local_history_name(self) -> str:
+        return self._local_history_name
 
-    def get_changes(self) -> Iterator[LocalHistoryChange]:
-        with shelve.open(self._local_history_file_path) as local_history_file:
-            header = local_history_file.get(_LOCAL_HISTORY_HEADER)
+    def exists(self) -> bool:
+        return bool(dbm.whichdb(self._local_history_file_path))
+
+    def get_backend(self) -> str:
+        return dbm.whichdb(self._local_history_file_path) or ''
+
+    def get_header(self) -> Optional[LocalHistoryRecordHeader]:
+        with self._open() as local_history_file, timed('storage.read'):
+            return self._load_header(local_history_file)
+
+    def get_records(self, with_content: bool = True) -> Iterator[LocalHistoryRecord]:
+        # Without content, only the metadata of the records are read
+        with self._open() as local_history_file:
+            with timed('storage.read'):
+                header = self._load_header(local_history_file)
             if header is None or header.num_records <= 0:
-                return iter(())
+                return
             record_id = header.first_record_id
             while record_id is not _LOCAL_HISTORY_NO_RECORD:
-                record = local_history_file[str(record_id)]
+                with timed('storage.read'):
+                    record = self._load_record(local_history_file, record_id, with_content)
+                if record is None:
+                    # Skip the corrupt record, record ids are increasing along the list
+                    record_id = _find_next_record_id(local_history_file, record_id, header.last_record_id)
+                    continue
                 record_id = record.next_record_id
-                yield LocalHistoryChange(change_id=record.record_id,
-                                         timestamp=record.timestamp,
-                                         content=decompress(record.content).splitlines())
+                yield record
+
+    def get_records_by_id(self, record_ids: Iterable[int]) -> List[LocalHistoryRecord]:
+        # Missing and corrupt records are skipped
+        with self._open() as local_history_file, timed('storage.read'):
+            records = [self._load_record(local_history_file, record_id) for record_id in record_ids]
+
+        return [record for record in records if record is not None]
+
+    def get_contents(self, records: Optional[Iterable[LocalHistoryRecord]] = None
+                     ) -> Iterator[Tuple[LocalHistoryRecord, Optional[str]]]:
+        # Content of every record (of the history by default) in order, None if the record is corrupt
+        return thread_map(self._get_record_content, self.get_records() if records is None else records,
+                          _DECOMPRESS_JOBS, _MAX_PENDING_CONTENT_SIZE, _get_content_size)
+
+    def get_changes(self, with_content: bool = True) -> Iterator[LocalHistoryChange]:
+        # Without content, only the metadata of the records are read and the content of the changes is None
+        if not with_content:
+            for record in self.get_records(with_content=False):
+                yield self._get_change(record, None)
+            return
+
+        for record, content in thread_map(self._get_record_content_lines, self.get_records(), _DECOMPRESS_JOBS,
+                                          _MAX_PENDING_CONTENT_SIZE, _get_content_size):
+            if content is None:
+                continue
+            yield self._get_change(record, content)
+
+    def get_linked_changes(self, with_content: bool = True) -> Iterator[LocalHistoryChange]:
+        # Changes saved under the previous paths of a renamed or moved file, oldest first. Only the headers are read
+        # before the first change is yielded
+        histories = []
+        names = {self._local_history_name}
+        header = self.get_header()
+        while header is not None and header.linked_from and header.linked_from not in names:
+            names.add(header.linked_from)
+            linked_storage = LocalHistoryStorage(self._settings, '', header.linked_from)
+            header = linked_storage.get_header()
+            if header is not None:
+                histories.append((linked_storage, header.file_path))
+
+        for linked_storage, file_path in reversed(histories):
+            for change in linked_storage.get_changes(with_content):
+                yield replace(change, file_path=file_path)
+
+    def get_change_content(self, change_id: int) -> Optional[list]:
+        with timed('storage.read'), self._open() as local_history_file:
+            record = self._load_record(local_history_file, change_id)
+        if record is None:
+            return None
+
+        return self.get_content_lines(record)
+
+    def _get_change(self, record: LocalHistoryRecord, content: Optional[list]) -> LocalHistoryChange:
+        return LocalHistoryChange(change_id=record.record_id,
+                                  timestamp=record.timestamp,
+                                  content=content,
+                                  unsaved=record.unsaved,
+                                  local_history_name=self._local_history_name,
+                                  added=record.added,
+                                  removed=record.removed,
+                                  size=record.size)
+
+    def get_last_record(self) -> Optional[LocalHistoryRecord]:
+        with timed('storage.read'), self._open() as local_history_file:
+            header = self._load_header(local_history_file)
+            if header is None or header.last_record_id == _LOCAL_HISTORY_NO_RECORD:
+                return None
+            return self._load_record(local_history_file, header.last_record_id)
+
+    def get_content_lines(self, record: LocalHistoryRecord) -> Optional[list]:
+        # The lines are shared with the other readers of the revision and must not be modified
+        key = (self._local_history_name, record.record_id, _get_checksum(record))
+        content = _get_cached_content(key)
+        if content is not None:
+            count('storage.content_cache_hit')
+            return content
+
+        count('storage.content_cache_miss')
+        _, text = self._get_record_content(record)
+        if text is None:
+            return None
+        content = text.splitlines()
+        _cache_content(key, content, len(text))
+
+        return content
+
+    def _get_record_content(self, record: LocalHistoryRecord) -> Tuple[LocalHistoryRecord, Optional[str]]:
+        with timed('storage.decompress'):
+            try:
+                return record, record.get_content()
+            except Exception as e:
+                self._report_corrupt_record(record.record_id, str(e))
+                return record, None
+
+    def _get_record_content_lines(self, record: LocalHistoryRecord) -> Tuple[LocalHistoryRecord, Optional[list]]:
+        return record, self.get_content_lines(record)
+
+    def find_record(self, timestamp: float, record_id: int = _LOCAL_HISTORY_NO_RECORD) -> Optional[LocalHistoryRecord]:
+        # Last revision written to disk before the timestamp, the record id is a guess (e.g. from the timeline)
+        with timed('storage.read'), self._open() as local_history_file:
+            record = self._load_record(local_history_file, record_id) if record_id else None
+            if record is not None and not record.unsaved and record.timestamp <= timestamp:
+                next_record = self._load_record(local_history_file, record.next_record_id, False)
+                if next_record is None or next_record.timestamp > timestamp:
+                    return record
+
+        found_record_id = _LOCAL_HISTORY_NO_RECORD
+        for record in self.get_records(with_content=False):
+            if record.timestamp > timestamp:
+                break
+            if not record.unsaved:
+                found_record_id = record.record_id
+        if found_record_id == _LOCAL_HISTORY_NO_RECORD:
+            return None
+
+        with timed('storage.read'), self._open() as local_history_file:
+            return self._load_record(local_history_file, found_record_id)
 
     def delete_record(self, record_id: int) -> None:
-        with shelve.open(self._local_history_file_path) as local_history_file:
-            header = local_history_file.get(_LOCAL_HISTORY_HEADER)
+        with timed('storage.delete'), self._open() as local_history_file:
+            header = self._load_header(local_history_file)
             if header is None or header.num_records == _LOCAL_HISTORY_NO_RECORD:
                 return
 
-            to_be_deleted_record = local_history_file.get(str(record_id))
+            to_be_deleted_record = self._load_record(local_history_file, record_id, False)
             if to_be_deleted_record is None:
                 return
 
@@ -82,86 +610,550 @@ class LocalHistoryStorage:
             local_history_file[_LOCAL_HISTORY_HEADER] = header
 
             if previous_record_id != _LOCAL_HISTORY_NO_RECORD:
-                previous_record = local_history_file.get(str(previous_record_id))
-                previous_record.next_record_id = next_record_id
-                local_history_file[str(previous_record_id)] = previous_record
+                previous_record = self._load_record(local_history_file, previous_record_id, False)
+                if previous_record is not None:
+                    previous_record.next_record_id = next_record_id
+                    local_history_file[str(previous_record_id)] = previous_record
 
             if next_record_id != _LOCAL_HISTORY_NO_RECORD:
-                next_record = local_history_file.get(str(next_record_id))
-                next_record.previous_record_id = previous_record_id
-                local_history_file[str(next_record_id)] = next_record
+                next_record = self._load_record(local_history_file, next_record_id, False)
+                if next_record is not None:
+                    next_record.previous_record_id = previous_record_id
+                    # Compared with another revision from now on
+                    next_record.added = next_record.removed = None
+                    local_history_file[str(next_record_id)] = next_record
 
-    def save_record(self) -> None:
-        content = get_file_content(self._file_path)
+    def save_record(self, content: Optional[str] = None, unsaved: bool = False, new_change: bool = False,
+                    detect_rename: bool = True) -> None:
+        # new_change: never merged into the last change, even within g:local_history_new_change_delay
+        if content is None:
+            with timed('storage.read_file'):
+                content = get_file_content(self._file_path)
         if not content:
             # Don't backup empty file
             return
         current_timestamp = time.time()
-        with shelve.open(self._local_history_file_path) as local_history_file:
-            header = local_history_file.get(_LOCAL_HISTORY_HEADER)
-            if header is None:
-                header = LocalHistoryRecordHeader(_LOCAL_HISTORY_NO_RECORD, _LOCAL_HISTORY_NO_RECORD,
-                                                  _LOCAL_HISTORY_NO_RECORD)
-
-            # Compress the content to reduce the size before saving
-            compression_content = compress(content)
-
-            if header.last_record_id == _LOCAL_HISTORY_NO_RECORD:
-                # Store patch and header
-                local_history_record = LocalHistoryRecord(_LOCAL_HISTORY_FIRST_RECORD_ID, current_timestamp,
-                                                          compression_content, _LOCAL_HISTORY_NO_RECORD,
-                                                          _LOCAL_HISTORY_NO_RECORD)
-                local_history_file[str(local_history_record.record_id)] = local_history_record
-
-                header.num_records = 1
-                header.first_record_id = local_history_record.record_id
-                header.last_record_id = local_history_record.record_id
-                local_history_file[_LOCAL_HISTORY_HEADER] = header
+        # Compress the content to reduce the size before saving
+        with timed('storage.compress'):
+            compression_content = compress(content, self._settings.codec)
+        with timed('storage.sketch'):
+            line_hashes = get_line_hashes(content)
+        lines = content.splitlines()
+        size = len(content.encode('utf-8'))
+        linked_from = ''
+        if detect_rename and self._settings.track_renames and not unsaved and not self.exists():
+            with timed('storage.find_moved_history'):
+                linked_from = self._find_moved_history(content)
+        with timed('storage.save'), self._open() as local_history_file:
+            stored = self._store_record(local_history_file, compression_content, line_hashes, lines, size,
+                                        current_timestamp, unsaved, linked_from, new_change)
+        if stored and self._settings.track_renames and not unsaved:
+            updates = {linked_from: ''} if linked_from else {}
+            # The history continues under the new path
+            updates[self._local_history_name] = content
+            _update_similarity_index_later(self._settings, updates)
 
-                return
+    def _store_record(self, local_history_file: LocalHistoryFile, compression_content: bytes, line_hashes: Set[int],
+                      lines: list, size: int, current_timestamp: float, unsaved: bool, linked_from: str,
+                      new_change: bool) -> bool:
+        header = self._load_header(local_history_file)
+        if header is None:
+            header = LocalHistoryRecordHeader(_LOCAL_HISTORY_NO_RECORD, _LOCAL_HISTORY_NO_RECORD,
+                                              _LOCAL_HISTORY_NO_RECORD, self._file_path, linked_from)
+        if not header.file_path:
+            header.file_path = self._file_path
 
-            last_record = local_history_file[str(header.last_record_id)]
+        if header.last_record_id == _LOCAL_HISTORY_NO_RECORD:
+            # Store patch and header
+            local_history_record = LocalHistoryRecord(_LOCAL_HISTORY_FIRST_RECORD_ID, current_timestamp,
+                                                      compression_content, _LOCAL_HISTORY_NO_RECORD,
+                                                      _LOCAL_HISTORY_NO_RECORD, unsaved)
+            local_history_record.set_content(compression_content, self._settings.codec)
+            local_history_record.sketch_rate, local_history_record.sketch = get_line_sketch(line_hashes)
+            self._set_change_stats(local_history_record, lines, size, [])
+            local_history_file[str(local_history_record.record_id)] = local_history_record
 
-            if last_record.content == compression_content:
-                return
+            header.num_records = 1
+            header.first_record_id = local_history_record.record_id
+            header.last_record_id = local_history_record.record_id
+            local_history_file[_LOCAL_HISTORY_HEADER] = header
+            self._add_to_timeline(local_history_record)
+
+            return True
+
+        # A corrupt last record is left untouched and a new record is started
+        last_record = self._load_record(local_history_file, header.last_record_id)
 
-            if current_timestamp - last_record.timestamp < self._settings.new_change_delay:
-                # Update the content of the last record in the case duration between current timestamp and timestamp of the last record is less than save delay
-                last_record.content = compression_content
-                # FIXME: Should we update the timestamp value?
+        if last_record is not None:
+            if last_record.content == compression_content and last_record.codec == self._settings.codec:
+                if last_record.unsaved and not unsaved:
+                    # The snapshot has been written to disk in the meantime
+                    last_record.unsaved = False
+                    local_history_file[str(header.last_record_id)] = last_record
+                    self._add_to_timeline(last_record)
+                    return True
+                return False
+
+            # An unsaved snapshot never overrides the content which was written to disk
+            if (not new_change and self._should_merge(last_record, line_hashes, current_timestamp) and
+                    (last_record.unsaved or not unsaved)):
+                # Update the content of the last record in the case duration between current timestamp and timestamp of the first save merged into the last record is less than save delay
+                last_record.set_content(compression_content, self._settings.codec)
+                last_record.unsaved = unsaved
+                # The timestamp is the one of the content, the merge window keeps starting at the first save
+                if last_record.first_timestamp is None:
+                    last_record.first_timestamp = last_record.timestamp
+                last_record.timestamp = current_timestamp
+                # The first change is compared with an empty file
+                previous_lines = []
+                if last_record.previous_record_id != _LOCAL_HISTORY_NO_RECORD:
+                    previous_record = self._load_record(local_history_file, last_record.previous_record_id)
+                    previous_lines = self._get_previous_lines(previous_record)
+                self._set_change_stats(last_record, lines, size, previous_lines)
                 local_history_file[str(header.last_record_id)] = last_record
-                return
+                self._add_to_timeline(last_record)
+                return True
 
-            # Store patch
-            local_history_record = LocalHistoryRecord(header.last_record_id + 1, current_timestamp, compression_content,
-                                                      header.last_record_id, _LOCAL_HISTORY_NO_RECORD)
-            local_history_file[str(local_history_record.record_id)] = local_history_record
+        # Store patch
+        local_history_record = LocalHistoryRecord(header.last_record_id + 1, current_timestamp, compression_content,
+                                                  header.last_record_id, _LOCAL_HISTORY_NO_RECORD, unsaved)
+        local_history_record.set_content(compression_content, self._settings.codec)
+        local_history_record.sketch_rate, local_history_record.sketch = get_line_sketch(line_hashes)
+        self._set_change_stats(local_history_record, lines, size, self._get_previous_lines(last_record))
+        local_history_file[str(local_history_record.record_id)] = local_history_record
 
-            # Update the last record
+        # Update the last record
+        if last_record is not None:
             last_record.next_record_id = local_history_record.record_id
             local_history_file[str(last_record.record_id)] = last_record
 
-            # Update header
-            header.num_records = header.num_records + 1
-            header.last_record_id = local_history_record.record_id
+        # Update header
+        header.num_records = header.num_records + 1
+        header.last_record_id = local_history_record.record_id
 
-            while header.num_records > self._settings.max_changes:
-                # Remove the first_record
-                first_record = local_history_file[str(header.first_record_id)]
+        while header.num_records > self._settings.max_changes:
+            # Remove the first_record
+            first_record = self._load_record(local_history_file, header.first_record_id, False)
+            if first_record is not None:
                 new_first_record_id = first_record.next_record_id
+            else:
+                new_first_record_id = _find_next_record_id(local_history_file, header.first_record_id,
+                                                           header.last_record_id)
+            if str(header.first_record_id) in local_history_file:
                 del local_history_file[str(header.first_record_id)]
 
-                # Update previous record for the new first record
-                new_first_record = local_history_file[str(new_first_record_id)]
+            # Update previous record for the new first record
+            new_first_record = self._load_record(local_history_file, new_first_record_id, False)
+            if new_first_record is not None:
                 new_first_record.previous_record_id = _LOCAL_HISTORY_NO_RECORD
                 local_history_file[str(new_first_record_id)] = new_first_record
 
-                # Update new first record into the header
-                header.first_record_id = new_first_record_id
-                header.num_records = header.num_records - 1
+            # Update new first record into the header
+            header.first_record_id = new_first_record_id
+            header.num_records = header.num_records - 1
 
-            # Update header
-            local_history_file[_LOCAL_HISTORY_HEADER] = header
+        # Update header
+        local_history_file[_LOCAL_HISTORY_HEADER] = header
+        self._add_to_timeline(local_history_record)
+
+        return True
+
+    def _get_previous_lines(self, previous_record: Optional[LocalHistoryRecord]) -> Optional[list]:
+        # Usually cached: the previous record was saved or shown by this process
+        return self.get_content_lines(previous_record) if previous_record is not None else None
+
+    def _set_change_stats(self, record: LocalHistoryRecord, lines: list, size: int,
+                          previous_lines: Optional[list]) -> None:
+        record.size = size
+        if previous_lines is None:
+            # The previous record is corrupt or was removed, computed again by the backfill
+            record.added = record.removed = None
+        else:
+            with timed('storage.change_stats'):
+                record.added, record.removed = count_changed_lines(previous_lines, lines)
+        # The record is likely the previous record of the next save
+        _cache_content((self._local_history_name, record.record_id, record.checksum), lines, size)
+
+    def backfill_change_stats(self) -> Dict[int, Tuple[int, int, int]]:
+        # Statistics of the records written before they were stored, by record id
+        if all(record.added is not None and record.size is not None for record in self.get_records(with_content=False)):
+            return {}
+
+        stats = {}
+        previous_lines = []
+        for record, lines in thread_map(self._get_record_content_lines, self.get_records(), _DECOMPRESS_JOBS,
+                                        _MAX_PENDING_CONTENT_SIZE, _get_content_size):
+            if lines is None:
+                continue
+            if record.added is None or record.size is None:
+                added, removed = count_changed_lines(previous_lines, lines)
+                # Line endings are not kept by the lines, close enough for files with one line ending
+                size = record.size if record.size is not None else sum(len(line.encode('utf-8')) + 1 for line in lines)
+                stats[record.record_id] = (_get_checksum(record), added, removed, size)
+            previous_lines = lines
+
+        with timed('storage.backfill'), self._open() as local_history_file:
+            for record_id, (checksum, added, removed, size) in list(stats.items()):
+                record = self._load_record(local_history_file, record_id, False)
+                if record is None or _get_checksum(record) != checksum or record.added is not None:
+                    # Saved in the meantime
+                    del stats[record_id]
+                    continue
+                record.added, record.removed, record.size = added, removed, size
+                local_history_file[str(record_id)] = record
+
+        return {record_id: (added, removed, size) for record_id, (_, added, removed, size) in stats.items()}
+
+    def _should_merge(self, last_record: LocalHistoryRecord, line_hashes: Set[int], current_timestamp: float) -> bool:
+        first_timestamp = last_record.timestamp if last_record.first_timestamp is None else last_record.first_timestamp
+        if current_timestamp - first_timestamp >= self._settings.new_change_delay:
+            return False
+        if self._settings.coalesce_max_lines <= 0 or not last_record.sketch:
+            # Records written before sketches were stored are merged by time only
+            return True
+
+        # Compared with the content the record was created with, so that small edits can't add up to a large one
+        changed_lines = estimate_changed_lines(last_record.sketch_rate, last_record.sketch, line_hashes)
+        return changed_lines <= self._settings.coalesce_max_lines
+
+    def _find_moved_history(self, content: str) -> str:
+        similarity_index = get_similarity_index(self._settings.path)
+        if not similarity_index.complete:
+            # Reads every history, renames are only detected once the index has been built in the background
+            count('storage.similarity_index_incomplete')
+            _build_similarity_index_later(self._settings)
+            return ''
+
+        for name, _ in similarity_index.find(content, _RENAME_SIMILARITY_THRESHOLD):
+            header = LocalHistoryStorage(self._settings, '', name).get_header()
+            # Only the history of a file which does not exist anymore can be taken over
+            if header is not None and header.file_path and header.file_path != self._file_path and not path.exists(
+                    header.file_path):
+                count('storage.moved_files')
+                return name
+
+        return ''
+
+    def _add_to_timeline(self, record: LocalHistoryRecord) -> None:
+        if not record.unsaved:
+            append_timeline_entry(self._settings.path, record.timestamp, self._local_history_name, record.record_id)
+
+    def _report_corrupt_record(self, key: Any, reason: str) -> None:
+        count('storage.corrupt_records')
+        log.warning('[vim-local-history] Skipped corrupt record %s of %s: %s', key, self._local_history_file_path,
+                    reason)
+
+    def _load_header(self, local_history_file: LocalHistoryFile) -> Optional[LocalHistoryRecordHeader]:
+        try:
+            return local_history_file.get(_LOCAL_HISTORY_HEADER)
+        except Exception as e:
+            self._report_corrupt_record(_LOCAL_HISTORY_HEADER, str(e))
+
+        # Rebuild the header from the stored records, the links are repaired by skipping missing records
+        record_ids = _get_record_ids(local_history_file)
+        if not record_ids:
+            return None
+        return LocalHistoryRecordHeader(len(record_ids), record_ids[0], record_ids[-1], self._file_path)
+
+    def _load_record(self, local_history_file: LocalHistoryFile, record_id: int,
+                     with_content: bool = True) -> Optional[LocalHistoryRecord]:
+        key = str(record_id)
+        try:
+            record = local_history_file.get_value(key, with_content) if key in local_history_file else None
+        except Exception as e:
+            self._report_corrupt_record(record_id, str(e))
+            return None
+        if record is not None and not record.is_intact():
+            self._report_corrupt_record(record_id, 'checksum mismatch')
+            return None
+
+        return record
+
+    @contextmanager
+    def _open(self) -> Iterator[LocalHistoryFile]:
+        # Warns once if new histories would fall back to the slow dbm.dumb
+        get_dbm_backend(self._settings.backend)
+        os.makedirs(path.dirname(self._local_history_file_path), exist_ok=True)
+        with lock_local_history_file(self._local_history_file_path):
+            with timed('storage.open'):
+                local_history_file = open_local_history_file(self._local_history_file_path, self._settings.backend)
+            try:
+                yield local_history_file
+            finally:
+                local_history_file.close()
 
     def _get_local_history_file_name(self, file_path: str) -> str:
         return md5(file_path.encode('utf-8')).hexdigest()
+
+
+def index_local_histories(settings: Settings, since_offset: int) -> None:
+    entries = []
+    for name in find_local_history_names(settings):
+        record = LocalHistoryStorage(settings, '', name).get_last_record()
+        if record is None or record.unsaved:
+            continue
+        try:
+            entries.append((name, record.get_content()))
+        except Exception:
+            continue
+    write_similarity_index(settings.path, entries, since_offset)
+
+
+def _update_similarity_index_later(settings: Settings, updates: Dict[str, str]) -> None:
+    with _similarity_lock:
+        _similarity_updates.setdefault(settings.path, {}).update(updates)
+        _start_similarity_thread()
+
+
+def _build_similarity_index_later(settings: Settings) -> None:
+    with _similarity_lock:
+        _similarity_builds.setdefault(settings.path, settings)
+        _start_similarity_thread()
+
+
+def _start_similarity_thread() -> None:
+    # Must be called with _similarity_lock held
+    global _similarity_thread
+
+    if _similarity_thread is None:
+        _similarity_thread = Thread(target=_update_similarity_indexes, name='local-history-similarity', daemon=True)
+        _similarity_thread.start()
+
+
+def flush_similarity_indexes() -> None:
+    # Waits for the pending updates, e.g. before a worker process of the command line tool exits
+    thread = _similarity_thread
+    if thread is not None:
+        thread.join()
+
+
+def _update_similarity_indexes() -> None:
+    # Hashing and signing the contents, and building an index from every history, never delay a save
+    global _similarity_thread
+
+    while True:
+        with _similarity_lock:
+            if not _similarity_builds and not _similarity_updates:
+                _similarity_thread = None
+                return
+            builds = list(_similarity_builds.values())
+            updates = list(_similarity_updates.items())
+            _similarity_builds.clear()
+            _similarity_updates.clear()
+
+        for settings in builds:
+            try:
+                with timed('storage.similarity_index_build'):
+                    similarity_index = get_similarity_index(settings.path)
+                    if not similarity_index.complete:
+                        index_local_histories(settings, similarity_index.offset)
+            except Exception as e:
+                log.exception('[vim-local-history] Indexing %s failed: %s', settings.path, str(e))
+        for settings_path, contents in updates:
+            try:
+                with timed('storage.similarity_index'):
+                    for name, content in contents.items():
+                        if content:
+                            add_to_similarity_index(settings_path, name, content)
+                        else:
+                            remove_from_similarity_index(settings_path, name)
+            except OSError as e:
+                log.warning('[vim-local-history] Updating the similarity index of %s failed: %s', settings_path,
+                            str(e))
+
+
+def find_local_history_names(settings: Settings) -> List[str]:
+    if not path.isdir(settings.path):
+        return []
+
+    _shard_local_histories(settings.path)
+    names = set()
+    for folder in _find_shard_folders(settings.path):
+        prefix = path.basename(path.dirname(folder)) + path.basename(folder)
+        for file_name in os.listdir(folder):
+            matches = _LOCAL_HISTORY_FILE_NAME_PATTERN.match(file_name)
+            if matches and matches.group(1).startswith(prefix):
+                names.add(matches.group(1))
+
+    return sorted(names)
+
+
+def get_local_history_file_path(settings_path: str, name: str) -> str:
+    _shard_local_histories(settings_path)
+    return _get_sharded_file_path(settings_path, name)
+
+
+def _get_sharded_file_path(settings_path: str, name: str) -> str:
+    return path.join(settings_path, name[:1], name[1:3], name)
+
+
+def _find_shard_folders(settings_path: str) -> List[str]:
+    folders = [settings_path]
+    for pattern in _SHARD_FOLDER_PATTERNS:
+        folders = [
+            path.join(folder, file_name)
+            for folder in folders
+            for file_name in sorted(os.listdir(folder))
+            if pattern.match(file_name) and path.isdir(path.join(folder, file_name))
+        ]
+
+    return folders
+
+
+def _shard_local_histories(settings_path: str) -> None:
+    # Moves the histories of the flat layout into their shard folder, once per folder and process
+    if settings_path in _sharded_paths:
+        return
+
+    with _sharded_paths_lock:
+        if settings_path in _sharded_paths:
+            return
+        try:
+            file_names = os.listdir(settings_path)
+        except FileNotFoundError:
+            file_names = []
+        flat_file_names: Dict[str, List[str]] = {}
+        for file_name in file_names:
+            matches = _FLAT_LOCAL_HISTORY_FILE_PATTERN.match(file_name)
+            if matches and path.isfile(path.join(settings_path, file_name)):
+                flat_file_names.setdefault(matches.group(1), []).append(file_name)
+        with timed('storage.shard'):
+            for name, names in sorted(flat_file_names.items()):
+                if _move_flat_local_history(settings_path, name, names):
+                    count('storage.sharded_histories')
+        _sharded_paths.add(settings_path)
+
+
+def _move_flat_local_history(settings_path: str, name: str, file_names: List[str]) -> bool:
+    flat_file_path = path.join(settings_path, name)
+    local_history_file_path = _get_sharded_file_path(settings_path, name)
+    os.makedirs(path.dirname(local_history_file_path), exist_ok=True)
+    # Older versions lock the flat history, this one the sharded history
+    with lock_local_history_file(flat_file_path), lock_local_history_file(local_history_file_path):
+        # Some may have been moved by another process in the meantime
+        file_names = [
+            file_name for file_name in file_names
+            if file_name != name + _LOCAL_HISTORY_LOCK_SUFFIX and path.isfile(path.join(settings_path, file_name))
+        ]
+        if file_names and get_local_history_files(local_history_file_path):
+            log.warning('[vim-local-history] History %s exists in the flat and the sharded layouts, %s is left as is',
+                        name, flat_file_path)
+            return False
+        for file_name in file_names:
+            os.replace(path.join(settings_path, file_name),
+                       path.join(path.dirname(local_history_file_path), file_name))
+    try:
+        os.remove(flat_file_path + _LOCAL_HISTORY_LOCK_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+    return bool(file_names)
+
+
+def _get_record_ids(local_history_file: LocalHistoryFile) -> List[int]:
+    return sorted(int(key) for key in local_history_file.keys() if key.isdigit())
+
+
+def _find_next_record_id(local_history_file: LocalHistoryFile, record_id: int, last_record_id: int) -> int:
+    for next_record_id in range(record_id + 1, last_record_id + 1):
+        if str(next_record_id) in local_history_file:
+            return next_record_id
+
+    return _LOCAL_HISTORY_NO_RECORD
+
+
+def _get_checksum(record: LocalHistoryRecord) -> int:
+    return record.checksum if record.checksum is not None else zlib.crc32(record.content)
+
+
+def _get_content_size(record: LocalHistoryRecord) -> int:
+    # What the revision takes once decompressed, the compressed size would let far more content pile up
+    if record.size is not None:
+        return record.size
+    return record.compressed_size * _ESTIMATED_COMPRESSION_RATIO
+
+
+def _get_cached_content(key: Tuple[str, int, int]) -> Optional[list]:
+    with _content_cache_lock:
+        entry = _content_cache.get(key)
+        if entry is None:
+            return None
+        _content_cache.move_to_end(key)
+        return entry[0]
+
+
+def _cache_content(key: Tuple[str, int, int], content: list, size: int) -> None:
+    global _content_cache_size
+
+    if size > _CONTENT_CACHE_SIZE:
+        return
+    with _content_cache_lock:
+        if key in _content_cache:
+            return
+        _content_cache[key] = (content, size)
+        _content_cache_size += size
+        while _content_cache_size > _CONTENT_CACHE_SIZE:
+            _, (_, evicted_size) = _content_cache.popitem(last=False)
+            _content_cache_size -= evicted_size
+
+
+def get_local_history_files(local_history_file_path: str) -> List[str]:
+    return [
+        local_history_file_path + suffix
+        for suffix in _DBM_FILE_SUFFIXES
+        if path.isfile(local_history_file_path + suffix)
+    ]
+
+
+def open_local_history_file(local_history_file_path: str, backend: str, flag: str = 'c') -> LocalHistoryFile:
+    # Existing histories are opened with the dbm implementation which created them
+    if flag in ('c', 'n') and not dbm.whichdb(local_history_file_path):
+        return LocalHistoryFile(importlib.import_module(get_dbm_backend(backend)).open(local_history_file_path, flag))
+
+    return LocalHistoryFile(dbm.open(local_history_file_path, flag))
+
+
+def get_dbm_backend(backend: str) -> str:
+    # Implementation used to create new histories: the configured one if available, else the one dbm would pick
+    dbm_backend = _dbm_backends.get(backend)
+    if dbm_backend is not None:
+        return dbm_backend
+
+    if backend and is_dbm_backend_available(backend):
+        dbm_backend = backend
+    else:
+        if backend:
+            log.warning('[vim-local-history] dbm implementation %s is not available, using the default one', backend)
+        dbm_backend = next(name for name in _DBM_BACKENDS if is_dbm_backend_available(name))
+        if dbm_backend == _SLOW_DBM_BACKEND:
+            log.warning('[vim-local-history] Neither dbm.gnu nor dbm.ndbm is available, histories are stored with the '
+                        'slow dbm.dumb. Install the gdbm module of Python (e.g. python3-gdbm) or set '
+                        'g:local_history_backend to \'dbm.dumb\' to silence this warning')
+    _dbm_backends[backend] = dbm_backend
+
+    return dbm_backend
+
+
+def is_dbm_backend_available(backend: str) -> bool:
+    try:
+        importlib.import_module(backend)
+    except ImportError:
+        return False
+
+    return True
+
+
+@contextmanager
+def lock_local_history_file(local_history_file_path: str) -> Iterator[None]:
+    # dbm files can't be shared between processes, writers (other Neovim instances, migration) are serialized
+    if fcntl is None:
+        yield
+        return
+
+    with open(local_history_file_path + _LOCAL_HISTORY_LOCK_SUFFIX, 'a') as lock_file:
+        with timed('storage.lock_wait'):
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,151 @@
+import os
+from bisect import bisect_right
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
+from .utils import lock_file
+
+# Time ordered index of the revisions of every history: one "<timestamp>\t<history name>\t<record id>" line per revision
+_TIMELINE_FILE_NAME = 'timeline'
+
+# First line of a timeline which covers every history, timelines without it are rebuilt from the histories
+_TIMELINE_HEADER = 'local-history-timeline\t1\n'
+
+# Timelines are compacted when they grow over this size (entries of deleted revisions are never removed otherwise)
+_MAX_TIMELINE_SIZE = 16 * 1024 * 1024
+
+_timelines: Dict[str, 'Timeline'] = {}
+
+_timelines_lock = Lock()
+
+
+class Timeline:
+
+    def __init__(self, timeline_file_path: str) -> None:
+        self._timeline_file_path = timeline_file_path
+        self._complete = False
+        self._offset = 0
+        self._inode = None
+        # Timestamps and record ids of every history, ordered by timestamp
+        self._entries: Dict[str, Tuple[List[float], List[int]]] = {}
+
+    @property
+    def complete(self) -> bool:
+        return self._complete
+
+    def refresh(self) -> None:
+        try:
+            file = open(self._timeline_file_path, 'rb')
+        except FileNotFoundError:
+            self._reset(None)
+            return
+
+        with file:
+            file_stat = os.fstat(file.fileno())
+            if file_stat.st_ino != self._inode or file_stat.st_size < self._offset:
+                # Rebuilt or compacted in the meantime
+                self._reset(file_stat.st_ino)
+            file.seek(self._offset)
+            data = file.read()
+
+        # A line which is being appended is read on the next refresh
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        for line in data[:end].decode('utf-8', 'replace').splitlines(True):
+            if line == _TIMELINE_HEADER:
+                self._complete = True
+                continue
+            entry = _parse_entry(line)
+            if entry is not None:
+                self._add(*entry)
+
+    def get_names(self) -> List[str]:
+        return sorted(self._entries)
+
+    def find(self, name: str, timestamp: float) -> Optional[int]:
+        entries = self._entries.get(name)
+        if entries is None:
+            return None
+        timestamps, record_ids = entries
+        index = bisect_right(timestamps, timestamp) - 1
+
+        return record_ids[index] if index >= 0 else None
+
+    def _reset(self, inode: Optional[int]) -> None:
+        self._complete = False
+        self._offset = 0
+        self._inode = inode
+        self._entries = {}
+
+    def _add(self, timestamp: float, name: str, record_id: int) -> None:
+        timestamps, record_ids = self._entries.setdefault(name, ([], []))
+        if not timestamps or timestamps[-1] <= timestamp:
+            timestamps.append(timestamp)
+            record_ids.append(record_id)
+            return
+        # Appended by another Neovim instance which saved slightly earlier
+        index = bisect_right(timestamps, timestamp)
+        timestamps.insert(index, timestamp)
+        record_ids.insert(index, record_id)
+
+
+def _parse_entry(line: str) -> Optional[Tuple[float, str, int]]:
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) != 3:
+        return None
+    try:
+        return float(fields[0]), fields[1], int(fields[2])
+    except ValueError:
+        return None
+
+
+def _format_entry(timestamp: float, name: str, record_id: int) -> str:
+    return '%.6f\t%s\t%d\n' % (timestamp, name, record_id)
+
+
+def get_timeline_file_path(path: str) -> str:
+    return os.path.join(path, _TIMELINE_FILE_NAME)
+
+
+def append_timeline_entry(path: str, timestamp: float, name: str, record_id: int) -> None:
+    timeline_file_path = get_timeline_file_path(path)
+    with lock_file(timeline_file_path), open(timeline_file_path, 'a') as file:
+        file.write(_format_entry(timestamp, name, record_id))
+
+
+def needs_rebuild(path: str) -> bool:
+    timeline = get_timeline(path)
+    try:
+        return not timeline.complete or os.path.getsize(get_timeline_file_path(path)) > _MAX_TIMELINE_SIZE
+    except FileNotFoundError:
+        return True
+
+
+def write_timeline(path: str, entries: Sequence[Tuple[float, str, int]], since: float) -> None:
+    # The entries are read from the histories without holding the timeline lock, the entries appended since the
+    # histories started to be read are merged
+    timeline_file_path = get_timeline_file_path(path)
+    with lock_file(timeline_file_path):
+        lines = {_format_entry(*entry) for entry in entries}
+        try:
+            with open(timeline_file_path, 'r', encoding='utf-8', errors='replace') as file:
+                for line in file:
+                    entry = _parse_entry(line)
+                    if entry is not None and entry[0] >= since:
+                        lines.add(_format_entry(*entry))
+        except FileNotFoundError:
+            pass
+
+        with open(timeline_file_path + '.tmp', 'w') as file:
+            file.write(_TIMELINE_HEADER)
+            file.writelines(sorted(lines, key=_parse_entry))
+        os.replace(timeline_file_path + '.tmp', timeline_file_path)
+
+
+def get_timeline(path: str) -> Timeline:
+    with _timelines_lock:
+        timeline = _timelines.get(path)
+        if timeline is None:
+            timeline = _timelines[path] = Timeline(get_timeline_file_path(path))
+        timeline.refresh()
+
+        return timeline
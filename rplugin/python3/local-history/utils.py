@@ -1,25 +1,151 @@
 import bz2
+import lzma
+import zlib
 import os
 import difflib
+import multiprocessing
+import re
+import time
+from collections import deque
+from datetime import datetime
 from os import path
 from asyncio import get_running_loop
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial
-from typing import Any, Callable, TypeVar
-
-T = TypeVar("T")
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+from .profiler import profile_call
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-async def run_in_executor(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
-    loop = get_running_loop()
-    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+T = TypeVar("T")
 
+# Items handed to a worker process at once
+_PARALLEL_CHUNK_SIZE = 8
 
-def compress(data: str) -> bytes:
-    return bz2.compress(data.encode('utf-8'))
+_LOCK_FILE_SUFFIX = '.lock'
 
 
-def decompress(data: bytes) -> str:
-    return bz2.decompress(data).decode('utf-8')
+async def run_in_executor(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = get_running_loop()
+    return await loop.run_in_executor(None, partial(profile_call, func, *args, **kwargs))
+
+
+_CODECS = {
+    'bz2': (bz2.compress, bz2.decompress),
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+    'none': (bytes, bytes),
+}
+
+DEFAULT_CODEC = 'bz2'
+
+CODECS = tuple(_CODECS.keys())
+
+
+def _map_chunk(func: Callable[..., T], items: Sequence[Any]) -> List[T]:
+    return [func(item) for item in items]
+
+
+def parallel_map(func: Callable[..., T],
+                 items: Iterable[Any],
+                 jobs: int,
+                 initializer: Optional[Callable[..., None]] = None,
+                 initargs: tuple = (),
+                 processes: bool = True,
+                 chunk_size: int = _PARALLEL_CHUNK_SIZE) -> Iterator[T]:
+    # Results are yielded in order as soon as they are ready so that the output can be streamed. The items are
+    # consumed lazily: at most two chunks per worker are submitted, so results never pile up in memory when the
+    # consumer is slower than the workers.
+    if jobs <= 1 or (isinstance(items, Sequence) and len(items) <= 1):
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(func, items)
+        return
+
+    if processes:
+        # Forked workers don't need to import the plugin package by name
+        start_methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in start_methods else None)
+        executor = ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=initializer,
+                                       initargs=initargs)
+    else:
+        # Inside the plugin host: forked children would inherit the locks held by its other threads and the RPC pipes
+        executor = ThreadPoolExecutor(max_workers=jobs, initializer=initializer, initargs=initargs)
+    pending = deque()
+    with executor:
+        try:
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) < chunk_size:
+                    continue
+                while len(pending) >= 2 * jobs:
+                    yield from pending.popleft().result()
+                pending.append(executor.submit(_map_chunk, func, chunk))
+                chunk = []
+            if chunk:
+                pending.append(executor.submit(_map_chunk, func, chunk))
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            # The consumer stopped early
+            for future in pending:
+                future.cancel()
+
+
+def thread_map(func: Callable[..., T], items: Iterable[Any], jobs: int, max_pending_size: int,
+               get_size: Callable[[Any], int]) -> Iterator[T]:
+    # Results are yielded in order, the items are consumed lazily: no more are handed to the threads while the
+    # pending ones add up to max_pending_size (at least one is always pending)
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+
+    pending = deque()
+    pending_size = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for item in items:
+                size = get_size(item)
+                while pending and (pending_size + size > max_pending_size or len(pending) >= 2 * jobs):
+                    future, future_size = pending.popleft()
+                    pending_size -= future_size
+                    yield future.result()
+                pending.append((executor.submit(func, item), size))
+                pending_size += size
+            while pending:
+                yield pending.popleft()[0].result()
+        finally:
+            # The consumer stopped early
+            for future, _ in pending:
+                future.cancel()
+
+
+@contextmanager
+def lock_file(file_path: str) -> Iterator[None]:
+    # Serializes the writers of a file shared by several processes (Neovim instances, command line tool)
+    if fcntl is None:
+        yield
+        return
+
+    with open(file_path + _LOCK_FILE_SUFFIX, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def compress(data: str, codec: str = DEFAULT_CODEC) -> bytes:
+    return _CODECS[codec][0](data.encode('utf-8'))
+
+
+def decompress(data: bytes, codec: str = DEFAULT_CODEC) -> str:
+    return _CODECS[codec][1](data).decode('utf-8')
 
 
 def get_file_content(file_path: str) -> str:
@@ -45,3 +171,40 @@ def is_in_workspace(file_path: str) -> bool:
 
 def diff(current: list, history: list) -> list:
     return list(difflib.unified_diff(current, history, fromfile='current', tofile='history', lineterm=''))
+
+
+def get_hunks(current: Sequence[str], target: Sequence[str]) -> List[Tuple[int, int, list]]:
+    # Ranges [start, end) of the current lines to replace by the given lines to get the target lines, from the top
+    start = 0
+    end = min(len(current), len(target))
+    while start < end and current[start] == target[start]:
+        start += 1
+    # Only the lines between the common prefix and suffix are compared
+    suffix = 0
+    while suffix < end - start and current[-1 - suffix] == target[-1 - suffix]:
+        suffix += 1
+    matcher = difflib.SequenceMatcher(None, current[start:len(current) - suffix], target[start:len(target) - suffix])
+
+    return [(start + current_start, start + current_end, list(target[start + target_start:start + target_end]))
+            for tag, current_start, current_end, target_start, target_end in matcher.get_opcodes()
+            if tag != 'equal']
+
+
+def count_changed_lines(current: Sequence[str], target: Sequence[str]) -> Tuple[int, int]:
+    # Lines added and removed to get the target lines
+    hunks = get_hunks(current, target)
+
+    return sum(len(lines) for _, _, lines in hunks), sum(end - start for start, end, _ in hunks)
+
+
+def parse_timestamp(value: str) -> float:
+    # Accepts a unix timestamp, an ISO 8601 date (e.g. 2020-08-30 14:05) or an age (e.g. 30m, 2h, 1d)
+    value = value.strip()
+    matches = re.match(r'^([0-9]+)\s*([smhdw])$', value)
+    if matches:
+        units = {'s': 1, 'm': 60, 'h': 3600, 'd': 3600 * 24, 'w': 3600 * 24 * 7}
+        return time.time() - int(matches.group(1)) * units[matches.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
@@ -0,0 +1,291 @@
+import ctypes
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from threading import Thread
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from .logging import log
+from .profiler import count
+
+# Changes are reported once no file changed for this many seconds, or at the latest after _MAX_BATCH_DELAY seconds
+_DEBOUNCE_DELAY = 1.0
+
+_MAX_BATCH_DELAY = 10.0
+
+# Changed files reported at once, other operations of the plugin can run between two batches
+_MAX_BATCH_SIZE = 256
+
+# Folders of version control systems are never watched
+_SKIPPED_FOLDER_NAMES = ('.git', '.hg', '.svn')
+
+# Seconds between two scans of the polling fallback, stretched so that scanning takes at most a tenth of the time
+_POLL_INTERVAL = 2.0
+
+_POLL_MAX_LOAD = 0.1
+
+# inotify(7)
+_IN_CLOSE_WRITE = 0x00000008
+
+_IN_MOVED_FROM = 0x00000040
+
+_IN_MOVED_TO = 0x00000080
+
+_IN_CREATE = 0x00000100
+
+_IN_Q_OVERFLOW = 0x00004000
+
+_IN_IGNORED = 0x00008000
+
+_IN_ONLYDIR = 0x01000000
+
+_IN_ISDIR = 0x40000000
+
+_IN_NONBLOCK = 0o4000
+
+_IN_CLOEXEC = 0o2000000
+
+# Files are reported when they are closed after being written or moved in, created folders are watched
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_ONLYDIR
+
+# Watch descriptor, mask, cookie and size of the name which follows
+_EVENT_STRUCT = struct.Struct('iIII')
+
+_READ_SIZE = 64 * 1024
+
+
+def _is_skipped_folder(folder: str, skip_folder: Callable[[str], bool]) -> bool:
+    return os.path.basename(folder) in _SKIPPED_FOLDER_NAMES or skip_folder(folder)
+
+
+class _InotifySource:
+
+    def __init__(self, root: str, skip_folder: Callable[[str], bool]) -> None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._root = root
+        self._skip_folder = skip_folder
+        self._folders: Dict[int, str] = {}
+        self._watches: Dict[str, int] = {}
+        self._limit_reported = False
+
+    def open(self) -> None:
+        self._watch_tree(self._root, None)
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def read(self, timeout: Optional[float]) -> List[str]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        changes = []
+        offset = 0
+        while offset + _EVENT_STRUCT.size <= len(data):
+            watch, mask, _, name_size = _EVENT_STRUCT.unpack_from(data, offset)
+            offset += _EVENT_STRUCT.size
+            name = os.fsdecode(data[offset:offset + name_size].rstrip(b'\0'))
+            offset += name_size
+            self._handle_event(watch, mask, name, changes)
+
+        return changes
+
+    def _handle_event(self, watch: int, mask: int, name: str, changes: List[str]) -> None:
+        if mask & _IN_Q_OVERFLOW:
+            count('watch.overflows')
+            log.warning('[vim-local-history] Too many files changed at once, some of them are not in the local history')
+            return
+        if mask & _IN_IGNORED:
+            # The folder has been removed or is not watched any more
+            folder = self._folders.pop(watch, None)
+            if folder is not None and self._watches.get(folder) == watch:
+                del self._watches[folder]
+            return
+
+        folder = self._folders.get(watch)
+        if folder is None:
+            return
+        file_path = os.path.join(folder, name)
+        if not mask & _IN_ISDIR:
+            if mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                changes.append(file_path)
+        elif mask & _IN_MOVED_FROM:
+            self._unwatch_tree(file_path)
+        elif mask & (_IN_CREATE | _IN_MOVED_TO):
+            # Files may have been written before the folder is watched, all of them are reported
+            try:
+                self._watch_tree(file_path, changes)
+            except OSError as e:
+                if not self._limit_reported:
+                    self._limit_reported = True
+                    log.warning('[vim-local-history] New folders are not watched: %s', str(e))
+
+    def _watch_tree(self, folder: str, files: Optional[List[str]]) -> None:
+        folders = [folder]
+        while folders:
+            folder = folders.pop()
+            if _is_skipped_folder(folder, self._skip_folder):
+                continue
+            watch = self._libc.inotify_add_watch(self._fd, os.fsencode(folder), _WATCH_MASK)
+            if watch < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, 'Limit of inotify watches reached (fs.inotify.max_user_watches)')
+                # Removed in the meantime or not readable
+                continue
+            self._folders[watch] = folder
+            self._watches[folder] = watch
+
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif files is not None and entry.is_file(follow_symlinks=False):
+                        files.append(entry.path)
+                except OSError:
+                    continue
+
+    def _unwatch_tree(self, folder: str) -> None:
+        # The folder has been moved away, the paths of its watches are wrong from now on
+        for watched_folder, watch in list(self._watches.items()):
+            if watched_folder == folder or watched_folder.startswith(folder + os.sep):
+                self._libc.inotify_rm_watch(self._fd, watch)
+                del self._watches[watched_folder]
+                self._folders.pop(watch, None)
+
+
+class _PollingSource:
+    # Compares the modification time and size of every file with the previous scan
+
+    def __init__(self, root: str, skip_folder: Callable[[str], bool]) -> None:
+        self._root = root
+        self._skip_folder = skip_folder
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._next_scan = 0.0
+
+    def open(self) -> None:
+        self._index = self._timed_scan()
+
+    def close(self) -> None:
+        pass
+
+    def read(self, timeout: Optional[float]) -> List[str]:
+        delay = self._next_scan - time.monotonic()
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, delay))
+
+        index = self._timed_scan()
+        changes = [file_path for file_path, state in index.items() if self._index.get(file_path) != state]
+        self._index = index
+
+        return changes
+
+    def _timed_scan(self) -> Dict[str, Tuple[int, int]]:
+        start = time.monotonic()
+        index = self._scan()
+        duration = time.monotonic() - start
+        self._next_scan = time.monotonic() + max(_POLL_INTERVAL, duration / _POLL_MAX_LOAD)
+
+        return index
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        index = {}
+        folders = [self._root]
+        while folders:
+            folder = folders.pop()
+            if _is_skipped_folder(folder, self._skip_folder):
+                continue
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        file_stat = entry.stat(follow_symlinks=False)
+                        index[entry.path] = (file_stat.st_mtime_ns, file_stat.st_size)
+                except OSError:
+                    continue
+
+        return index
+
+
+class FileWatcher(Thread):
+    # Reports the files of a folder which are written (by Neovim or by other programs) in batches, once the changes
+    # settle. Uses inotify on Linux and polls the modification times of the files elsewhere.
+
+    def __init__(self, root: str, skip_folder: Callable[[str], bool], on_changes: Callable[[List[str]], None]) -> None:
+        super().__init__(name='local-history-watcher', daemon=True)
+        self._root = root
+        self._skip_folder = skip_folder
+        self._on_changes = on_changes
+
+    def run(self) -> None:
+        source = self._open_source()
+        try:
+            self._watch(source)
+        except Exception as e:
+            log.exception('[vim-local-history] Stopped watching %s: %s', self._root, str(e))
+        finally:
+            source.close()
+
+    def _open_source(self) -> Union[_InotifySource, _PollingSource]:
+        try:
+            source = _InotifySource(self._root, self._skip_folder)
+            try:
+                source.open()
+            except OSError:
+                source.close()
+                raise
+            return source
+        except OSError as e:
+            log.warning('[vim-local-history] Watching %s by polling: %s', self._root, str(e))
+
+        source = _PollingSource(self._root, self._skip_folder)
+        source.open()
+
+        return source
+
+    def _watch(self, source: Union[_InotifySource, _PollingSource]) -> None:
+        pending: Dict[str, None] = {}
+        first_change = last_change = 0.0
+        while True:
+            timeout = None
+            if pending:
+                flush_time = min(last_change + _DEBOUNCE_DELAY, first_change + _MAX_BATCH_DELAY)
+                timeout = max(0.0, flush_time - time.monotonic())
+            changes = source.read(timeout)
+            now = time.monotonic()
+            if changes:
+                if not pending:
+                    first_change = now
+                last_change = now
+                count('watch.changes', len(changes))
+                pending.update(dict.fromkeys(changes))
+            if pending and (now >= last_change + _DEBOUNCE_DELAY or now >= first_change + _MAX_BATCH_DELAY):
+                file_paths = list(pending)
+                pending.clear()
+                for start in range(0, len(file_paths), _MAX_BATCH_SIZE):
+                    self._on_changes(file_paths[start:start + _MAX_BATCH_SIZE])
@@ -0,0 +1,54 @@
+import importlib
+import os
+import sys
+import time
+from dataclasses import replace
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rplugin', 'python3'))
+
+settings_module = importlib.import_module('local-history.settings')
+storage = importlib.import_module('local-history.storage')
+
+
+class Clock:
+
+    def __init__(self) -> None:
+        self.now = 1600000000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def tick(self, seconds: float = 3600) -> float:
+        self.now += seconds
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    # Timestamps of the saved revisions, an hour apart by default so that saves are never merged
+    clock = Clock()
+    monkeypatch.setattr(time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def settings(tmp_path):
+    path = tmp_path / 'history'
+    path.mkdir()
+    return replace(settings_module.default_settings(str(path)), backend='dbm.dumb', track_renames=False)
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    path = tmp_path / 'workspace'
+    path.mkdir()
+    return path
+
+
+def save(settings, file_path, content: str, clock: Clock = None, **kwargs) -> None:
+    if clock is not None:
+        clock.tick()
+    with open(str(file_path), 'w') as file:
+        file.write(content)
+    storage.LocalHistoryStorage(settings, str(file_path)).save_record(**kwargs)
@@ -0,0 +1,62 @@
+import importlib
+from collections import OrderedDict
+import pytest
+
+local_history = importlib.import_module('local-history.local_history')
+
+
+class _Buffer:
+
+    def __init__(self, number: int) -> None:
+        self.number = number
+
+
+@pytest.fixture
+def buffer_lines(monkeypatch):
+    buffer_lines = local_history.BufferLines(3, ['a', 'b', 'c'], True)
+    state = local_history.LocalHistoryState(_Buffer(7), OrderedDict(), buffer_lines, [])
+    monkeypatch.setattr(local_history, '_local_history_state', state)
+    return buffer_lines
+
+
+def test_lines_event_updates_the_cached_lines(buffer_lines):
+    local_history.local_history_buffer_lines_event(7, 4, 1, 2, ['x', 'y'])
+
+    assert buffer_lines.lines == ['a', 'x', 'y', 'c']
+    assert buffer_lines.changedtick == 4
+
+
+def test_older_updates_are_ignored(buffer_lines):
+    local_history.local_history_buffer_lines_event(7, 3, 0, 1, ['x'])
+
+    assert buffer_lines.lines == ['a', 'b', 'c']
+
+
+def test_updates_of_other_buffers_are_ignored(buffer_lines):
+    local_history.local_history_buffer_lines_event(8, 4, 0, 1, ['x'])
+    local_history.local_history_buffer_changedtick_event(8, 5)
+    local_history.local_history_buffer_detach_event(8)
+
+    assert buffer_lines == local_history.BufferLines(3, ['a', 'b', 'c'], True)
+
+
+def test_updates_after_a_detach_are_ignored(buffer_lines):
+    local_history.local_history_buffer_detach_event(7)
+    local_history.local_history_buffer_lines_event(7, 4, 0, 1, ['x'])
+
+    assert not buffer_lines.attached
+    assert buffer_lines.lines == ['a', 'b', 'c']
+
+
+def test_changedtick_event_keeps_the_lines_valid(buffer_lines):
+    local_history.local_history_buffer_changedtick_event(7, 5)
+
+    assert buffer_lines.changedtick == 5
+
+
+def test_lines_are_read_again_once_invalidated(buffer_lines):
+    buffer_lines.changedtick = -1
+    local_history.local_history_buffer_lines_event(7, 4, 0, 1, ['x'])
+    local_history.local_history_buffer_changedtick_event(7, 5)
+
+    assert buffer_lines.changedtick == -1
@@ -0,0 +1,57 @@
+import importlib
+from collections import OrderedDict
+from conftest import save
+
+storage = importlib.import_module('local-history.storage')
+graph_log = importlib.import_module('local-history.graph_log')
+
+
+def _get_stats(local_history_storage):
+    return [(change.added, change.removed, change.size)
+            for change in local_history_storage.get_changes(with_content=False)]
+
+
+def test_changes_are_compared_with_the_previous_one(settings, workspace, clock):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'a\nb\n', clock)
+    save(settings, file_path, 'a\nc\nd\n', clock)
+    save(settings, file_path, 'd\n', clock)
+
+    assert _get_stats(storage.LocalHistoryStorage(settings, str(file_path))) == [(2, 0, 4), (2, 1, 6), (0, 2, 2)]
+
+
+def test_merged_first_change_is_still_compared_with_an_empty_file(settings, workspace, clock):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'a\nb\n', clock)
+    clock.tick(1)
+    save(settings, file_path, 'a\nc\n')
+
+    assert _get_stats(storage.LocalHistoryStorage(settings, str(file_path))) == [(2, 0, 4)]
+
+
+def test_backfill_computes_the_missing_stats(settings, workspace, clock):
+    file_path = workspace / 'file.txt'
+    for content in ('a\nb\n', 'a\nc\nd\n', 'd\n'):
+        save(settings, file_path, content, clock)
+    local_history_storage = storage.LocalHistoryStorage(settings, str(file_path))
+    # Written before the stats were stored
+    with local_history_storage._open() as local_history_file:
+        for record_id in ('1', '3'):
+            record = local_history_file[record_id]
+            record.added = record.removed = record.size = None
+            local_history_file[record_id] = record
+
+    assert _get_stats(local_history_storage) == [(None, None, None), (2, 1, 6), (None, None, None)]
+    assert local_history_storage.backfill_change_stats() == {1: (2, 0, 4), 3: (0, 2, 2)}
+    assert _get_stats(local_history_storage) == [(2, 0, 4), (2, 1, 6), (0, 2, 2)]
+    assert local_history_storage.backfill_change_stats() == {}
+
+
+def test_tree_shows_the_stats_of_the_changes(clock):
+    changes = OrderedDict([
+        (1, storage.LocalHistoryChange(1, clock.now - 600, None, added=2, removed=0, size=2048)),
+        (2, storage.LocalHistoryChange(2, clock.now - 300, None)),
+    ])
+
+    assert graph_log.build_graph_log(changes) == [
+        'o  [2] 5 minutes ago', '|', 'o  [1] 10 minutes ago +2 -0 2.0K']
@@ -0,0 +1,58 @@
+import importlib
+from conftest import save
+
+cli = importlib.import_module('local-history.cli')
+
+
+def test_diff_of_two_revisions_goes_from_the_first_to_the_second(settings, workspace, clock, capsys):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'one\n', clock)
+    save(settings, file_path, 'two\n', clock)
+
+    assert cli.main(['-p', settings.path, 'diff', str(file_path), '-r', '1', '-r', '2']) == 0
+
+    assert capsys.readouterr().out.splitlines() == [
+        '--- revision 1',
+        '+++ revision 2',
+        '@@ -1 +1 @@',
+        '-one',
+        '+two',
+    ]
+
+
+def test_diff_of_one_revision_goes_from_the_file_to_the_revision(settings, workspace, clock, capsys):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'one\n', clock)
+    save(settings, file_path, 'two\n', clock)
+    file_path.write_text('three\n')
+
+    assert cli.main(['-p', settings.path, 'diff', str(file_path), '-r', '1']) == 0
+
+    assert capsys.readouterr().out.splitlines()[:2] == ['--- current', '+++ revision 1']
+
+
+def test_diff_of_a_deleted_file_compares_it_as_empty(settings, workspace, clock, capsys):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'one\n', clock)
+    file_path.unlink()
+
+    assert cli.main(['-p', settings.path, 'diff', str(file_path)]) == 0
+
+    assert capsys.readouterr().out.splitlines()[2:] == ['@@ -0,0 +1 @@', '+one']
+
+
+def test_diff_rejects_more_than_two_revisions(settings, workspace, clock, capsys):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'one\n', clock)
+
+    assert cli.main(['-p', settings.path, 'diff', str(file_path), '-r', '1', '-r', '1', '-r', '1']) == 1
+    assert 'At most two revisions' in capsys.readouterr().err
+
+
+def test_show_prints_a_revision(settings, workspace, clock, capsys):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'one\n', clock)
+    save(settings, file_path, 'two\n', clock)
+
+    assert cli.main(['-p', settings.path, 'show', str(file_path), '-r', '1']) == 0
+    assert capsys.readouterr().out == 'one\n'
@@ -0,0 +1,92 @@
+import importlib
+from dataclasses import replace
+import pytest
+from conftest import save
+
+storage = importlib.import_module('local-history.storage')
+
+_CONTENT = ''.join('line %d\n' % line for line in range(100))
+
+
+def _edit(first_line: int, last_line: int) -> str:
+    lines = _CONTENT.splitlines(True)
+    lines[first_line:last_line] = ['edited %d\n' % line for line in range(first_line, last_line)]
+    return ''.join(lines)
+
+
+def _get_contents(settings, file_path):
+    return [record.get_content() for record in storage.LocalHistoryStorage(settings, str(file_path)).get_records()]
+
+
+@pytest.fixture
+def file_path(workspace):
+    return workspace / 'file.txt'
+
+
+def test_small_edits_within_the_delay_are_merged(settings, file_path, clock):
+    save(settings, file_path, _CONTENT, clock)
+    clock.tick(60)
+    save(settings, file_path, _edit(0, 5))
+
+    assert _get_contents(settings, file_path) == [_edit(0, 5)]
+
+
+def test_merge_window_starts_at_the_first_save(settings, file_path, clock):
+    save(settings, file_path, _CONTENT, clock)
+    for line in range(1, 4):
+        clock.tick(settings.new_change_delay // 3 - 1)
+        save(settings, file_path, _edit(0, line))
+    clock.tick(4)
+    save(settings, file_path, _edit(0, 4))
+
+    assert _get_contents(settings, file_path) == [_edit(0, 3), _edit(0, 4)]
+
+
+def test_large_edit_within_the_delay_starts_a_new_change(settings, file_path, clock):
+    # Every edited line counts twice, once removed and once added
+    save(settings, file_path, _CONTENT, clock)
+    clock.tick(60)
+    save(settings, file_path, _edit(0, settings.coalesce_max_lines // 2 + 1))
+
+    assert _get_contents(settings, file_path) == [_CONTENT, _edit(0, settings.coalesce_max_lines // 2 + 1)]
+
+
+def test_small_edits_do_not_add_up_to_a_large_merged_change(settings, file_path, clock):
+    half = settings.coalesce_max_lines // 4
+    save(settings, file_path, _CONTENT, clock)
+    clock.tick(10)
+    save(settings, file_path, _edit(0, half))
+    clock.tick(10)
+    save(settings, file_path, _edit(0, half * 2))
+    clock.tick(10)
+    save(settings, file_path, _edit(0, half * 3))
+
+    assert _get_contents(settings, file_path) == [_edit(0, half * 2), _edit(0, half * 3)]
+
+
+def test_edits_are_merged_by_time_only_without_a_line_limit(settings, file_path, clock):
+    settings = replace(settings, coalesce_max_lines=0)
+    save(settings, file_path, _CONTENT, clock)
+    clock.tick(60)
+    save(settings, file_path, _edit(0, 100))
+
+    assert _get_contents(settings, file_path) == [_edit(0, 100)]
+
+
+def test_new_change_is_never_merged(settings, file_path, clock):
+    save(settings, file_path, _CONTENT, clock)
+    clock.tick(1)
+    save(settings, file_path, _edit(0, 1), new_change=True)
+
+    assert _get_contents(settings, file_path) == [_CONTENT, _edit(0, 1)]
+
+
+def test_unsaved_snapshot_is_not_merged_into_a_saved_change(settings, file_path, clock):
+    save(settings, file_path, _CONTENT, clock)
+    clock.tick(1)
+    storage.LocalHistoryStorage(settings, str(file_path)).save_record(_edit(0, 1), unsaved=True)
+    clock.tick(1)
+    save(settings, file_path, _edit(0, 2))
+
+    records = list(storage.LocalHistoryStorage(settings, str(file_path)).get_records())
+    assert [(record.get_content(), record.unsaved) for record in records] == [(_CONTENT, False), (_edit(0, 2), False)]
@@ -0,0 +1,67 @@
+import difflib
+import importlib
+import os
+import tempfile
+from collections import OrderedDict
+import pytest
+
+local_history = importlib.import_module('local-history.local_history')
+storage = importlib.import_module('local-history.storage')
+
+
+@pytest.fixture
+def changes(monkeypatch):
+    changes = [storage.LocalHistoryChange(change_id, float(change_id), None, local_history_name='a')
+               for change_id in range(1, 5)]
+    state = local_history.LocalHistoryState(None, OrderedDict(enumerate(changes, 1)),
+                                            local_history.BufferLines(-1, [], False), [])
+    monkeypatch.setattr(local_history, '_local_history_state', state)
+    return changes
+
+
+def test_selected_change_is_diffed_against_the_buffer(changes):
+    assert local_history._get_diff_changes(changes[2]) == [changes[2]]
+
+
+def test_marked_change_is_diffed_against_the_selected_one_oldest_first(changes):
+    local_history._local_history_state.marks.append(changes[3].key)
+
+    assert local_history._get_diff_changes(changes[1]) == [changes[1], changes[3]]
+    assert local_history._get_diff_changes(changes[3]) == [changes[3]]
+
+
+def test_two_marked_changes_are_diffed_together(changes):
+    local_history._local_history_state.marks.extend([changes[2].key, changes[0].key])
+
+    assert local_history._get_diff_changes(changes[1]) == [changes[0], changes[2]]
+
+
+def _write_temporary_file(folder, content, mode=0o600):
+    file_descriptor, file_path = tempfile.mkstemp(dir=folder)
+    os.write(file_descriptor, content)
+    os.close(file_descriptor)
+    os.chmod(file_path, mode)
+    return file_path
+
+
+def test_only_the_diff_files_of_the_old_versions_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    diff = '\n'.join(difflib.unified_diff(['a', 'b'], ['a', 'c'], 'current', 'history', lineterm='')) + '\n'
+    removed = [
+        _write_temporary_file(str(tmp_path), diff.encode('utf-8')),
+        _write_temporary_file(str(tmp_path), b'Contents are identical\n'),
+    ]
+    kept = [
+        # Written by something else
+        _write_temporary_file(str(tmp_path), b'--- current\n+++ history\nsomething else\n'),
+        _write_temporary_file(str(tmp_path), b'Contents are identical\nand more\n'),
+        _write_temporary_file(str(tmp_path), diff.encode('utf-8'), 0o644),
+        str(tmp_path / 'history.diff'),
+    ]
+    with open(kept[-1], 'wb') as file:
+        file.write(b'Contents are identical\n')
+    os.chmod(kept[-1], 0o600)
+
+    local_history._remove_legacy_diff_files()
+
+    assert [os.path.exists(file_path) for file_path in removed + kept] == [False] * len(removed) + [True] * len(kept)
@@ -0,0 +1,116 @@
+import fnmatch
+import importlib
+import os
+import pytest
+
+exclude = importlib.import_module('local-history.exclude')
+
+
+def _matches(lines, path, is_directory=False):
+    return exclude.IgnoreRules(lines).match(path, is_directory)
+
+
+@pytest.mark.parametrize('lines, path, expected', [
+    (['*.log'], 'a.log', True),
+    (['*.log'], 'deep/folder/a.log', True),
+    (['*.log'], 'a.txt', None),
+    (['/build'], 'build', True),
+    (['/build'], 'src/build', None),
+    (['doc/*.txt'], 'doc/a.txt', True),
+    (['doc/*.txt'], 'doc/sub/a.txt', None),
+    (['**/logs'], 'a/b/logs', True),
+    (['logs/**'], 'logs/a/b.txt', True),
+    (['a/**/b'], 'a/x/y/b', True),
+    (['a/**/b'], 'a/b', True),
+    (['*.log', '!keep.log'], 'keep.log', False),
+    (['!keep.log', '*.log'], 'keep.log', True),
+    (['# comment', '', '   '], 'comment', None),
+    (['\\#file'], '#file', True),
+    (['\\!file'], '!file', True),
+    (['file\\ '], 'file ', True),
+    (['file   '], 'file', True),
+    (['[ab].txt'], 'b.txt', True),
+    (['[!ab].txt'], 'b.txt', None),
+    (['?.txt'], 'a.txt', True),
+    (['?.txt'], 'ab.txt', None),
+])
+def test_ignore_rules_follow_git(lines, path, expected):
+    assert _matches(lines, path) is expected
+
+
+def test_directory_rules_only_match_directories():
+    assert _matches(['build/'], 'build', is_directory=True) is True
+    assert _matches(['build/'], 'build', is_directory=False) is None
+
+
+@pytest.mark.parametrize('pattern',
+                         ['*.txt', '*/node_modules/*', '/tmp/*', '/a/b.txt', '*[0-9].log', '/a/?.c', '*cache*'])
+def test_exclude_patterns_match_like_fnmatch(pattern):
+    patterns = exclude.ExcludePatterns([pattern])
+    for path in ('/a/b.txt', '/a/b.txtx', '/a/node_modules/b', '/tmp/a', '/a/b1.log', '/a/b.log', '/a/b.c', '/a/bc.c',
+                 '/a/cache/b'):
+        assert patterns.match(path) == fnmatch.fnmatch(path, pattern), path
+
+
+def _write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_ignore_files_of_the_workspace(tmp_path):
+    _write(tmp_path / '.gitignore', '*.log\nbuild/\n')
+    _write(tmp_path / 'src' / '.ignore', '!keep.log\n')
+    matcher = exclude.ExcludeMatcher([], str(tmp_path), True)
+
+    assert matcher.is_excluded(str(tmp_path / 'a.log'))
+    assert not matcher.is_excluded(str(tmp_path / 'a.txt'))
+    assert not matcher.is_excluded(str(tmp_path / 'src' / 'keep.log'))
+    assert matcher.is_excluded(str(tmp_path / 'build' / 'a.txt'))
+    assert matcher.is_folder_excluded(str(tmp_path / 'build'))
+    # Files of an ignored folder can't be re-included
+    _write(tmp_path / 'build' / '.gitignore', '!*\n')
+    assert matcher.is_excluded(str(tmp_path / 'build' / 'a.txt'))
+    # Outside of the workspace
+    assert not matcher.is_excluded(os.path.join(os.path.dirname(str(tmp_path)), 'a.log'))
+
+
+def test_ignore_files_are_checked_at_most_once_per_interval(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(exclude.time, 'monotonic', lambda: now[0])
+    _write(tmp_path / '.gitignore', '*.log\n')
+    matcher = exclude.ExcludeMatcher([], str(tmp_path), True)
+    file_path = str(tmp_path / 'src' / 'a.log')
+    assert matcher.is_excluded(file_path)
+
+    stats = []
+    real_stat = os.stat
+
+    def _stat(path, *args, **kwargs):
+        if os.path.basename(str(path)) in exclude._IGNORE_FILE_NAMES:
+            stats.append(path)
+        return real_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'stat', _stat)
+    _write(tmp_path / '.gitignore', '*.tmp\n')
+    os.utime(str(tmp_path / '.gitignore'), (1, 1))
+    assert matcher.is_excluded(file_path)
+    assert matcher.is_excluded(str(tmp_path / 'src' / 'b.log'))
+    assert stats == []
+
+    now[0] += exclude._IGNORE_FILES_CHECK_INTERVAL
+    assert not matcher.is_excluded(file_path)
+    assert len(stats) == 2 * len(exclude._IGNORE_FILE_NAMES)
+
+
+def test_saving_an_ignore_file_checks_the_ignore_files_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(exclude.time, 'monotonic', lambda: 1000.0)
+    _write(tmp_path / '.gitignore', '*.log\n')
+    matcher = exclude.ExcludeMatcher([], str(tmp_path), True)
+    assert matcher.is_excluded(str(tmp_path / 'a.log'))
+
+    _write(tmp_path / '.gitignore', '*.tmp\n')
+    os.utime(str(tmp_path / '.gitignore'), (1, 1))
+    matcher.is_excluded(str(tmp_path / '.gitignore'))
+
+    assert not matcher.is_excluded(str(tmp_path / 'a.log'))
+    assert matcher.is_excluded(str(tmp_path / 'a.tmp'))
@@ -0,0 +1,77 @@
+import importlib
+import io
+import subprocess
+import pytest
+from conftest import save
+
+git_export = importlib.import_module('local-history.git_export')
+utils = importlib.import_module('local-history.utils')
+
+
+def _git(repository, *args):
+    return subprocess.run(['git', '-C', str(repository)] + list(args), check=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout
+
+
+@pytest.fixture
+def histories(settings, workspace, clock):
+    # Revisions of both files interleaved in time, one content saved twice
+    (workspace / 'src').mkdir()
+    save(settings, workspace / 'a.txt', 'a1\n', clock)
+    save(settings, workspace / 'src' / 'b.txt', 'b1\n', clock)
+    save(settings, workspace / 'a.txt', 'a2\n', clock)
+    save(settings, workspace / 'src' / 'b.txt', 'a2\n', clock)
+    return workspace
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_export_commits_every_revision_in_time_order(settings, histories, tmp_path, jobs):
+    repository = tmp_path / 'repository'
+
+    result = git_export.export_to_git(settings, [], str(repository), str(histories), 'history', jobs)
+
+    assert (result.histories, result.revisions, result.blobs) == (2, 4, 3)
+    assert _git(repository, 'log', '--format=%s', 'history').splitlines() == [
+        'Local history of src/b.txt',
+        'Local history of a.txt',
+        'Local history of src/b.txt',
+        'Local history of a.txt',
+    ]
+    assert _git(repository, 'show', 'history:a.txt') == 'a2\n'
+    assert _git(repository, 'show', 'history:src/b.txt') == 'a2\n'
+    assert _git(repository, 'show', 'history~3:a.txt') == 'a1\n'
+
+
+def test_histories_are_read_a_few_revisions_at_a_time(settings, workspace, clock):
+    revisions = git_export._REVISIONS_PER_ITEM * 2 + 1
+    for index in range(revisions):
+        save(settings, workspace / 'a.txt', '%d\n' % index, clock)
+    items = list(git_export._get_items(settings, git_export.find_local_history_names(settings)))
+
+    assert [len(item[3]) for item in items] == [git_export._REVISIONS_PER_ITEM, git_export._REVISIONS_PER_ITEM, 1]
+
+    stream = io.BytesIO()
+    result = git_export.write_fast_import_stream(stream, settings, git_export.find_local_history_names(settings),
+                                                 str(workspace), 'history', 1)
+    assert result.revisions == revisions
+    assert stream.getvalue().endswith(b'done\n')
+
+
+def test_quoted_paths():
+    assert git_export._quote_path('a b.txt') == b'a b.txt'
+    assert git_export._quote_path('a"b\n.txt') == b'"a\\"b\\n.txt"'
+
+
+def test_parallel_map_keeps_the_order_and_consumes_items_lazily():
+    consumed = []
+
+    def _items():
+        for item in range(100):
+            consumed.append(item)
+            yield item
+
+    results = utils.parallel_map(abs, _items(), 2, processes=False, chunk_size=1)
+    assert next(results) == 0
+    # At most two chunks per worker are in flight
+    assert len(consumed) <= 5
+    assert list(results) == list(range(1, 100))
@@ -0,0 +1,59 @@
+import asyncio
+import fcntl
+import importlib
+from threading import Event
+from conftest import save
+
+local_history = importlib.import_module('local-history.local_history')
+storage = importlib.import_module('local-history.storage')
+
+
+def test_read_stops_once_cancelled_and_closes_the_changes():
+    cancelled = Event()
+    closed = []
+
+    def changes():
+        try:
+            yield 1
+            yield 2
+            cancelled.set()
+            yield 3
+            yield 4
+        finally:
+            closed.append(True)
+
+    assert local_history._read_changes(changes(), cancelled) == [1, 2]
+    assert closed == [True]
+
+
+def test_cancelled_read_releases_the_lock_of_the_history(settings, workspace, clock):
+    for content in ('one\n', 'two\n'):
+        save(settings, workspace / 'file.txt', content, clock)
+    local_history_storage = storage.LocalHistoryStorage(settings, str(workspace / 'file.txt'))
+    cancelled = Event()
+    cancelled.set()
+
+    assert local_history._read_changes(local_history_storage.get_changes(False), cancelled) == []
+
+    file_path = storage.get_local_history_file_path(settings.path, local_history_storage.local_history_name)
+    with open(file_path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_closing_the_tree_window_cancels_the_load(monkeypatch):
+
+    async def _load_and_close():
+        monkeypatch.setattr(local_history, '_load_cancelled', Event())
+        monkeypatch.setattr(local_history, '_load_task', asyncio.get_event_loop().create_task(asyncio.sleep(60)))
+
+        local_history.local_history_window_closed_event('python')
+        assert not local_history._load_cancelled.is_set()
+        local_history.local_history_window_closed_event(local_history._LOCAL_HISTORY_FILE_TYPE)
+        await asyncio.wait_for(local_history.local_history_wait_for_load(), 5)
+
+        return local_history._load_task
+
+    task = asyncio.run(_load_and_close())
+
+    assert local_history._load_cancelled.is_set()
+    assert task.cancelled()
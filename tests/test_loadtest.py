@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+import gc
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+_LOADTEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'loadtest.py')
+
+_spec = importlib.util.spec_from_file_location('loadtest', _LOADTEST_PATH)
+loadtest = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(loadtest)
+
+
+def test_operation_mix_is_parsed():
+    assert loadtest._parse_mix('save=85, toggle=10,delete=0') == {'save': 85.0, 'toggle': 10.0, 'delete': 0.0}
+
+
+@pytest.mark.parametrize('mix, message', [
+    ('save=1,undo=2', 'Unknown operation undo'),
+    ('save=a', 'Invalid weight of save'),
+    ('save=0', 'The operation mix is empty'),
+])
+def test_invalid_operation_mix_is_rejected(mix, message):
+    with pytest.raises(argparse.ArgumentTypeError, match=message):
+        loadtest._parse_mix(mix)
+
+
+def test_latency_percentiles_are_exact():
+    stats = loadtest._get_latency_stats([float(latency) for latency in range(1000, 0, -1)])
+
+    assert stats == {'count': 1000, 'avg_ms': 500.5, 'p50_ms': 500.0, 'p95_ms': 950.0, 'p99_ms': 990.0,
+                     'p999_ms': 999.0, 'max_ms': 1000.0}
+    assert loadtest._get_latency_stats([]) == {'count': 0}
+
+
+def test_exceptions_of_background_tasks_are_counted_as_errors(settings):
+    args = argparse.Namespace(seed=0, skew=1.0, mix={'save': 1.0})
+    worker = loadtest._Worker(args, 0, ['file.txt'], settings, loadtest._FakeNvim(None, 0))
+
+    async def _fail():
+        raise ValueError('failed')
+
+    async def _run_task():
+        asyncio.get_running_loop().set_exception_handler(worker.handle_exception)
+        await asyncio.wait([asyncio.get_running_loop().create_task(_fail())])
+
+    asyncio.run(_run_task())
+    # Reported when the task is garbage collected
+    gc.collect()
+    worker.handle_exception(None, {'message': 'Task was destroyed but it is pending!'})
+
+    assert worker.errors == {'background: ValueError': 1, 'background: RuntimeError': 1}
+    assert 'failed' in worker.error_samples[0] and 'Task was destroyed' in worker.error_samples[1]
+
+
+def test_short_run_reports_no_errors(tmp_path):
+    process = subprocess.run([sys.executable, _LOADTEST_PATH, '--workers', '2', '--duration', '1', '--files', '3',
+                              '--lines', '20', '--backend', 'dbm.dumb', '--folder', str(tmp_path)],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=120)
+
+    report = json.loads(process.stdout.decode('utf-8'))
+    assert process.returncode == 0
+    assert report['operations'] > 0
+    assert (report['errors']['total'], report['corruption']['corrupt_histories']) == (0, 0)
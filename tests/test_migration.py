@@ -0,0 +1,78 @@
+import importlib
+import os
+import pytest
+from conftest import save
+
+migration = importlib.import_module('local-history.migration')
+storage = importlib.import_module('local-history.storage')
+
+
+class _Crash(BaseException):
+    pass
+
+
+@pytest.fixture
+def history(settings, workspace, clock):
+    file_path = workspace / 'file.txt'
+    for content in ('one\n', 'two\n', 'three\n'):
+        save(settings, file_path, content, clock)
+    return storage.LocalHistoryStorage(settings, str(file_path))
+
+
+def _get_records(local_history_storage):
+    return [(record.get_content(), record.codec) for record in local_history_storage.get_records()]
+
+
+def _get_files(settings):
+    return sorted(file_name for _, _, file_names in os.walk(settings.path) for file_name in file_names
+                  if not file_name.startswith('timeline') and not file_name.startswith('similarity'))
+
+
+def test_migration_converts_every_record(settings, history):
+    files = _get_files(settings)
+    result = migration.migrate_local_history(settings, history.local_history_name, 'lzma', '', True)
+
+    assert (result.status, result.records, result.content_size) == ('migrated', 3, 14)
+    assert _get_records(history) == [('one\n', 'lzma'), ('two\n', 'lzma'), ('three\n', 'lzma')]
+    assert _get_files(settings) == files
+    assert migration.migrate_local_history(settings, history.local_history_name, 'lzma', '', True).status == 'skipped'
+
+
+@pytest.mark.parametrize('crashing_call', [1, 2])
+def test_interrupted_swap_is_finished_or_rolled_back(settings, history, monkeypatch, crashing_call):
+    # Crash while moving the original history away (1) or while moving the converted one in place (2)
+    files = _get_files(settings)
+    rename = migration._rename
+    calls = []
+
+    def _rename(source_path, target_path):
+        calls.append(source_path)
+        if len(calls) == crashing_call:
+            raise _Crash()
+        rename(source_path, target_path)
+
+    monkeypatch.setattr(migration, '_rename', _rename)
+    with pytest.raises(_Crash):
+        migration.migrate_local_history(settings, history.local_history_name, 'lzma', '', True)
+    monkeypatch.setattr(migration, '_rename', rename)
+
+    # What the next migration does first, under the lock of the history
+    migration._recover(storage.get_local_history_file_path(settings.path, history.local_history_name))
+    expected_codec = 'lzma' if crashing_call == 2 else settings.codec
+    assert _get_records(history) == [('one\n', expected_codec), ('two\n', expected_codec),
+                                     ('three\n', expected_codec)]
+    assert _get_files(settings) == files
+
+
+def test_failed_migration_keeps_the_history(settings, history, monkeypatch):
+    files = _get_files(settings)
+    compress = migration.compress
+    monkeypatch.setattr(migration, 'compress', lambda content, codec: compress(content + 'x', codec))
+
+    result = migration.migrate_local_history(settings, history.local_history_name, 'lzma', '', True)
+
+    assert result.status == 'failed'
+    assert result.error == 'Content of record 1 differs after conversion'
+    assert _get_records(history) == [('one\n', settings.codec), ('two\n', settings.codec),
+                                     ('three\n', settings.codec)]
+    assert _get_files(settings) == files
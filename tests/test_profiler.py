@@ -0,0 +1,57 @@
+import importlib
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+
+profiler = importlib.import_module('local-history.profiler')
+
+
+def _work_on_the_operation_thread():
+    return sum(range(1000))
+
+
+def _work_on_another_thread():
+    return sum(range(1000))
+
+
+def test_capture_covers_the_operation_thread_and_the_other_threads(tmp_path):
+    output_path = str(tmp_path / 'profile.prof')
+    profiler.arm_capture(output_path)
+    assert profiler.start_capture()
+    # Only one capture at a time
+    assert not profiler.start_capture()
+    _work_on_the_operation_thread()
+    # Calls on the operation thread are not profiled twice
+    profiler.profile_call(_work_on_the_operation_thread)
+    with ThreadPoolExecutor(1) as executor:
+        executor.submit(profiler.profile_call, _work_on_another_thread).result()
+    capture = profiler.stop_capture()
+
+    lines = profiler.write_capture(capture, 'test')
+
+    assert lines[0] == '[vim-local-history] Profile of test saved to %s' % output_path
+    functions = {function: stats[1] for (_, _, function), stats in pstats.Stats(output_path).stats.items()}
+    assert functions['_work_on_the_operation_thread'] == 2
+    assert functions['_work_on_another_thread'] == 1
+    assert len(capture.profiles) == 2
+
+
+def test_nothing_is_captured_unless_armed():
+    assert not profiler.start_capture()
+    assert profiler.write_capture(profiler.stop_capture(), 'test') is None
+
+
+def test_stats_of_timers_and_counters():
+    profiler.reset_stats()
+    for elapsed in (1, 2, 3, 400):
+        profiler.record('stage', elapsed)
+    profiler.count('counter', 2)
+    profiler.count('counter')
+
+    stats = profiler.get_stats()
+
+    timer = stats['timers']['stage']
+    assert (timer['count'], timer['total_ms'], timer['min_ms'], timer['max_ms']) == (4, 406, 1, 400)
+    assert timer['p50_ms'] == 2.5
+    assert timer['p99_ms'] == 400
+    assert stats['counters'] == {'counter': 3}
+    assert profiler.format_stats(stats)[1].split()[:2] == ['stage', '4']
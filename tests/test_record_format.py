@@ -0,0 +1,120 @@
+import importlib
+import pickle
+import pytest
+from conftest import save
+
+storage = importlib.import_module('local-history.storage')
+utils = importlib.import_module('local-history.utils')
+
+
+def _open(tmp_path):
+    return storage.open_local_history_file(str(tmp_path / 'history'), 'dbm.dumb')
+
+
+def _pickle_legacy(value, state) -> bytes:
+    # As pickled by the versions which stored fewer fields
+    cls = type(value)
+    get_state = cls.__getstate__
+    cls.__getstate__ = lambda self: state
+    try:
+        return pickle.dumps(value)
+    finally:
+        cls.__getstate__ = get_state
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'unsaved': True, 'codec': 'lzma', 'checksum': 0xffffffff, 'first_timestamp': 1.5, 'added': 3, 'removed': 0,
+     'size': 1 << 40},
+])
+def test_record_metadata_round_trip(kwargs):
+    record = storage.LocalHistoryRecord(7, 1600000000.25, b'content', 6, 8, sketch_rate=4, **kwargs)
+    record.sketch = b'sketch'
+
+    unpacked, sketch_size = storage._unpack_record(storage._pack_record(record))
+
+    assert sketch_size == 6 and unpacked.compressed_size == 7
+    for name in ('record_id', 'timestamp', 'previous_record_id', 'next_record_id', 'unsaved', 'codec', 'checksum',
+                 'first_timestamp', 'sketch_rate', 'added', 'removed', 'size'):
+        assert getattr(unpacked, name) == getattr(record, name), name
+    with pytest.raises(ValueError):
+        unpacked.content
+
+
+def test_header_round_trip():
+    header = storage.LocalHistoryRecordHeader(3, 2, 4, '/tmp/é.txt', 'linked')
+
+    unpacked = storage._unpack_header(storage._pack_header(header))
+
+    assert unpacked.__getstate__() == header.__getstate__()
+
+
+def test_newer_format_version_is_rejected():
+    data = bytearray(storage._pack_record(storage.LocalHistoryRecord(1, 0.0, b'', 0, 0)))
+    data[3] = storage._FORMAT_VERSION + 1
+
+    with pytest.raises(ValueError, match='Unsupported record format version'):
+        storage._unpack_record(bytes(data))
+
+
+def test_content_is_stored_under_its_own_key(tmp_path):
+    record = storage.LocalHistoryRecord(1, 0.0, None, 0, 0)
+    record.set_content(utils.compress('one\n'), utils.DEFAULT_CODEC)
+    record.sketch = b'1234'
+    local_history_file = _open(tmp_path)
+    try:
+        local_history_file['1'] = record
+        assert list(local_history_file) == ['1']
+        assert local_history_file.get_content_keys() == [record.content_key]
+        assert local_history_file.get_value('1', False).compressed_size == record.compressed_size
+        loaded = local_history_file['1']
+        assert (loaded.get_content(), loaded.sketch) == ('one\n', b'1234')
+
+        # The content of the previous version of the record is removed
+        loaded.set_content(utils.compress('two\n'), utils.DEFAULT_CODEC)
+        local_history_file['1'] = loaded
+        assert local_history_file.get_content_keys() == [loaded.content_key] != [record.content_key]
+
+        del local_history_file['1']
+        assert local_history_file.get_content_keys() == []
+    finally:
+        local_history_file.close()
+
+
+def test_truncated_content_is_reported(tmp_path):
+    record = storage.LocalHistoryRecord(1, 0.0, None, 0, 0)
+    record.set_content(utils.compress('one\n'), utils.DEFAULT_CODEC)
+    local_history_file = _open(tmp_path)
+    try:
+        local_history_file['1'] = record
+        local_history_file.dict[record.content_key.encode('utf-8')] = record.content[:-1]
+
+        with pytest.raises(ValueError, match='truncated'):
+            local_history_file['1']
+    finally:
+        local_history_file.close()
+
+
+def test_legacy_pickled_history_is_read_and_converted_on_write(settings, workspace, clock):
+    file_path = workspace / 'file.txt'
+    local_history_storage = storage.LocalHistoryStorage(settings, str(file_path))
+    with local_history_storage._open() as local_history_file:
+        for record_id, content in ((1, 'one\n'), (2, 'two\n')):
+            record = storage.LocalHistoryRecord(record_id, clock.tick(), None, record_id - 1, (record_id + 1) % 3)
+            local_history_file.dict[str(record_id).encode('utf-8')] = _pickle_legacy(record, {
+                'record_id': record_id, 'timestamp': record.timestamp, 'content': utils.compress(content, 'bz2'),
+                'previous_record_id': record_id - 1, 'next_record_id': (record_id + 1) % 3})
+        header = storage.LocalHistoryRecordHeader(2, 1, 2)
+        local_history_file.dict[storage._LOCAL_HISTORY_HEADER.encode('utf-8')] = _pickle_legacy(header, {
+            'num_records': 2, 'first_record_id': 1, 'last_record_id': 2})
+        assert local_history_file.is_legacy('1') and local_history_file.is_legacy('header')
+
+    assert [record.get_content() for record in local_history_storage.get_records()] == ['one\n', 'two\n']
+    assert [record.checksum for record in local_history_storage.get_records()] == [None, None]
+
+    save(settings, file_path, 'three\n', clock)
+
+    with local_history_storage._open() as local_history_file:
+        assert [local_history_file.is_legacy(key) for key in ('1', '2', '3', 'header')] == [True, False, False, False]
+    assert [record.get_content() for record in local_history_storage.get_records()] == ['one\n', 'two\n', 'three\n']
+
@@ -0,0 +1,67 @@
+import importlib
+from conftest import save
+
+cli = importlib.import_module('local-history.cli')
+restore = importlib.import_module('local-history.restore')
+storage = importlib.import_module('local-history.storage')
+
+
+def _restore(settings, timestamp, workspace, apply=False, skipped_paths=()):
+    results = restore.restore_local_histories(settings, timestamp, str(workspace), apply, skipped_paths, 1, False)
+    return {result.file_path: result for result in results}
+
+
+def test_files_created_after_the_time_are_reported_missing(settings, workspace, clock):
+    old_file_path = workspace / 'old.txt'
+    new_file_path = workspace / 'new.txt'
+    save(settings, old_file_path, 'old\n', clock)
+    timestamp = clock.tick()
+    save(settings, old_file_path, 'changed\n', clock)
+    save(settings, new_file_path, 'new\n', clock)
+
+    results = _restore(settings, timestamp, workspace)
+
+    assert results[str(old_file_path)].status == 'changed'
+    assert (results[str(old_file_path)].added, results[str(old_file_path)].removed) == (1, 1)
+    assert results[str(new_file_path)].status == 'missing'
+
+
+def test_restore_at_reports_the_missing_files(settings, workspace, clock, capsys):
+    save(settings, workspace / 'old.txt', 'old\n', clock)
+    timestamp = clock.tick()
+    save(settings, workspace / 'new.txt', 'new\n', clock)
+
+    assert cli.main(['-p', settings.path, '-j', '1', 'restore-at', str(timestamp), '--root', str(workspace)]) == 0
+
+    assert capsys.readouterr().out.splitlines()[-1].startswith('0 files differ, 1 unchanged, 1 without revision before')
+
+
+def test_restore_keeps_the_overwritten_content(settings, workspace, clock):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'old\n', clock)
+    timestamp = clock.tick()
+    save(settings, file_path, 'new\n', clock)
+    file_path.write_text('unsaved\n')
+
+    results = _restore(settings, timestamp, workspace, apply=True)
+
+    assert results[str(file_path)].status == 'restored'
+    assert file_path.read_text() == 'old\n'
+    records = storage.LocalHistoryStorage(settings, str(file_path)).get_records()
+    assert [record.get_content() for record in records] == ['old\n', 'new\n', 'unsaved\n']
+
+
+def test_files_outside_of_the_root_and_modified_files_are_skipped(settings, workspace, tmp_path, clock):
+    other_folder = tmp_path / 'other'
+    other_folder.mkdir()
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'old\n', clock)
+    save(settings, other_folder / 'file.txt', 'old\n', clock)
+    timestamp = clock.tick()
+    save(settings, file_path, 'new\n', clock)
+
+    results = _restore(settings, timestamp, workspace, apply=True, skipped_paths=[str(file_path)])
+
+    assert results[str(file_path)].status == 'modified'
+    assert results[str(other_folder / 'file.txt')].status == 'outside'
+    assert file_path.read_text() == 'new\n'
@@ -0,0 +1,102 @@
+import dbm
+import importlib
+import os
+import pytest
+from conftest import save
+
+scrub = importlib.import_module('local-history.scrub')
+storage = importlib.import_module('local-history.storage')
+
+
+@pytest.fixture
+def history(settings, workspace, clock):
+    file_path = workspace / 'file.txt'
+    for content in ('one\n', 'two\n', 'three\n'):
+        save(settings, file_path, content, clock)
+    return storage.LocalHistoryStorage(settings, str(file_path))
+
+
+def _open(settings, history):
+    return storage.open_local_history_file(
+        storage.get_local_history_file_path(settings.path, history.local_history_name), '', 'w')
+
+
+def _corrupt_content(settings, history, record_id):
+    local_history_file = _open(settings, history)
+    try:
+        content_key = local_history_file.get_value(str(record_id), False).content_key.encode('utf-8')
+        content = local_history_file.dict[content_key]
+        local_history_file.dict[content_key] = content[:-1] + bytes([content[-1] ^ 0xff])
+    finally:
+        local_history_file.close()
+
+
+def test_intact_history(settings, history):
+    result = scrub.scrub_local_history(settings, history.local_history_name, False)
+
+    assert (result.records, result.corrupt, result.quarantined) == (3, [], 0)
+
+
+def test_corrupt_record_is_reported(settings, history):
+    _corrupt_content(settings, history, 2)
+
+    result = scrub.scrub_local_history(settings, history.local_history_name, False)
+
+    # The neighbours of the corrupt record are reported as not linked as well
+    assert result.corrupt[0] == ('2', 'checksum mismatch')
+    assert all(key == 'header' for key, _ in result.corrupt[1:])
+    assert result.quarantined == 0
+    assert len(list(history.get_records(with_content=False))) == 3
+
+
+def test_quarantine_moves_the_corrupt_record_out_and_relinks_the_others(settings, history):
+    _corrupt_content(settings, history, 2)
+
+    result = scrub.scrub_local_history(settings, history.local_history_name, True)
+
+    assert result.quarantined == 1
+    assert [record.get_content() for record in history.get_records()] == ['one\n', 'three\n']
+    assert scrub.scrub_local_history(settings, history.local_history_name, False).corrupt == []
+    # The raw bytes of the record and of its content are kept
+    with dbm.open(os.path.join(settings.path, 'quarantine', history.local_history_name), 'r') as quarantine_file:
+        keys = [key.decode('utf-8') for key in quarantine_file.keys()]
+    assert len(keys) == 2 and '2' in keys
+
+
+def test_contents_of_no_record_are_removed(settings, history):
+    local_history_file = _open(settings, history)
+    try:
+        local_history_file.dict[b'%s9.00000000' % storage._CONTENT_KEY_PREFIX.encode('utf-8')] = b'left behind'
+    finally:
+        local_history_file.close()
+
+    result = scrub.scrub_local_history(settings, history.local_history_name, True)
+
+    assert [reason for _, reason in result.corrupt] == ['content of no record']
+    assert result.quarantined == 1
+    assert scrub.scrub_local_history(settings, history.local_history_name, False).corrupt == []
+
+
+def test_broken_links_are_repaired(settings, history):
+    local_history_file = _open(settings, history)
+    try:
+        record = local_history_file['3']
+        record.previous_record_id = 1
+        local_history_file['3'] = record
+    finally:
+        local_history_file.close()
+
+    result = scrub.scrub_local_history(settings, history.local_history_name, True)
+
+    assert result.corrupt == [('header', 'record 3 is not linked to its neighbours')]
+    assert scrub.scrub_local_history(settings, history.local_history_name, False).corrupt == []
+    assert [record.get_content() for record in history.get_records()] == ['one\n', 'two\n', 'three\n']
+
+
+def test_histories_are_scrubbed_in_threads(settings, history):
+    _corrupt_content(settings, history, 1)
+
+    results = list(scrub.scrub_local_histories(settings, [], False, 2, 0, False))
+
+    assert [(result.name, result.corrupt[0]) for result in results] == [(history.local_history_name,
+                                                                          ('1', 'checksum mismatch'))]
@@ -0,0 +1,95 @@
+import importlib
+import json
+import logging
+import os
+import pytest
+from conftest import save
+
+storage = importlib.import_module('local-history.storage')
+cli = importlib.import_module('local-history.cli')
+
+
+def _flatten(settings, local_history_storage) -> str:
+    # Layout of the versions before sharding
+    folder = os.path.dirname(storage._get_sharded_file_path(settings.path, local_history_storage.local_history_name))
+    for file_name in os.listdir(folder):
+        os.replace(os.path.join(folder, file_name), os.path.join(settings.path, file_name))
+    storage._sharded_paths.discard(settings.path)
+    return folder
+
+
+def test_histories_are_stored_in_shard_folders(settings, workspace, clock):
+    save(settings, workspace / 'file.txt', 'one\n', clock)
+    name = storage.LocalHistoryStorage(settings, str(workspace / 'file.txt')).local_history_name
+
+    assert storage.get_local_history_file_path(settings.path, name) == os.path.join(settings.path, name[0],
+                                                                                    name[1:3], name)
+    assert storage.find_local_history_names(settings) == [name]
+
+
+def test_flat_histories_are_moved_on_first_use(settings, workspace, clock):
+    for file_name in ('a.txt', 'b.txt'):
+        save(settings, workspace / file_name, file_name, clock)
+    storages = [storage.LocalHistoryStorage(settings, str(workspace / file_name)) for file_name in ('a.txt', 'b.txt')]
+    folders = [_flatten(settings, local_history_storage) for local_history_storage in storages]
+    name = storages[0].local_history_name
+    # Lock of an older version and file of an interrupted migration
+    open(os.path.join(settings.path, name + '.lock'), 'w').close()
+    open(os.path.join(settings.path, name + '.migrate.dat'), 'w').close()
+
+    names = sorted(local_history_storage.local_history_name for local_history_storage in storages)
+    assert storage.find_local_history_names(settings) == names
+
+    assert sorted(file_name for file_name in os.listdir(settings.path) if not os.path.isdir(
+        os.path.join(settings.path, file_name))) == ['timeline', 'timeline.lock']
+    assert os.path.isfile(os.path.join(folders[0], name + '.migrate.dat'))
+    assert [local_history_storage.get_last_record().get_content()
+            for local_history_storage in storages] == ['a.txt', 'b.txt']
+
+
+def test_history_in_both_layouts_is_left_in_place(settings, workspace, clock, caplog):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'flat\n', clock)
+    local_history_storage = storage.LocalHistoryStorage(settings, str(file_path))
+    _flatten(settings, local_history_storage)
+    storage._sharded_paths.add(settings.path)
+    save(settings, file_path, 'sharded\n', clock)
+    storage._sharded_paths.discard(settings.path)
+
+    with caplog.at_level(logging.WARNING):
+        storage.find_local_history_names(settings)
+
+    assert 'exists in the flat and the sharded layouts' in caplog.text
+    assert local_history_storage.get_last_record().get_content() == 'sharded\n'
+    assert any(file_name.startswith(local_history_storage.local_history_name)
+               for file_name in os.listdir(settings.path))
+
+
+@pytest.fixture
+def dbm_backends(monkeypatch):
+    monkeypatch.setattr(storage, '_dbm_backends', {})
+
+
+def test_unavailable_backend_falls_back_to_an_available_one(dbm_backends, caplog):
+    with caplog.at_level(logging.WARNING):
+        backend = storage.get_dbm_backend('dbm.missing')
+        assert storage.get_dbm_backend('dbm.missing') == backend
+
+    assert backend in ('dbm.gnu', 'dbm.ndbm', 'dbm.dumb')
+    assert caplog.text.count('dbm implementation dbm.missing is not available') == 1
+    assert storage.get_dbm_backend('dbm.dumb') == 'dbm.dumb'
+
+
+def test_stats_report_the_backend_of_every_history(settings, workspace, clock, capsys):
+    save(settings, workspace / 'file.txt', 'one\n', clock)
+
+    assert cli.main(['-p', settings.path, 'stats', '--json']) == 0
+
+    total = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert (total['histories'], total['backends']) == (1, {'dbm.dumb': 1})
+
+
+def test_migrate_fails_early_without_the_backend(settings, capsys):
+    assert cli.main(['-p', settings.path, 'migrate', '--backend', 'dbm.missing']) == 1
+
+    assert 'dbm implementation dbm.missing is not available' in capsys.readouterr().err
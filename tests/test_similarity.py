@@ -0,0 +1,109 @@
+import importlib
+import os
+from dataclasses import replace
+from conftest import save
+
+storage = importlib.import_module('local-history.storage')
+similarity = importlib.import_module('local-history.similarity')
+
+_CONTENT = ''.join('line %d\n' % line for line in range(40))
+
+
+def test_find_returns_identical_then_similar_histories(tmp_path):
+    similar = _CONTENT.replace('line 3\n', 'line three\n')
+    similarity.write_similarity_index(str(tmp_path), [('a', similar), ('b', _CONTENT), ('c', 'other\ncontent\n')], 0)
+
+    similarity_index = similarity.get_similarity_index(str(tmp_path))
+
+    assert similarity_index.complete
+    candidates = similarity_index.find(_CONTENT, 0.5)
+    assert [name for name, _ in candidates] == ['b', 'a']
+    assert candidates[0][1] == 1.0 and 0.5 <= candidates[1][1] < 1.0
+
+
+def test_appended_entries_replace_the_previous_revision_of_a_history(tmp_path):
+    similarity.write_similarity_index(str(tmp_path), [('a', _CONTENT)], 0)
+    similarity_index = similarity.get_similarity_index(str(tmp_path))
+
+    similarity.add_to_similarity_index(str(tmp_path), 'b', _CONTENT)
+    similarity.add_to_similarity_index(str(tmp_path), 'a', 'other\ncontent\n')
+    similarity_index.refresh()
+    assert similarity_index.find(_CONTENT, 0.5) == [('b', 1.0)]
+
+    similarity.remove_from_similarity_index(str(tmp_path), 'b')
+    similarity_index.refresh()
+    assert similarity_index.find(_CONTENT, 0.5) == []
+
+
+def test_index_without_header_is_incomplete(tmp_path):
+    similarity.add_to_similarity_index(str(tmp_path), 'a', _CONTENT)
+
+    similarity_index = similarity.get_similarity_index(str(tmp_path))
+
+    assert not similarity_index.complete
+    assert similarity_index.find(_CONTENT, 0.5) == [('a', 1.0)]
+
+
+def test_compaction_keeps_the_last_entry_of_every_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(similarity, '_MAX_SIMILARITY_INDEX_SIZE', 1024)
+    similarity.write_similarity_index(str(tmp_path), [], 0)
+    for revision in range(20):
+        similarity.add_to_similarity_index(str(tmp_path), 'a', _CONTENT + str(revision))
+    similarity.add_to_similarity_index(str(tmp_path), 'b', _CONTENT)
+
+    with open(str(tmp_path / 'similarity')) as file:
+        lines = file.readlines()
+    similarity_index = similarity.get_similarity_index(str(tmp_path))
+
+    assert len(lines) < 22
+    assert similarity_index.complete
+    assert similarity_index.find(_CONTENT + '19', 0.99)[0] == ('a', 1.0)
+
+
+def _save_and_index(settings, file_path, content, clock):
+    save(settings, file_path, content, clock)
+    storage.flush_similarity_indexes()
+
+
+def test_renamed_file_continues_the_history_of_the_previous_path(settings, workspace, clock):
+    settings = replace(settings, track_renames=True)
+    old_path = workspace / 'old.txt'
+    new_path = workspace / 'new.txt'
+    # The first save builds the index in the background, without looking for renames
+    _save_and_index(settings, old_path, _CONTENT, clock)
+    _save_and_index(settings, old_path, _CONTENT + 'more\n', clock)
+    os.rename(str(old_path), str(new_path))
+
+    _save_and_index(settings, new_path, _CONTENT + 'more\nand more\n', clock)
+
+    old_storage = storage.LocalHistoryStorage(settings, str(old_path))
+    new_storage = storage.LocalHistoryStorage(settings, str(new_path))
+    assert new_storage.get_header().linked_from == old_storage.local_history_name
+    linked_changes = list(new_storage.get_linked_changes(with_content=False))
+    assert [(change.local_history_name, change.change_id, change.file_path) for change in linked_changes] == [
+        (old_storage.local_history_name, 1, str(old_path)), (old_storage.local_history_name, 2, str(old_path))]
+    # The old history is not offered to the next new file
+    assert [name for name, _ in similarity.get_similarity_index(settings.path).find(_CONTENT, 0.5)] == [
+        new_storage.local_history_name]
+
+
+def test_copied_file_starts_a_new_history(settings, workspace, clock):
+    settings = replace(settings, track_renames=True)
+    _save_and_index(settings, workspace / 'old.txt', _CONTENT, clock)
+    _save_and_index(settings, workspace / 'old.txt', _CONTENT + 'more\n', clock)
+
+    _save_and_index(settings, workspace / 'copy.txt', _CONTENT + 'more\n', clock)
+
+    copy_storage = storage.LocalHistoryStorage(settings, str(workspace / 'copy.txt'))
+    assert copy_storage.get_header().linked_from == ''
+    assert list(copy_storage.get_linked_changes(with_content=False)) == []
+
+
+def test_renames_are_not_tracked_when_disabled(settings, workspace, clock):
+    _save_and_index(settings, workspace / 'old.txt', _CONTENT, clock)
+    os.rename(str(workspace / 'old.txt'), str(workspace / 'new.txt'))
+
+    _save_and_index(settings, workspace / 'new.txt', _CONTENT, clock)
+
+    assert storage.LocalHistoryStorage(settings, str(workspace / 'new.txt')).get_header().linked_from == ''
+    assert not os.path.exists(os.path.join(settings.path, 'similarity'))
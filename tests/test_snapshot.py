@@ -0,0 +1,95 @@
+import importlib
+from conftest import save
+
+snapshot = importlib.import_module('local-history.snapshot')
+storage = importlib.import_module('local-history.storage')
+
+
+class _Handle:
+
+    def __init__(self, delay, callback, args):
+        self.delay = delay
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        assert not self.cancelled
+        self.callback(*self.args)
+
+
+class _Loop:
+
+    def __init__(self):
+        self.handles = []
+
+    def call_later(self, delay, callback, *args):
+        handle = _Handle(delay, callback, args)
+        self.handles.append(handle)
+        return handle
+
+
+def _create_scheduler():
+    loop = _Loop()
+    captures = []
+    return loop, captures, snapshot.SnapshotScheduler(loop, captures.append)
+
+
+def test_snapshot_waits_until_the_buffer_is_idle(clock):
+    loop, captures, scheduler = _create_scheduler()
+    scheduler.notify(1, 10, 2, 60)
+    scheduler.notify(1, 11, 2, 60)
+
+    assert loop.handles[0].cancelled
+    assert loop.handles[1].delay == 2
+    loop.handles[1].fire()
+    assert captures == [1]
+    assert scheduler.is_pending(1, 11)
+    assert not scheduler.is_pending(1, 10)
+
+
+def test_snapshots_of_a_buffer_are_rate_limited(clock):
+    loop, captures, scheduler = _create_scheduler()
+    scheduler.notify(1, 10, 2, 60)
+    loop.handles[0].fire()
+    scheduler.captured(1, 10)
+
+    # Same changedtick: nothing to capture
+    scheduler.notify(1, 10, 2, 60)
+    assert len(loop.handles) == 1
+    clock.tick(15)
+    scheduler.notify(1, 12, 2, 60)
+    assert loop.handles[1].delay == 45
+
+
+def test_forgotten_buffers_are_not_captured(clock):
+    loop, captures, scheduler = _create_scheduler()
+    scheduler.notify(1, 10, 2, 60)
+    scheduler.forget(1)
+
+    assert loop.handles[0].cancelled
+    assert not scheduler.is_pending(1, 10)
+
+
+def test_unsaved_snapshots_never_override_a_saved_revision(settings, workspace, clock):
+    file_path = workspace / 'file.txt'
+    save(settings, file_path, 'saved\n', clock)
+    local_history_storage = storage.LocalHistoryStorage(settings, str(file_path))
+    clock.tick(1)
+    local_history_storage.save_record('unsaved\n', unsaved=True)
+    clock.tick(1)
+    local_history_storage.save_record('unsaved again\n', unsaved=True)
+
+    records = list(local_history_storage.get_records())
+    assert [(record.get_content(), record.unsaved) for record in records] == [('saved\n', False),
+                                                                              ('unsaved again\n', True)]
+
+    # A save replaces the snapshot taken right before it
+    clock.tick(1)
+    save(settings, file_path, 'saved again\n')
+    records = list(local_history_storage.get_records())
+    assert [(record.get_content(), record.unsaved) for record in records] == [('saved\n', False),
+                                                                              ('saved again\n', False)]
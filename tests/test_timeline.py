@@ -0,0 +1,49 @@
+import importlib
+from conftest import save
+
+storage = importlib.import_module('local-history.storage')
+timeline_module = importlib.import_module('local-history.timeline')
+
+
+def test_find_returns_the_last_revision_before_the_timestamp(tmp_path):
+    timeline_module.write_timeline(str(tmp_path), [(30.0, 'a', 3), (10.0, 'a', 1), (20.0, 'a', 2), (15.0, 'b', 1)],
+                                   0)
+    timeline = timeline_module.get_timeline(str(tmp_path))
+
+    assert timeline.complete
+    assert timeline.get_names() == ['a', 'b']
+    assert [timeline.find('a', timestamp) for timestamp in (5, 10, 25, 40)] == [None, 1, 2, 3]
+    assert timeline.find('c', 40) is None
+
+
+def test_entries_appended_out_of_order_are_sorted(tmp_path):
+    timeline_module.write_timeline(str(tmp_path), [(10.0, 'a', 1)], 0)
+    timeline_module.append_timeline_entry(str(tmp_path), 30.0, 'a', 3)
+    timeline_module.append_timeline_entry(str(tmp_path), 20.0, 'a', 2)
+
+    timeline = timeline_module.get_timeline(str(tmp_path))
+
+    assert [timeline.find('a', timestamp) for timestamp in (15, 25, 35)] == [1, 2, 3]
+
+
+def test_timeline_without_header_needs_a_rebuild(tmp_path):
+    timeline_module.append_timeline_entry(str(tmp_path), 10.0, 'a', 1)
+
+    assert timeline_module.needs_rebuild(str(tmp_path))
+    timeline_module.write_timeline(str(tmp_path), [(10.0, 'a', 1)], 0)
+    assert not timeline_module.needs_rebuild(str(tmp_path))
+
+
+def test_find_record_falls_back_to_a_scan_when_the_guess_is_wrong(settings, workspace, clock):
+    file_path = workspace / 'file.txt'
+    for content in ('one\n', 'two\n', 'three\n'):
+        save(settings, file_path, content, clock)
+    local_history_storage = storage.LocalHistoryStorage(settings, str(file_path))
+    records = list(local_history_storage.get_records(with_content=False))
+    timestamp = records[1].timestamp + 1
+
+    assert local_history_storage.find_record(timestamp, records[1].record_id).get_content() == 'two\n'
+    # Too new, too old and unknown guesses
+    for record_id in (records[2].record_id, records[0].record_id, 12345, 0):
+        assert local_history_storage.find_record(timestamp, record_id).get_content() == 'two\n'
+    assert local_history_storage.find_record(records[0].timestamp - 1, records[0].record_id) is None
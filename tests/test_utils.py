@@ -0,0 +1,113 @@
+import importlib
+import threading
+import time
+from dataclasses import replace
+import pytest
+from conftest import save
+
+local_history = importlib.import_module('local-history.local_history')
+storage = importlib.import_module('local-history.storage')
+utils = importlib.import_module('local-history.utils')
+
+
+def _slow_square(value: int) -> int:
+    # The first items finish last
+    time.sleep(0.001 * (10 - value % 10))
+    return value * value
+
+
+def test_thread_map_yields_the_results_in_order():
+    assert list(utils.thread_map(_slow_square, range(30), 4, 100, lambda _: 1)) == [
+        value * value for value in range(30)]
+    assert list(utils.thread_map(_slow_square, range(30), 1, 100, lambda _: 1)) == [
+        value * value for value in range(30)]
+
+
+def test_thread_map_bounds_the_size_of_the_pending_items():
+    consumed = []
+    results = []
+
+    def items():
+        for item in range(20):
+            consumed.append(item)
+            # Pending items add up to 10 at most, one more is being sized
+            assert len(consumed) - len(results) <= 3
+            yield item
+
+    for result in utils.thread_map(lambda item: item, items(), 8, 10, lambda _: 4):
+        results.append(result)
+
+    assert results == list(range(20))
+
+
+def test_thread_map_always_handles_an_oversized_item():
+    assert list(utils.thread_map(str, [1, 2, 3], 2, 10, lambda item: 100)) == ['1', '2', '3']
+
+
+def test_thread_map_stops_handing_items_when_the_consumer_stops():
+    consumed = []
+    started = threading.Event()
+
+    def func(item):
+        started.set()
+        return item
+
+    results = utils.thread_map(func, (consumed.append(item) or item for item in range(100)), 2, 1000, lambda _: 1)
+
+    assert next(results) == 0
+    results.close()
+    assert started.is_set() and len(consumed) <= 5
+
+
+def test_content_size_is_the_decompressed_size_or_an_estimate(settings, workspace, clock):
+    save(settings, workspace / 'file.txt', 'line\n' * 1000, clock)
+    record = storage.LocalHistoryStorage(settings, str(workspace / 'file.txt')).get_last_record()
+
+    assert storage._get_content_size(record) == 5000
+    record.size = None
+    assert storage._get_content_size(record) == record.compressed_size * storage._ESTIMATED_COMPRESSION_RATIO
+
+
+def test_contents_are_read_in_order(settings, workspace, clock, monkeypatch):
+    monkeypatch.setattr(storage, '_DECOMPRESS_JOBS', 3)
+    monkeypatch.setattr(storage, '_MAX_PENDING_CONTENT_SIZE', 20)
+    settings = replace(settings, new_change_delay=0)
+    for revision in range(10):
+        save(settings, workspace / 'file.txt', 'revision %d\n' % revision, clock)
+
+    contents = storage.LocalHistoryStorage(settings, str(workspace / 'file.txt')).get_contents()
+
+    assert [content for _, content in contents] == ['revision %d\n' % revision for revision in range(10)]
+
+
+def _revert(current: list, target: list) -> list:
+    # Applies the calls sent to Neovim to a copy of the buffer lines
+    lines = list(current)
+    for _, (_, start, end, _, replacement) in local_history._buf_set_hunks(None, utils.get_hunks(current, target)):
+        lines[start:end] = replacement
+    return lines
+
+
+@pytest.mark.parametrize('current, target', [
+    (['a', 'b', 'c'], ['a', 'b', 'c']),
+    (['a', 'b', 'c'], ['a', 'x', 'c']),
+    (['a', 'b', 'c'], ['x', 'a', 'b', 'c', 'y']),
+    (['a', 'b', 'c'], []),
+    ([], ['a', 'b']),
+    (['a', 'b', 'c', 'd', 'e'], ['a', 'c', 'x', 'e', 'f']),
+    (['a', 'a', 'a'], ['a', 'a']),
+    (['a', 'b', 'a', 'b'], ['b', 'a', 'b', 'a']),
+])
+def test_hunks_turn_the_current_lines_into_the_target(current, target):
+    assert _revert(current, target) == target
+
+
+def test_hunks_only_cover_the_changed_lines():
+    current = ['line %d' % line for line in range(1000)]
+    target = list(current)
+    target[10] = 'changed'
+    del target[500:502]
+    target.insert(900, 'added')
+
+    assert utils.get_hunks(current, target) == [(10, 11, ['changed']), (500, 502, []), (902, 902, ['added'])]
+    assert utils.count_changed_lines(current, target) == (2, 3)
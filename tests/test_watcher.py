@@ -0,0 +1,111 @@
+import importlib
+import os
+import time
+from dataclasses import replace
+import pytest
+
+local_history = importlib.import_module('local-history.local_history')
+storage = importlib.import_module('local-history.storage')
+watcher = importlib.import_module('local-history.watcher')
+
+
+def _get_contents(settings, file_path):
+    return [record.get_content() for record in storage.LocalHistoryStorage(settings, str(file_path)).get_records()]
+
+
+def test_changed_files_are_saved(settings, workspace, clock, monkeypatch):
+    monkeypatch.chdir(str(workspace))
+    monkeypatch.setattr(local_history, '_WATCH_MAX_FILE_SIZE', 100)
+    settings = replace(settings, exclude=['*.log'])
+    files = {'text.txt': 'text\n', 'binary.bin': 'bin\0ary', 'large.txt': 'x' * 101, 'excluded.log': 'log\n'}
+    for file_name, content in files.items():
+        (workspace / file_name).write_text(content)
+
+    local_history._save_changed_files(settings, [str(workspace / file_name) for file_name in files] +
+                                      [str(workspace / 'removed.txt')])
+    clock.tick()
+    local_history._save_changed_files(settings, [str(workspace / 'text.txt')])
+
+    assert [_get_contents(settings, workspace / file_name) for file_name in files] == [['text\n'], [], [], []]
+
+
+class _Stop(Exception):
+    pass
+
+
+class _FakeSource:
+
+    def __init__(self, reads):
+        self._reads = list(reads)
+        self.timeouts = []
+
+    def read(self, timeout):
+        self.timeouts.append(timeout)
+        if not self._reads:
+            raise _Stop()
+        return self._reads.pop(0)
+
+
+def test_changes_are_reported_in_batches_once_they_settle(monkeypatch):
+    monkeypatch.setattr(watcher, '_DEBOUNCE_DELAY', 0)
+    monkeypatch.setattr(watcher, '_MAX_BATCH_SIZE', 2)
+    batches = []
+    source = _FakeSource([['a', 'b'], [], ['c', 'a', 'd', 'e', 'f'], []])
+
+    with pytest.raises(_Stop):
+        watcher.FileWatcher('/', lambda folder: False, batches.append)._watch(source)
+
+    assert batches == [['a', 'b'], ['c', 'a'], ['d', 'e'], ['f']]
+    assert source.timeouts[0] is None
+
+
+def test_changes_are_reported_at_the_latest_after_the_max_delay(monkeypatch):
+    monkeypatch.setattr(watcher, '_DEBOUNCE_DELAY', 60)
+    monkeypatch.setattr(watcher, '_MAX_BATCH_DELAY', 0)
+    batches = []
+
+    with pytest.raises(_Stop):
+        watcher.FileWatcher('/', lambda folder: False, batches.append)._watch(_FakeSource([['a'], ['b']]))
+
+    assert batches == [['a'], ['b']]
+
+
+def _read_until(source, expected):
+    changes = set()
+    deadline = time.monotonic() + 5
+    while not expected <= changes and time.monotonic() < deadline:
+        changes.update(source.read(0.1))
+    return changes
+
+
+def _skip_folder(folder: str) -> bool:
+    return os.path.basename(folder) == 'skipped'
+
+
+def _open_sources(workspace):
+    sources = [watcher._PollingSource(str(workspace), _skip_folder)]
+    try:
+        sources.append(watcher._InotifySource(str(workspace), _skip_folder))
+    except OSError:
+        pass
+    for source in sources:
+        source.open()
+    return sources
+
+
+def test_sources_report_written_files(workspace, monkeypatch):
+    monkeypatch.setattr(watcher, '_POLL_INTERVAL', 0)
+    for folder in ('.git', 'skipped', 'folder'):
+        (workspace / folder).mkdir()
+    sources = _open_sources(workspace)
+    try:
+        for folder in ('.git', 'skipped', 'folder', 'new'):
+            os.makedirs(str(workspace / folder), exist_ok=True)
+            (workspace / folder / 'file.txt').write_text('content')
+        expected = {str(workspace / 'folder' / 'file.txt'), str(workspace / 'new' / 'file.txt')}
+
+        for source in sources:
+            assert _read_until(source, expected) == expected
+    finally:
+        for source in sources:
+            source.close()